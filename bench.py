@@ -0,0 +1,233 @@
+"""
+End-to-end benchmarks of the CLI against the mock Diderot server.
+
+Each benchmark runs a command in a fresh process against test_server.py,
+started with --stateful and the requested --latency, and measures its wall
+time, the number of requests it sent, the bytes it sent and received (from
+its --trace records) and its peak resident memory. The data is a synthetic
+book of --chapters chapters, each with an XML file, its PDF and
+--attachments attachments of --attachment-size bytes, laid out like
+bulk_test/bulk_upload.json, and an assignment handin of --handin-size bytes.
+
+    python bench.py --chapters 20 --attachments 5 --latency 0.02 --output before.json
+    python bench.py --chapters 20 --attachments 5 --latency 0.02 --compare before.json
+    python bench.py --latency exp:0.05 --server-args "--bandwidth 1e6 --lock-rate 2e6"
+
+Results are saved as JSON with the commit they were measured at, so that
+runs can be compared across commits with --compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from diderot_cli.constants import ADDR
+
+BENCH_PORT = 8090
+COURSE = "TestCourse0"
+BOOK = "BenchBook"
+HOMEWORK = "TestHW1"
+
+
+def write_random(path, size):
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+
+
+def make_book(root, chapters, attachments, attachment_size):
+    """make_book writes a synthetic book under root and returns the path of its upload-book JSON file."""
+
+    book = {
+        "book": BOOK,
+        "title": "Benchmark book",
+        "parts": [{"number": 1, "title": "Benchmark part", "label": "part:bench"}],
+        "chapters": [],
+    }
+    for number in range(1, chapters + 1):
+        directory = os.path.join(root, f"chapter{number}")
+        os.makedirs(directory)
+        with open(os.path.join(directory, "chapter.xml"), "w") as f:
+            f.write(f"<chapter><title>Chapter {number}</title></chapter>\n")
+        write_random(os.path.join(directory, "chapter.pdf"), attachment_size)
+        for i in range(attachments):
+            write_random(os.path.join(directory, f"figure{i}.jpg"), attachment_size)
+        chapter = {
+            "number": number,
+            "part": 1,
+            "label": f"chapter:{number}",
+            "title": f"Chapter {number}",
+            "xml": f"chapter{number}/chapter.xml",
+            "xml-pdf": f"chapter{number}/chapter.pdf",
+        }
+        if attachments:
+            chapter["attachments"] = [f"chapter{number}/*.jpg"]
+        book["chapters"].append(chapter)
+
+    path = os.path.join(root, "book.json")
+    with open(path, "w") as f:
+        json.dump(book, f, indent=2)
+    return path
+
+
+def run_cli(argv, home, cwd):
+    """
+    run_cli runs the CLI with argv in a new process, and returns its wall
+    time in seconds, its exit code and its peak resident memory in bytes.
+    """
+
+    # The CLI is imported from this checkout, whatever directory it runs in.
+    here = os.path.dirname(os.path.abspath(__file__))
+    pythonpath = os.pathsep.join(p for p in (here, os.environ.get("PYTHONPATH")) if p)
+    env = dict(os.environ, DIDEROT_HOME=home, DIDEROT_AGENT="0", PYTHONPATH=pythonpath)
+    code = "from diderot_cli.main import diderot; diderot()"
+    started = time.perf_counter()
+    with open(os.path.join(home, "output.log"), "ab") as log:
+        process = subprocess.Popen(
+            [sys.executable, "-c", code] + argv, cwd=cwd, env=env, stdout=log, stderr=log,
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - started
+    # os.waitstatus_to_exitcode is only available from Python 3.9 on.
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    rss = usage.ru_maxrss if platform.system() == "Darwin" else usage.ru_maxrss * 1024
+    return wall, process.returncode, rss
+
+
+def trace_totals(path):
+    totals = {"requests": 0, "bytes_sent": 0, "bytes_received": 0}
+    if not os.path.exists(path):
+        return totals
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            totals["requests"] += 1
+            totals["bytes_sent"] += record.get("request_bytes") or 0
+            totals["bytes_received"] += record.get("response_bytes") or 0
+    os.unlink(path)
+    return totals
+
+
+def benchmarks(book_path, handin_path):
+    """benchmarks returns the benchmarks to run, in order, as (name, command line) pairs."""
+    return [
+        ("upload-book", ["admin", "upload-book", COURSE, book_path, "--sleep-time", "1"]),
+        ("upload-book-unchanged", ["admin", "upload-book", COURSE, book_path, "--sleep-time", "1"]),
+        ("upload-chapter", [
+            "admin", "upload-chapter", COURSE, BOOK, "--chapter-number", "1", "--sleep-time", "1",
+            "--xml", os.path.join(os.path.dirname(book_path), "chapter1", "chapter.xml"),
+            "--xml-pdf", os.path.join(os.path.dirname(book_path), "chapter1", "chapter.pdf"),
+        ]),
+        ("submit-assignment", ["student", "submit-assignment", COURSE, HOMEWORK, handin_path]),
+        ("download-assignment", ["student", "download-assignment", COURSE, HOMEWORK]),
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    root = tempfile.mkdtemp(prefix="diderot-bench-")
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen(
+        [sys.executable, "test_server.py", "--port", str(options.port), "--latency", str(options.latency), "--stateful"]
+        + shlex.split(getattr(options, "server_args", "")),
+        cwd=here,
+    )
+    try:
+        time.sleep(1)
+        data = os.path.join(root, "data")
+        os.makedirs(data)
+        book_path = make_book(data, options.chapters, options.attachments, options.attachment_size)
+        handin_path = os.path.join(data, "handin.tar")
+        write_random(handin_path, options.handin_size)
+
+        home = os.path.join(root, "home")
+        os.makedirs(home)
+        trace = os.path.join(root, "trace.jsonl")
+        url = f"http://{ADDR}:{options.port}"
+        results = {}
+        for name, argv in benchmarks(book_path, handin_path):
+            downloads = os.path.join(root, "downloads")
+            shutil.rmtree(downloads, ignore_errors=True)
+            os.makedirs(downloads)
+            group, command = argv[0], argv[1:]
+            argv = [group, "--url", url, "--username", "test", "--password", "test", "--trace", trace] + command
+            wall, exit_code, rss = run_cli(argv, home, downloads)
+            results[name] = dict(wall=round(wall, 3), exit_code=exit_code, peak_rss=rss, **trace_totals(trace))
+            print(f"{name:<24}{wall:8.3f}s {results[name]['requests']:6d} requests"
+                  f" {results[name]['bytes_sent']:12d} bytes sent {rss / 2**20:8.1f} MiB"
+                  + ("" if exit_code == 0 else f"  (exit code {exit_code})"))
+        if any(r["exit_code"] != 0 for r in results.values()):
+            print(f"Some commands failed, see {os.path.join(home, 'output.log')}", file=sys.stderr)
+        else:
+            shutil.rmtree(root)
+        return results
+    finally:
+        server.kill()
+        server.wait()
+
+
+def compare(results, baseline):
+    print(f"\nCompared to {baseline.get('commit') or 'baseline'}:")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        changes = []
+        for metric in ("wall", "requests", "bytes_sent", "peak_rss"):
+            if before[metric]:
+                changes.append(f"{metric} {result[metric] / before[metric]:6.2f}x")
+        print(f"{name:<24}" + "  ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chapters", type=int, default=10, help="Chapters in the synthetic book.")
+    parser.add_argument("--attachments", type=int, default=3, help="Attachments per chapter.")
+    parser.add_argument("--attachment-size", type=int, default=256 * 1024, help="Bytes per attachment and PDF.")
+    parser.add_argument("--handin-size", type=int, default=1024 * 1024, help="Bytes of the assignment handin.")
+    parser.add_argument(
+        "--latency", default="0.01", help="Seconds the mock server takes to answer, or a distribution of them.",
+    )
+    parser.add_argument("--port", type=int, default=BENCH_PORT, help="Port of the mock server.")
+    parser.add_argument(
+        "--server-args", default="",
+        help='More options of the mock server, such as "--bandwidth 1e6 --lock-rate 1e6 --error-rate 0.05".',
+    )
+    parser.add_argument("--output", help="Saves the results to this JSON file.")
+    parser.add_argument("--compare", help="Compares the results to those saved in this JSON file.")
+    options = parser.parse_args()
+
+    results = run(options)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": {k: v for k, v in vars(options).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+    sys.exit(0 if all(r["exit_code"] == 0 for r in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+A local agent that keeps a warm, logged-in Diderot session between CLI
+invocations.
+
+The agent listens on a Unix socket inside DIDEROT_HOME. When it is running,
+the `diderot`, `diderot_admin` and `diderot_student` entry points forward their
+arguments to it instead of importing the CLI, logging in and resolving courses
+themselves. The agent runs the command in its own process, reusing the
+sessions (and their connection pools and login) of earlier commands, and
+streams the output back. Objects resolved by a command are not kept for the
+next one.
+
+This module is imported by the entry points on every invocation, so it must
+only import from the standard library at module level.
+"""
+
+import io
+import json
+import os
+import socket
+import sys
+import time
+
+import diderot_cli.constants as constants
+
+# Environment variables that influence the CLI and are forwarded to the agent.
+FORWARDED_ENV_PREFIX = "DIDEROT_"
+FORWARDED_ENV = ["DEBUG"]
+
+
+def socket_path():
+    """socket_path returns the path of the agent's socket."""
+    home = os.environ.get("DIDEROT_HOME", constants.DEFAULT_DIDEROT_HOME)
+    return os.path.join(os.path.abspath(os.path.expanduser(home)), "agent.sock")
+
+
+def _send(conn, message):
+    conn.sendall(json.dumps(message).encode() + b"\n")
+
+
+def _connect():
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+def request(message):
+    """
+    request sends a control message to the agent and returns its reply, or
+    None if the agent is not running.
+    """
+
+    conn = _connect()
+    if conn is None:
+        return None
+    with conn, conn.makefile("rb") as replies:
+        _send(conn, message)
+        line = replies.readline()
+    return json.loads(line) if line else None
+
+
+def should_forward(argv):
+    """should_forward reports whether a command line can be handed to the agent."""
+    if os.environ.get("DIDEROT_AGENT", "1") == "0":
+        return False
+    if len(argv) > 0 and argv[0] == "agent":
+        return False
+    # Profiles are of the command running in this process.
+    if "--profile" in argv:
+        return False
+    return os.path.exists(socket_path())
+
+
+def forward(argv):
+    """
+    forward runs a command line in the agent, copying its output to this
+    process' stdout and stderr. It returns the command's exit code, or None if
+    the agent is not running, in which case the caller runs the command itself.
+    """
+
+    conn = _connect()
+    if conn is None:
+        return None
+
+    env = {k: v for k, v in os.environ.items() if k.startswith(FORWARDED_ENV_PREFIX) or k in FORWARDED_ENV}
+    message = {
+        "op": "run",
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": env,
+        "tty": {"out": sys.stdout.isatty(), "err": sys.stderr.isatty()},
+    }
+    streams = {"out": sys.stdout, "err": sys.stderr}
+    with conn, conn.makefile("rb") as replies:
+        _send(conn, message)
+        for line in replies:
+            reply = json.loads(line)
+            if "exit" in reply:
+                return reply["exit"]
+            for name, stream in streams.items():
+                if name in reply:
+                    stream.write(reply[name])
+                    stream.flush()
+
+    sys.stderr.write("[ERROR]: Lost connection to the Diderot agent.\n")
+    return 1
+
+
+class _SocketStream(io.RawIOBase):
+    """_SocketStream forwards one output stream of a command to the client."""
+
+    def __init__(self, conn, name, tty):
+        self.conn = conn
+        self.name = name
+        self.tty = tty
+        self.disconnected = False
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return self.tty
+
+    def write(self, b):
+        if not self.disconnected:
+            try:
+                _send(self.conn, {self.name: bytes(b).decode("utf-8", errors="replace")})
+            except OSError:
+                # The client went away, the command still runs to completion.
+                self.disconnected = True
+        return len(b)
+
+
+class AgentServer:
+    """AgentServer runs forwarded commands against a pool of warm sessions."""
+
+    def __init__(self, idle_timeout=constants.DEFAULT_AGENT_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.path = socket_path()
+        self.started = time.time()
+        self.served = 0
+        self.running = False
+        # Logged in DiderotAPIInterfaces, keyed by (url, username, password).
+        self.sessions = {}
+
+    def _bind(self):
+        if os.path.exists(self.path):
+            if request({"op": "ping"}) is not None:
+                raise RuntimeError(f"An agent is already listening on {self.path}")
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        server.settimeout(self.idle_timeout if self.idle_timeout > 0 else None)
+        return server
+
+    def serve(self):
+        """serve handles requests one at a time until stopped or idle for too long."""
+
+        server = self._bind()
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                with conn:
+                    self._handle(conn)
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            for session in self.sessions.values():
+                session.close()
+
+    def status(self):
+        return {
+            "pid": os.getpid(),
+            "started": self.started,
+            "served": self.served,
+            "sessions": len(self.sessions),
+        }
+
+    def _handle(self, conn):
+        with conn.makefile("rb") as messages:
+            line = messages.readline()
+        if not line:
+            return
+        message = json.loads(line)
+        op = message.get("op")
+        try:
+            if op == "ping":
+                _send(conn, self.status())
+            elif op == "stop":
+                self.running = False
+                _send(conn, self.status())
+            elif op == "run":
+                self.served += 1
+                _send(conn, {"exit": self._run(conn, message)})
+        except OSError:
+            # The client disconnected before reading the reply.
+            pass
+
+    def _run(self, conn, message):
+        # Imported here: the CLI is only loaded once, by the agent, and never
+        # by the forwarding clients.
+        from diderot_cli.commands import diderot
+        from diderot_cli.context import DiderotContext
+
+        tty = message.get("tty", {})
+        stdout = io.TextIOWrapper(_SocketStream(conn, "out", tty.get("out", False)), encoding="utf-8", write_through=True)
+        stderr = io.TextIOWrapper(_SocketStream(conn, "err", tty.get("err", False)), encoding="utf-8", write_through=True)
+        saved_streams = sys.stdin, sys.stdout, sys.stderr
+        saved_env = dict(os.environ)
+        saved_cwd = os.getcwd()
+
+        dc = DiderotContext()
+        dc.sessions = self.sessions
+        try:
+            os.chdir(message["cwd"])
+            for k in list(os.environ):
+                if k.startswith(FORWARDED_ENV_PREFIX) or k in FORWARDED_ENV:
+                    del os.environ[k]
+            os.environ.update(message.get("env", {}))
+            # The agent cannot prompt, so commands see an empty stdin.
+            sys.stdin, sys.stdout, sys.stderr = io.StringIO(), stdout, stderr
+            diderot.main(args=message["argv"], prog_name="diderot", obj=dc)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception as e:
+            stderr.write(f"[ERROR]: Agent failed to run command: {e!r}\n")
+            code = 1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved_streams
+            os.environ.clear()
+            os.environ.update(saved_env)
+            os.chdir(saved_cwd)
+        return code
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the Diderot CLI agent in the foreground.")
+    parser.add_argument("--idle-timeout", type=int, default=constants.DEFAULT_AGENT_IDLE_TIMEOUT)
+    AgentServer(idle_timeout=parser.parse_args().idle_timeout).serve()
@@ -0,0 +1,256 @@
+import hashlib
+import os
+import threading
+import time
+import urllib.parse
+
+from diderot_cli.utils import debug, read_private_json, state_path, write_private_json
+
+
+class TokenCache:
+    """
+    TokenCache keeps authentication tokens on disk, scoped per Diderot URL and
+    username, so that commands can reuse them instead of logging in again.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or state_path("tokens")
+
+    @staticmethod
+    def _key(url):
+        return url.rstrip("/")
+
+    def get(self, url, username):
+        return read_private_json(self.path).get(self._key(url), {}).get(username)
+
+    def put(self, url, username, token):
+        tokens = read_private_json(self.path)
+        tokens.setdefault(self._key(url), {})[username] = token
+        self._write(tokens)
+
+    def remove(self, url, username):
+        tokens = read_private_json(self.path)
+        if tokens.get(self._key(url), {}).pop(username, None) is not None:
+            self._write(tokens)
+
+    def _write(self, tokens):
+        # Failing to persist a token only costs a login next time.
+        try:
+            write_private_json(self.path, tokens)
+        except OSError as e:
+            debug(f"Could not write token cache {self.path}: {e}")
+
+
+class Catalog:
+    """
+    Catalog is an on-disk snapshot of the course, lab, book, part and chapter
+    metadata fetched from Diderot, scoped per URL and username. Entries
+    expire after ttl seconds, and are invalidated when this CLI changes the
+    data they hold. Several processes may share a snapshot: changes are
+    merged into the file, and the file is read again when it changes.
+    """
+
+    def __init__(self, url, username, ttl, path=None):
+        digest = hashlib.sha256(f"{url.rstrip('/')}\0{username}".encode()).hexdigest()[:16]
+        self.path = path or state_path("catalog", f"{digest}.json")
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.version = None
+        self.entries = {}
+        self._load()
+
+    @staticmethod
+    def key(api, params=None):
+        if not params:
+            return api
+        return api + "?" + urllib.parse.urlencode(sorted((k, str(v)) for k, v in params.items()))
+
+    def _fresh(self, entry, now):
+        return now - entry.get("time", 0) <= self.ttl
+
+    def _load(self):
+        """_load reads the snapshot again if the file changed since it was last read."""
+        try:
+            st = os.stat(self.path)
+            version = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            version = None
+        if version != self.version:
+            self.entries = read_private_json(self.path)
+            self.version = version
+
+    def get(self, api, params=None):
+        """get returns the cached data for a request, or None if it is missing or expired."""
+        with self.lock:
+            self._load()
+            entry = self.entries.get(self.key(api, params))
+        if entry is None or not self._fresh(entry, time.time()):
+            return None
+        return entry["data"]
+
+    def put(self, api, params, data):
+        with self.lock:
+            self.entries = read_private_json(self.path)
+            self.entries[self.key(api, params)] = {"time": time.time(), "data": data}
+            self._write()
+
+    def invalidate(self, api):
+        """invalidate drops the entries of all requests to routes starting with api."""
+        with self.lock:
+            self.entries = read_private_json(self.path)
+            stale = [k for k in self.entries if k.startswith(api)]
+            for k in stale:
+                del self.entries[k]
+            if stale:
+                self._write()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _write(self):
+        now = time.time()
+        self.entries = {k: e for k, e in self.entries.items() if self._fresh(e, now)}
+        try:
+            write_private_json(self.path, self.entries)
+        except OSError as e:
+            # Keep using the entries in memory, rather than the file's.
+            debug(f"Could not write catalog {self.path}: {e}")
+            return
+        self.version = None
+
+
+class UploadManifest:
+    """
+    UploadManifest records, per Diderot URL, a fingerprint of the input of
+    the last successful content upload of every chapter, so that unchanged
+    chapters need not be uploaded again. Books and chapters are keyed by id,
+    so that those deleted and created again do not match old entries.
+    """
+
+    # Shared by the manifests of all threads, which update the same file.
+    lock = threading.Lock()
+
+    def __init__(self, url, path=None):
+        digest = hashlib.sha256(url.rstrip("/").encode()).hexdigest()[:16]
+        self.path = path or state_path("manifest", f"{digest}.json")
+
+    @staticmethod
+    def key(course, book_pk, chapter_pk):
+        return f"{course}/{book_pk}/{chapter_pk}"
+
+    def get(self, course, book_pk, chapter_pk):
+        return read_private_json(self.path).get(self.key(course, book_pk, chapter_pk))
+
+    def put(self, course, book_pk, chapter_pk, fingerprint):
+        with self.lock:
+            entries = read_private_json(self.path)
+            entries[self.key(course, book_pk, chapter_pk)] = fingerprint
+            try:
+                write_private_json(self.path, entries)
+            except OSError as e:
+                debug(f"Could not write upload manifest {self.path}: {e}")
+
+
+class LockTimes:
+    """
+    LockTimes learns how long Diderot keeps each book locked while it
+    processes an uploaded chapter, as a moving average over past uploads.
+    """
+
+    lock = threading.Lock()
+    # Weight of the latest upload in the average.
+    alpha = 0.3
+
+    def __init__(self, url, path=None):
+        self.url = url.rstrip("/")
+        self.path = path or state_path("lock_times")
+
+    def get(self, book_pk):
+        return read_private_json(self.path).get(self.url, {}).get(str(book_pk))
+
+    def record(self, book_pk, seconds):
+        with self.lock:
+            times = read_private_json(self.path)
+            books = times.setdefault(self.url, {})
+            previous = books.get(str(book_pk))
+            books[str(book_pk)] = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+            try:
+                write_private_json(self.path, times)
+            except OSError as e:
+                debug(f"Could not write lock times {self.path}: {e}")
+
+
+class UploadJobs:
+    """
+    UploadJobs keeps track, per Diderot URL, of chapter uploads that were
+    submitted without waiting for Diderot to process them.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, url, path=None):
+        self.url = url.rstrip("/")
+        self.path = path or state_path("uploads")
+
+    def list(self):
+        return read_private_json(self.path).get(self.url, {})
+
+    def add(self, job_id, job):
+        """add records a job, and returns whether it could be saved."""
+        with self.lock:
+            jobs = read_private_json(self.path)
+            jobs.setdefault(self.url, {})[job_id] = job
+            try:
+                write_private_json(self.path, jobs)
+            except OSError as e:
+                debug(f"Could not write upload jobs {self.path}: {e}")
+                return False
+            return True
+
+    def remove(self, job_id):
+        with self.lock:
+            jobs = read_private_json(self.path)
+            if jobs.get(self.url, {}).pop(job_id, None) is not None:
+                try:
+                    write_private_json(self.path, jobs)
+                except OSError as e:
+                    debug(f"Could not write upload jobs {self.path}: {e}")
+
+
+class DownloadRecords:
+    """
+    DownloadRecords remembers the validators (ETag, Last-Modified), size,
+    modification time and SHA-256 of downloaded files, by their absolute
+    path, so that they can later be downloaded again only if they changed on
+    the server, and replaced only if they did not change locally.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.path = path or state_path("downloads")
+
+    def get(self, local_path):
+        return read_private_json(self.path).get(os.path.abspath(local_path))
+
+    def put(self, local_path, record):
+        self._update(os.path.abspath(local_path), record)
+
+    def remove(self, local_path):
+        self._update(os.path.abspath(local_path), None)
+
+    def _update(self, key, record):
+        with self.lock:
+            records = read_private_json(self.path)
+            if record is None:
+                if records.pop(key, None) is None:
+                    return
+            else:
+                records[key] = record
+            try:
+                write_private_json(self.path, records)
+            except OSError as e:
+                debug(f"Could not write download records {self.path}: {e}")
@@ -0,0 +1,169 @@
+"""
+Resumable, chunked uploads of large files.
+
+A file is first registered with a POST to CHUNKED_UPLOAD_API, which returns
+an upload id and the chunk size to use. Chunks are then sent in order with
+PUTs to the upload, each with a Content-Range header and the SHA-256 of the
+chunk in X-Chunk-SHA256; the server acknowledges every chunk with the number
+of bytes it has received so far, which a GET of the upload also returns.
+Finally, the request that would have carried the file carries the upload id
+in a "<field>_upload_id" form field instead.
+
+Upload ids are kept under DIDEROT_HOME, keyed by the file's path, size and
+modification time, so that an interrupted upload of an unchanged file picks
+up after its last acknowledged chunk, even from a new process. Servers that
+do not implement the protocol get the file in the request itself, as before.
+"""
+
+import hashlib
+import os
+import requests
+
+import diderot_cli.constants as constants
+
+from diderot_cli.utils import APIError, debug, read_private_json, state_path, write_private_json
+
+# Chunked uploads are abandoned, and the remaining chunks sent again from the
+# last acknowledged one, after this many failed attempts at a single chunk.
+CHUNK_ATTEMPTS = 3
+
+
+def _file_key(url, fileobj):
+    """_file_key identifies a version of a file on disk, or returns None for other file objects."""
+    try:
+        st = os.fstat(fileobj.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    name = os.path.abspath(getattr(fileobj, "name", ""))
+    return f"{url.rstrip('/')}\0{name}\0{st.st_size}\0{st.st_mtime_ns}"
+
+
+class ChunkedUploader:
+    """ChunkedUploader sends large files of a DiderotClient's requests in resumable chunks."""
+
+    def __init__(self, client, threshold=constants.CHUNKED_UPLOAD_THRESHOLD, path=None):
+        self.client = client
+        self.threshold = threshold
+        self.path = path or state_path("chunked_uploads")
+        # Unknown until the server is first asked to start an upload.
+        self.supported = None
+
+    def _state(self):
+        return read_private_json(self.path)
+
+    def _remember(self, key, upload_id):
+        state = self._state()
+        if upload_id is None:
+            state.pop(key, None)
+        else:
+            state[key] = upload_id
+        try:
+            write_private_json(self.path, state)
+        except OSError as e:
+            debug(f"Could not write chunked upload state {self.path}: {e}")
+
+    def prepare(self, data, files):
+        """
+        prepare uploads the large files among a request's files in chunks, and
+        returns the request's data and files with them replaced by their
+        upload ids, and the keys of the uploads to forget once the request
+        succeeds.
+        """
+
+        if not files or self.supported is False:
+            return data, files, []
+        items = list(files.items()) if isinstance(files, dict) else list(files)
+        fields = list(data.items()) if isinstance(data, dict) else list(data or [])
+        remaining, keys = [], []
+        for name, value in items:
+            fileobj = value[1] if isinstance(value, (list, tuple)) else value
+            key = _file_key(self.client.url, fileobj)
+            if key is None or os.fstat(fileobj.fileno()).st_size < self.threshold:
+                remaining.append((name, value))
+                continue
+            upload_id = self.upload(key, fileobj)
+            if upload_id is None:
+                remaining.append((name, value))
+                continue
+            fields.append((f"{name}_upload_id", upload_id))
+            keys.append(key)
+        if not keys:
+            return data, files, []
+        return fields, remaining, keys
+
+    def forget(self, keys):
+        """forget drops the upload ids of uploads that have been used."""
+        for key in keys:
+            self._remember(key, None)
+
+    def _status(self, upload_id):
+        """_status returns the server's status of an upload, or None if it is unknown or malformed."""
+        try:
+            status = self.client._request("GET", constants.CHUNKED_UPLOAD_API + f"{upload_id}/").json()
+            status["received"] = int(status["received"])
+        except (APIError, requests.RequestException, ValueError, KeyError, TypeError):
+            return None
+        return status
+
+    def _start(self, fileobj, size):
+        try:
+            response = self.client._request(
+                "POST", constants.CHUNKED_UPLOAD_API,
+                data={"filename": os.path.basename(getattr(fileobj, "name", "file")), "size": size},
+            )
+            status = response.json()
+            status["id"]
+        except (APIError, ValueError, KeyError, TypeError) as e:
+            debug(f"Chunked uploads are not supported: {e}")
+            self.supported = False
+            return None
+        self.supported = True
+        return status
+
+    def upload(self, key, fileobj):
+        """
+        upload sends the contents of fileobj in chunks, resuming an earlier
+        upload of the same file if the server still has it, and returns the
+        upload id, or None if the server does not support chunked uploads.
+        """
+
+        size = os.fstat(fileobj.fileno()).st_size
+        status = None
+        upload_id = self._state().get(key)
+        if upload_id is not None:
+            status = self._status(upload_id)
+            if status is not None:
+                debug(f"Resuming upload {upload_id} at byte {status['received']} of {size}.")
+        if status is None:
+            status = self._start(fileobj, size)
+            if status is None:
+                return None
+            upload_id = status["id"]
+            self._remember(key, upload_id)
+
+        chunk_size = int(status.get("chunk_size", constants.CHUNK_SIZE))
+        received = int(status.get("received", 0))
+        failures = 0
+        while received < size:
+            fileobj.seek(received)
+            chunk = fileobj.read(chunk_size)
+            headers = {
+                "Content-Range": f"bytes {received}-{received + len(chunk) - 1}/{size}",
+                "X-Chunk-SHA256": hashlib.sha256(chunk).hexdigest(),
+            }
+            try:
+                response = self.client._request(
+                    "PUT", constants.CHUNKED_UPLOAD_API + f"{upload_id}/", data=chunk, headers=headers,
+                )
+                received = int(response.json()["received"])
+                failures = 0
+            except (APIError, requests.RequestException, ValueError, KeyError) as e:
+                failures += 1
+                if failures >= CHUNK_ATTEMPTS:
+                    raise APIError(f"Upload of {getattr(fileobj, 'name', 'file')} failed at byte {received}: {e}")
+                debug(f"Chunk at byte {received} failed ({e}), retrying.")
+                status = self._status(upload_id)
+                if status is not None:
+                    received = status["received"]
+        fileobj.seek(0)
+        return upload_id
@@ -1,12 +1,73 @@
 import click
+import importlib
+
+from click.shell_completion import CompletionItem
 
-from diderot_cli.commands import diderot_user, diderot_admin
 from diderot_cli.context import DiderotContext
 
-@click.group()
+
+class LazyGroup(click.Group):
+    """
+    LazyGroup is a click group whose subcommands are defined in modules that
+    are only imported when one of their commands runs, so that help, shell
+    completion and mistyped commands do not pay for loading all of them.
+
+    lazy_commands maps each command name to the module registering it (with
+    its register_commands function) and the command's short help, which is
+    shown in the group's help without importing the module.
+    """
+
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(self.commands) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module, _ = self.lazy_commands[cmd_name]
+            importlib.import_module(module).register_commands(self)
+        return self.commands.get(cmd_name)
+
+    def _short_help(self, ctx, name, limit=45):
+        if name not in self.commands:
+            return self.lazy_commands[name][1]
+        return self.commands[name].get_short_help_str(limit)
+
+    def format_commands(self, ctx, formatter):
+        names = [n for n in self.list_commands(ctx) if n not in self.commands or not self.commands[n].hidden]
+        if names:
+            limit = formatter.width - 6 - max(len(n) for n in names)
+            with formatter.section("Commands"):
+                formatter.write_dl([(n, self._short_help(ctx, n, limit)) for n in names])
+
+    def shell_complete(self, ctx, incomplete):
+        results = [
+            CompletionItem(n, help=self._short_help(ctx, n))
+            for n in self.list_commands(ctx)
+            if n.startswith(incomplete) and (n not in self.commands or not self.commands[n].hidden)
+        ]
+        # Skip click.Group's completion, which loads every command for its help.
+        results.extend(click.Command.shell_complete(self, ctx, incomplete))
+        return results
+
+
+@click.group(
+    cls=LazyGroup,
+    lazy_commands={
+        "admin": ("diderot_cli.commands.diderot_admin", "Admin related actions."),
+        "agent": ("diderot_cli.commands.diderot_agent", "Manage the background agent."),
+        "student": ("diderot_cli.commands.diderot_user", "Student/Regular user related actions."),
+    },
+)
+@click.option(
+    "--profile", type=click.Path(dir_okay=False),
+    help="Profiles the command, saving the statistics to this file and printing a summary.",
+)
 @click.pass_context
-def diderot(ctx):
+def diderot(ctx, profile):
     ctx.ensure_object(DiderotContext)
-
-diderot_admin.register_commands(diderot)
-diderot_user.register_commands(diderot)
+    if profile is not None:
+        from diderot_cli import profiling
+        profiling.start(ctx, profile)
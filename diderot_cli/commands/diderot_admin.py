@@ -1,19 +1,23 @@
 import click
+import glob
 import json
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 import diderot_cli.arguments as args
 import diderot_cli.options as opts
 
 from diderot_cli.commands import diderot_user
-from diderot_cli.context import DiderotContext, pass_diderot_context
-from diderot_cli.diderot_api import uses_api
+from diderot_cli.context import DiderotContext, pass_diderot_context, uses_api
 from diderot_cli.models import Book, Chapter, Course, Part
+from diderot_cli.trace import tagged
 from diderot_cli.utils import (
-    BookNotFoundAPIError,
+    APIError,
     debug as debug_echo,
     exit_with_error,
     expand_file_path,
+    output_prefix,
     print_list,
 )
 
@@ -30,6 +34,11 @@ def admin(dc: DiderotContext, **opts):
     dc.username = opts.get("username")
     dc.password = opts.get("password")
     dc.debug = opts.get("debug")
+    dc.token_cache = opts.get("token_cache")
+    dc.cache_ttl = opts.get("cache_ttl")
+    dc.timeout = opts.get("timeout")
+    dc.retry_time = opts.get("retry_time")
+    dc.trace = opts.get("trace")
 
     debug_echo(f"Context object: {dc}")
 
@@ -78,8 +87,8 @@ def list_books(dc: DiderotContext, course: str, all: bool):
 @uses_api
 @pass_diderot_context
 def list_chapters(dc: DiderotContext, course: str, book: str):
-    course = Course(dc.client.client, course)
-    book = Book(course, book)
+    course = Course.resolve(dc.client.client, course)
+    book = Book.resolve(course, book)
     print_list(
         [
             "{}. {}".format(str(float(c["rank"])).rstrip("0").rstrip("."), c["title"])
@@ -93,8 +102,8 @@ def list_chapters(dc: DiderotContext, course: str, book: str):
 @uses_api
 @pass_diderot_context
 def list_parts(dc: DiderotContext, course: str, book: str):
-    course = Course(dc.client.client, course)
-    book = Book(course, book)
+    course = Course.resolve(dc.client.client, course)
+    book = Book.resolve(course, book)
     print_list(["{}. {}".format(c["rank"], c["title"]) for c in Part.list(course, book)])
 
 
@@ -138,140 +147,110 @@ def update_assignment(dc: DiderotContext, course: str, homework: str, **options)
     click.echo("Success uploading files.")
 
 
-@click.command("upload-book")
-@args.course
-@click.argument("upload-data", type=click.Path(exists=True))  # Path? re-check this
-@opts.sleep_time
-@uses_api
-@pass_diderot_context
-def upload_book(dc: DiderotContext, course: str, upload_data: str, **options):
+def load_book_data(upload_data: str):
+    """load_book_data returns the contents of an upload-book JSON file and the directory it is in."""
     file_path = expand_file_path(upload_data)
-
     with open(file_path, "rb") as schema:
         try:
             book_data = json.load(schema)
         except Exception as e:
-            exit_with_error("Failed loading json schema with error: {}".format(e))
+            exit_with_error("Failed loading json schema {} with error: {}".format(upload_data, e))
+    return book_data, os.path.dirname(file_path)
 
-    def get_or_none(obj, field):
-        if field in obj:
-            return obj[field]
-        return None
 
-    file_prefix = os.path.dirname(file_path)
+def upload_size(book_data: dict, file_prefix: str):
+    """upload_size returns the total size in bytes of the files an upload-book JSON file refers to."""
+    paths = []
+    for chapter in book_data.get("chapters", []):
+        paths.extend(chapter.get(field) for field in ("pdf", "xml", "xml-pdf"))
+        paths.extend(chapter.get("attachments") or [])
 
-    def adjust_search_path(path):
+    size = 0
+    for path in paths:
         if path is None:
-            return None
-        return os.path.join(file_prefix, path)
-
-    # Collect the necessary Diderot objects.
-    print(f"Fetching course {course}")
-    course = Course(dc.client.client, course)
-    book_label = get_or_none(book_data, "book")
-    print(f"Uploading  book {book_label}")
-
-    # Try out "label", more consistent with Diderot terminology
-    if book_label is None:
-        book_label = get_or_none(book_data, "label")
-    # If book label is still None, then error out.
-    if book_label is None:
-        exit_with_error("Please specify a valid book to upload into")
-
-    book_title = book_data.get("title", book_label)
-    print(f"Book title {book_title}")
-    try:
-        book = Book(course, book_label)
-    except BookNotFoundAPIError:
-        Book.create(course, book_title, book_label)
-        book = Book(course, book_label)
-    print("Created  book")
-
-    book_data_chapters = book_data.get("chapters", [])
-
-    book_data_parts = book_data.get("parts", [])
-    book_data_part_numbers = set([c.get("number") for c in book_data_parts])
-    chapters_data_part_numbers = set([c.get("part") for c in book_data_chapters])
-    actual_part_numbers = set([int(float(c["rank"])) for c in Part.list(course, book)])
-    union_part_numbers = actual_part_numbers.union(book_data_part_numbers)
-    print("Setup complete.")
-
-    if union_part_numbers != set(range(1, len(union_part_numbers) + 1)):
-        exit_with_error(f"invalid JSON: resulting parts numbers are inconsistent, "
-                        f"should be a sequence of integers starting with 1 including existing parts. "
-                        f"Current numbers set is: {actual_part_numbers} and resulting using json "
-                        f"is {union_part_numbers}")
-    elif not chapters_data_part_numbers.issubset(union_part_numbers):
-        exit_with_error(f"invalid JSON: some parts numbers for chapters are invalid. "
-                        f"Resulting part number set (existing and new) is {union_part_numbers} and specified in"
-                        f" chapter number set is {chapters_data_part_numbers}")
-
-    book_data_chapter_numbers = set([c.get("number") for c in book_data_chapters])
-    actual_chapter_numbers = set([int(float(c["rank"])) for c in Chapter.list(course, book)])
-    union_chapter_numbers = actual_chapter_numbers.union(book_data_chapter_numbers)
-    if union_chapter_numbers != set(range(1, len(union_chapter_numbers) + 1)):
-        exit_with_error(f"invalid JSON: resulting chapters numbers are inconsistent, "
-                        f"should be a sequence of integers starting with 1 including existing chapters. "
-                        f"Current numbers set is: {actual_chapter_numbers} and resulting using json "
-                        f"is {union_chapter_numbers}")
-
-    click.echo("Creating parts")
-    # If the upload contains parts, create them.
-    parts = get_or_none(book_data, "parts")
-    if parts is not None:
-        for part in parts:
-            if not Part.exists(course, book, get_or_none(part, "number")):
-                dc.client.create_part(
-                    course.label,
-                    book.label,
-                    get_or_none(part, "title"),
-                    part_number = get_or_none(part, "number"),
-                    part_label = get_or_none(part, "label"),
-                )
-
-    click.echo("Creating chapters")
-    # Upload and maybe create the chapters in the input.
-    chapters = get_or_none(book_data, "chapters")
-    if chapters is None:
-        exit_with_error("invalid JSON: could not find field 'chapters'")
-
-    for chapter in chapters:
-        # Extract data from chapter json
-        number = get_or_none(chapter, "number")
-        label = get_or_none(chapter, "label")
-        title = get_or_none(chapter, "title")
-        attachments = get_or_none(chapter, "attachments")
-
-        part_num = get_or_none(chapter, "part")
-        pdf = adjust_search_path(get_or_none(chapter, "pdf"))
-        video_url = adjust_search_path(get_or_none(chapter, "video"))
-        xml = adjust_search_path(get_or_none(chapter, "xml"))
-        xml_pdf = adjust_search_path(get_or_none(chapter, "xml-pdf"))
-        publish_date = get_or_none(chapter, "publish-on-date")
-        publish_on_week = get_or_none(chapter, "publish-on-week")
-
-        if number is None:
-            exit_with_error(f"invalid JSON: must provide field 'number' for chapter {chapter}")
-
-        if Chapter.exists(course, book, number):
-            dc.client.set_publish_date(course.label, book.label, chapter_label=label, chapter_number=number)
-        else:
-            if part_num is None:
-                exit_with_error("Chapter creation in a book requires 'part' field for chapters")
-
-            dc.client.create_chapter(
-                course.label, book.label, part_number=part_num, chapter_number=number, title=title, chapter_label=label, publish_date=publish_date, publish_on_week=publish_on_week
-            )
-            click.echo(f"Successfully created chapter number ({number}), label ({label}, title ({title}).")
-
-        # Upload the target files to the chapter now.
-        attach = None
-        if attachments is not None:
-            attach = [adjust_search_path(path) for path in attachments]
-        # Set default arguments that we wont use, but upload_chapter expects.
-        click.echo(f"Uploading chapter number: {number}...")
-        dc.client.upload_chapter(course.label, book.label, number, None, attach=attach, xml=xml, xml_pdf=xml_pdf, pdf=pdf)
-        click.echo("Successfully uploaded chapter.")
+            continue
+        for g in glob.glob(expand_file_path(os.path.join(file_prefix, path))):
+            if os.path.isdir(g):
+                for root, _, names in os.walk(g):
+                    size += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+            else:
+                size += os.path.getsize(g)
+    return size
+
+
+@click.command("upload-book")
+@args.course
+@click.argument("upload-data", type=click.Path(exists=True))  # Path? re-check this
+@opts.multi_opts(opts.sleep_time, opts.lock_timeout, opts.force)
+@uses_api
+@pass_diderot_context
+def upload_book(dc: DiderotContext, course: str, upload_data: str, **options):
+    book_data, file_prefix = load_book_data(upload_data)
+    dc.client.upload_book(course, book_data, file_prefix, **options)
+
+
+@click.command("upload-books")
+@click.argument("upload-data", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--course", help="Course to upload into, for JSON files without a 'course' field.")
+@click.option(
+    "--jobs", type=click.IntRange(min=1), default=4, show_default=True,
+    help="Number of books uploaded at the same time.",
+)
+@opts.multi_opts(opts.sleep_time, opts.lock_timeout, opts.force)
+@uses_api
+@pass_diderot_context
+def upload_books(dc: DiderotContext, upload_data: tuple, course: str, jobs: int, **options):
+    """
+    Upload several books at once.
+
+    Each UPLOAD_DATA file has the format of upload-book, and may name its
+    course in a "course" field. Files for the same book are uploaded one after
+    the other, in the order given, while different books are uploaded
+    concurrently, starting with those that have the most data to upload.
+    """
+
+    # One lane per book: Diderot locks a book while it processes an upload, so
+    # only uploads to different books can overlap.
+    lanes = {}
+    for path in upload_data:
+        book_data, file_prefix = load_book_data(path)
+        course_label = book_data.get("course", course)
+        book_label = book_data.get("book", book_data.get("label"))
+        if course_label is None:
+            exit_with_error(f"No course given for {path}, use --course or a 'course' field.")
+        lane = lanes.setdefault((course_label, book_label), [])
+        lane.append((path, book_data, file_prefix, upload_size(book_data, file_prefix)))
+
+    # Starting the largest lanes first keeps a long upload from being the
+    # last one to begin.
+    order = sorted(lanes, key=lambda k: sum(f[3] for f in lanes[k]), reverse=True)
+    ctx = click.get_current_context()
+
+    def run_lane(key):
+        course_label, book_label = key
+        with ctx.scope(cleanup=False), output_prefix(f"[{course_label}/{book_label}] "), tagged(book=book_label):
+            for path, book_data, file_prefix, _ in lanes[key]:
+                try:
+                    dc.client.upload_book(course_label, book_data, file_prefix, **options)
+                except APIError as e:
+                    click.secho(f"[ERROR]: {path}: {e}", fg="red", err=True)
+                    return False
+                except SystemExit:
+                    # The error has been reported already.
+                    return False
+                except Exception as e:
+                    # Such as a connection or file error: only this lane fails.
+                    click.secho(f"[ERROR]: {path}: {e or type(e).__name__}", fg="red", err=True)
+                    return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(run_lane, order))
+
+    failed = results.count(False)
+    if failed > 0:
+        exit_with_error(f"{failed} of {len(results)} books failed to upload.")
+    click.echo(f"Uploaded {len(results)} books.")
 
 
 @click.command("upload-chapter")
@@ -279,7 +258,7 @@ def upload_book(dc: DiderotContext, course: str, upload_data: str, **options):
 @opts.multi_opts(
     opts.chapter_number, opts.chapter_label,
     opts.attach, opts.pdf, opts.xml, opts.xml_pdf,
-    opts.video_url, opts.attach, opts.sleep_time,
+    opts.video_url, opts.sleep_time, opts.lock_timeout, opts.no_wait,
 )
 @uses_api
 @pass_diderot_context
@@ -288,14 +267,36 @@ def upload_chapter(dc: DiderotContext, course: str, book: str, chapter_number: i
     if len(attached_files) > 0 and options.get("xml") is None:
         exit_with_error("Cannot use --attach if not uploading xml/mlx.\nFailure uploading chapter.")
 
-    dc.client.upload_chapter(
-        course,
-        book,
-        chapter_number,
-        chapter_label,
-        **options,
-    )
-    click.echo("Chapter uploaded successfully.")
+    with tagged(book=book, chapter=chapter_number if chapter_number is not None else chapter_label):
+        job_id = dc.client.upload_chapter(
+            course,
+            book,
+            chapter_number,
+            chapter_label,
+            **options,
+        )
+    if job_id is not None:
+        click.echo(f"Chapter upload submitted as job {job_id}. Use wait-uploads to wait for it.")
+    else:
+        click.echo("Chapter uploaded successfully.")
+
+
+@click.command("wait-uploads")
+@click.argument("jobs", nargs=-1)
+@opts.multi_opts(opts.sleep_time, opts.lock_timeout)
+@uses_api
+@pass_diderot_context
+def wait_uploads(dc: DiderotContext, jobs: tuple, **options):
+    """
+    Wait for chapter uploads submitted with --no-wait.
+
+    Waits for the given JOBS, or for all pending uploads if none are given,
+    and reports the warnings and errors of each upload as it finishes.
+    """
+
+    failed = dc.client.wait_uploads(list(jobs), **options)
+    if failed:
+        exit_with_error(f"{len(failed)} uploads failed.")
 
 
 def register_commands(click_group: click.Group):
@@ -311,10 +312,14 @@ def register_commands(click_group: click.Group):
         retract_chapter,
         update_assignment,
         upload_book,
+        upload_books,
         upload_chapter,
+        wait_uploads,
+        diderot_user.batch,
         diderot_user.download_assignment,
         diderot_user.list_assignments,
         diderot_user.list_courses,
+        diderot_user.refresh_cache,
         diderot_user.submit_assignment,
     ]
 
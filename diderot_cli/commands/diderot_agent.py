@@ -0,0 +1,87 @@
+import click
+import datetime
+import os
+import subprocess
+import sys
+import time
+
+import diderot_cli.constants as constants
+
+from diderot_cli import agent as diderot_agent
+from diderot_cli.utils import exit_with_error, state_path
+
+
+@click.group()
+def agent():
+    """
+    Manage the background agent.
+
+    While the agent is running, commands are forwarded to it and reuse its
+    logged in sessions, connections and caches instead of starting from
+    scratch. Commands run in the agent one at a time and cannot prompt for
+    input, so credentials must come from options, environment variables or a
+    credentials file. Set DIDEROT_AGENT=0 to bypass a running agent.
+    """
+
+
+@click.command("start")
+@click.option(
+    "--idle-timeout", type=click.INT, default=constants.DEFAULT_AGENT_IDLE_TIMEOUT,
+    help="Seconds without commands after which the agent exits. 0 disables the timeout.",
+)
+def start(idle_timeout: int):
+    if diderot_agent.request({"op": "ping"}) is not None:
+        click.echo("Agent is already running.")
+        return
+
+    log_path = state_path("agent.log")
+    os.makedirs(os.path.dirname(log_path), mode=0o700, exist_ok=True)
+    with open(log_path, "ab") as log:
+        subprocess.Popen(
+            [sys.executable, "-m", "diderot_cli.agent", "--idle-timeout", str(idle_timeout)],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+    for _ in range(100):
+        time.sleep(0.1)
+        if diderot_agent.request({"op": "ping"}) is not None:
+            click.echo("Agent started.")
+            return
+    exit_with_error(f"Agent did not start, see {log_path} for details.")
+
+
+@click.command("stop")
+def stop():
+    if diderot_agent.request({"op": "stop"}) is None:
+        click.echo("Agent is not running.")
+    else:
+        click.echo("Agent stopped.")
+
+
+@click.command("status")
+def status():
+    reply = diderot_agent.request({"op": "ping"})
+    if reply is None:
+        click.echo("Agent is not running.")
+        return
+    started = datetime.datetime.fromtimestamp(reply["started"]).strftime("%Y-%m-%d %H:%M:%S")
+    click.echo(
+        f"Agent running (pid {reply['pid']}) since {started}: "
+        f"{reply['served']} commands served, {reply['sessions']} sessions."
+    )
+
+
+def register_commands(click_group: click.Group):
+    commands = [
+        start,
+        stop,
+        status,
+    ]
+
+    for c in commands:
+        agent.add_command(c)
+
+    click_group.add_command(agent)
@@ -1,11 +1,17 @@
 import click
+import json
+import sys
+import time
+
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
 
 import diderot_cli.arguments as args
 import diderot_cli.options as opts
 
-from diderot_cli.context import DiderotContext, pass_diderot_context
-from diderot_cli.diderot_api import uses_api
-from diderot_cli.models import Course, Lab
+from diderot_cli.cache import Catalog
+from diderot_cli.context import DiderotContext, pass_diderot_context, uses_api
+from diderot_cli.models import Course, IdentityMap, Lab
 from diderot_cli.utils import print_list, debug as debug_echo
 
 
@@ -21,16 +27,34 @@ def student(dc: DiderotContext, **opts):
     dc.username = opts.get("username")
     dc.password = opts.get("password")
     dc.debug = opts.get("debug")
+    dc.token_cache = opts.get("token_cache")
+    dc.cache_ttl = opts.get("cache_ttl")
+    dc.timeout = opts.get("timeout")
+    dc.retry_time = opts.get("retry_time")
+    dc.trace = opts.get("trace")
 
     debug_echo(f"Context object: {dc}")
 
 
 @click.command("download-assignment")
 @args.multi_args(args.course, args.homework)
+@click.option(
+    "--keep-old", is_flag=True,
+    help="Download files that exist locally even if they may have been changed, keeping the previous copy as <name>.old.",
+)
 @uses_api
 @pass_diderot_context
-def download_assignment(dc: DiderotContext, course, homework):
-    if dc.client.download_assignment(course, homework):
+def download_assignment(dc: DiderotContext, course, homework, keep_old):
+    """
+    Download the files of an assignment.
+
+    Files downloaded before are only downloaded again if they changed on
+    Diderot, and replace the previous copy unless --keep-old is given.
+    Files that exist locally but were not downloaded by the CLI, or were
+    changed since, are left alone unless --keep-old is given.
+    """
+
+    if dc.client.download_assignment(course, homework, keep_old=keep_old):
         click.echo("Successfully downloaded assignment.")
 
 
@@ -39,7 +63,7 @@ def download_assignment(dc: DiderotContext, course, homework):
 @uses_api
 @pass_diderot_context
 def list_assignments(dc: DiderotContext, course):
-    course = Course(dc.client.client, course)
+    course = Course.resolve(dc.client.client, course)
     labs = [hw["name"] for hw in Lab.list(course)]
     if len(labs) == 0:
         click.echo("Course has no labs.")
@@ -54,6 +78,21 @@ def list_courses(dc: DiderotContext):
     print_list([c["label"] for c in Course.list(dc.client.client)])
 
 
+@click.command("refresh-cache")
+@uses_api
+@pass_diderot_context
+def refresh_cache(dc: DiderotContext):
+    """Drop the locally cached course, book and chapter metadata."""
+
+    client = dc.client.client
+    catalog = client.catalog or Catalog(dc.url, dc.username, dc.cache_ttl)
+    catalog.clear()
+    client.identities = IdentityMap()
+    # Warm the snapshot back up with the courses, which every command needs.
+    Course.list(client)
+    click.echo("Successfully refreshed the cache.")
+
+
 @click.command("submit-assignment")
 @args.multi_args(args.course, args.homework, args.handin)
 @uses_api
@@ -63,11 +102,136 @@ def submit_assignment(dc: DiderotContext, course: str, homework: str, handin: st
     click.echo("Assignment submitted successfully. Track your submission's status on Diderot.")
 
 
+def batch_argv(entry):
+    """
+    batch_argv turns a batch entry such as
+    {"command": "publish-chapter", "args": ["course", "book"], "options": {"chapter-number": 3}}
+    into the command name and its command line arguments.
+    """
+
+    if not isinstance(entry, dict) or not isinstance(entry.get("command"), str):
+        raise ValueError("each line must be a JSON object with a 'command' string")
+    argv = [str(a) for a in entry.get("args", [])]
+    for name, value in entry.get("options", {}).items():
+        flag = "--" + name.replace("_", "-")
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            if v is True:
+                argv.append(flag)
+            elif v is not False and v is not None:
+                argv.extend([flag, str(v)])
+    return entry["command"], argv
+
+
+def batch_command(group_ctx: click.Context, name):
+    """batch_command returns the subcommand of group_ctx a batch entry names."""
+
+    command = group_ctx.command.get_command(group_ctx, name)
+    if command is None or name == "batch":
+        raise ValueError(f"unknown command '{name}'")
+    return command
+
+
+def run_batch_entry(group_ctx: click.Context, command: click.Command, name, argv):
+    """run_batch_entry runs command as a subcommand of group_ctx and returns its exit code."""
+
+    try:
+        with command.make_context(name, argv, parent=group_ctx) as ctx:
+            command.invoke(ctx)
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.exceptions.Exit as e:
+        return e.exit_code
+    except click.Abort:
+        click.echo("Aborted!", err=True)
+        return 1
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    return 0
+
+
+@click.command("batch")
+@click.argument("script", type=click.File("r"))
+@click.option("--stop-on-error", is_flag=True, default=False, help="Stop at the first command that fails.")
+@pass_diderot_context
+def batch(dc: DiderotContext, script, stop_on_error: bool):
+    """
+    Run the commands of a JSONL SCRIPT (or - for stdin) in one process.
+
+    Each line is a JSON object such as {"command": "upload-chapter", "args":
+    ["course", "book"], "options": {"chapter-number": 1, "pdf": "ch1.pdf"}}.
+    All commands share a single logged in session. For each one, a JSON line
+    with its status, exit code, duration and output is printed.
+    """
+
+    from diderot_cli.diderot_api import setup_client
+
+    group_ctx = click.get_current_context().parent
+    owns_sessions = dc.sessions is None
+    if owns_sessions:
+        dc.sessions = {}
+
+    failures = 0
+    try:
+        # Log in once, up front; every command below reuses the session.
+        with setup_client(dc):
+            pass
+
+        for number, line in enumerate(script, start=1):
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            record = {"line": number}
+            stdout, stderr = StringIO(), StringIO()
+            start = time.monotonic()
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                try:
+                    entry = json.loads(line)
+                    record["command"] = entry.get("command") if isinstance(entry, dict) else None
+                    name, argv = batch_argv(entry)
+                    command = batch_command(group_ctx, name)
+                except ValueError as e:
+                    record["error"] = f"invalid batch entry: {e}"
+                    code = 2
+                else:
+                    # A command crashing must not stop the others.
+                    try:
+                        code = run_batch_entry(group_ctx, command, name, argv)
+                    except Exception as e:
+                        record["error"] = str(e) or type(e).__name__
+                        code = 1
+                if "error" in record:
+                    click.echo(f"[ERROR]: {record['error']}", err=True)
+            record.update({
+                "status": "ok" if code == 0 else "error",
+                "exit_code": code,
+                "seconds": round(time.monotonic() - start, 6),
+                "stdout": stdout.getvalue(),
+                "stderr": stderr.getvalue(),
+            })
+            click.echo(json.dumps(record))
+
+            if code != 0:
+                failures += 1
+                if stop_on_error:
+                    break
+    finally:
+        if owns_sessions:
+            for session in dc.sessions.values():
+                session.close()
+            dc.sessions = None
+
+    if failures > 0:
+        sys.exit(1)
+
+
 def register_commands(click_group: click.Group):
     commands = [
+        batch,
         download_assignment,
         list_assignments,
         list_courses,
+        refresh_cache,
         submit_assignment,
     ]
 
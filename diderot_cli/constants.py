@@ -12,11 +12,52 @@ SUBMIT_ASSIGNMENT_API = "/api/courses/{}/codelabs/{}/submissions/create_and_subm
 UPLOAD_FILES_API = "/api/courses/{}/codelabs/{}/"
 FILE_URLS_API = "api/courses/{}/codelabs/{}/attached_file_urls/"
 LOGIN_URL = "/api/users/login/"
+CHUNKED_UPLOAD_API = "/api/uploads/"
 
 DEFAULT_CRED_LOCATIONS = ["~/private/.diderot/credentials", "~/.diderot/credentials"]
 
 DEFAULT_DIDEROT_URL = "https://api.diderot.one"
 
+# Directory holding the CLI's local state (token cache, etc.). It can be
+# overridden with the DIDEROT_HOME environment variable.
+DEFAULT_DIDEROT_HOME = "~/.diderot"
+
+# Seconds for which cached course, lab, book, part and chapter metadata is used
+# before it is fetched again.
+DEFAULT_CACHE_TTL = 5 * 60
+
+# Seconds the background agent waits for a command before exiting.
+DEFAULT_AGENT_IDLE_TIMEOUT = 30 * 60
+
+# Files of at least this many bytes are sent as resumable chunked uploads
+# when the server supports them, in chunks of CHUNK_SIZE bytes unless the
+# server asks for another size.
+CHUNKED_UPLOAD_THRESHOLD = 64 * 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Seconds to wait for a connection to Diderot, and for data from it.
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+# Seconds for which requests failing with connection errors or temporary
+# server errors are retried, waiting from RETRY_INITIAL up to RETRY_CAP
+# seconds between attempts.
+DEFAULT_RETRY_TIME = 60
+RETRY_INITIAL = 0.5
+RETRY_CAP = 8
+
+# Number of files downloaded at the same time.
+DOWNLOAD_JOBS = 4
+# Number of times an interrupted download is resumed before giving up.
+DOWNLOAD_ATTEMPTS = 3
+
+# Seconds before the first check whether a book is still locked after a
+# chapter upload, when there is no history of earlier uploads to the book.
+LOCK_POLL_INITIAL = 0.5
+# Fewest seconds between two such checks, whatever --sleep-time says.
+LOCK_POLL_MIN = 0.1
+# Seconds after which a book that is still locked is reported as stuck.
+DEFAULT_LOCK_TIMEOUT = 30 * 60
+
 # OPTIONS
 # Click converts dashes in options to underscores for
 # access (get) operations.
@@ -31,6 +72,7 @@ CHAPTER_LABEL = "chapter-label"
 CHAPTER_LABEL_GET = "chapter_label"
 CHAPTER_NUMBER = "chapter-number"
 CHAPTER_NUMBER_GET = "chapter_number"
+FORCE_GET = "force"
 PDF = "pdf"
 PDF_GET = "pdf"
 PUBLISH_DATE = "publish-date"
@@ -39,6 +81,8 @@ PUBLISH_ON_WEEK = "publish-on-week"
 PUBLISH_ON_WEEK_GET = "publish_on_week"
 SLEEP_TIME = "sleep-time"
 SLEEP_TIME_GET = "sleep_time"
+LOCK_TIMEOUT_GET = "lock_timeout"
+NO_WAIT_GET = "no_wait"
 VIDEO_URL = "video-url"
 VIDEO_URL_GET = "video_url"
 XML = "xml"
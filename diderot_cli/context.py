@@ -1,5 +1,11 @@
 import click
 
+from functools import wraps
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from diderot_cli.diderot_api import DiderotAPIInterface
+
 class DiderotContext:
     def __init__(self):
         self.url: str = None
@@ -7,14 +13,44 @@ class DiderotContext:
         self.password: str = None
         self.credentials: str = None
         self.debug: bool = None
-
-        from diderot_cli.diderot_api import DiderotClient
-        self.client: DiderotClient = None
+        self.token_cache: bool = None
+        self.cache_ttl: int = None
+        self.timeout: int = None
+        self.retry_time: int = None
+        self.trace: str = None
+        # Pool of logged in sessions shared across commands, set by the agent.
+        self.sessions: dict = None
+        self.client: "DiderotAPIInterface" = None
 
     def __repr__(self):
         return (
             f"DiderotContext(url={self.url}, username={self.username}, password={self.password},"
-            f" credentials={self.credentials}, debug={self.debug})"
+            f" credentials={self.credentials}, debug={self.debug}, token_cache={self.token_cache},"
+            f" cache_ttl={self.cache_ttl}, timeout={self.timeout}, retry_time={self.retry_time},"
+            f" trace={self.trace})"
         )
 
 pass_diderot_context = click.make_pass_decorator(DiderotContext)
+
+
+def uses_api(f):
+    """
+    uses_api wraps a command that talks to Diderot, setting up dc.client for
+    it and reporting API errors. The client, and requests with it, is only
+    imported when such a command runs.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        from diderot_cli.diderot_api import setup_client
+        from diderot_cli.utils import APIError, exit_with_error
+
+        ctx = click.get_current_context()
+
+        with setup_client(ctx.obj):
+            try:
+                f(*args, **kwargs)
+            except APIError as e:
+                exit_with_error(str(e))
+
+    return wrapper
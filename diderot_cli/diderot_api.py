@@ -1,28 +1,89 @@
 import click
-import glob
+import collections
+import email.utils
+import os
 import re
 import requests
 import time
 import urllib.parse
+import urllib3
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack, contextmanager
-from functools import wraps
 from pathlib import Path
 
 import diderot_cli.constants as constants
 
-from diderot_cli.context import DiderotContext
-from diderot_cli.models import Book, Chapter, Course, Lab, Part
+from diderot_cli.cache import Catalog, DownloadRecords, LockTimes, TokenCache, UploadJobs, UploadManifest
+from diderot_cli.chunked import ChunkedUploader
+from diderot_cli.context import DiderotContext, uses_api  # noqa: F401, re-exported
+from diderot_cli.models import Book, Chapter, Course, IdentityMap, Lab, Part, rank_key
+from diderot_cli.multipart import MultipartEncoder
+from diderot_cli.polling import Backoff, poll
+from diderot_cli.records import decode
+from diderot_cli.staging import stage_upload
+from diderot_cli.throttle import Throttle, load_limits
+from diderot_cli.trace import Tracer, route_of, start_timings, tagged
+from diderot_cli.trace_adapter import TracingAdapter
 from diderot_cli.utils import (
     APIError,
+    BookNotFoundAPIError,
     download_file_helper,
     err_for_code,
     exit_with_error,
     expand_file_path,
     debug,
+    debugging,
+    in_current_context,
+    info,
+    Progress,
+    rewind_files,
     warn,
 )
 
+# Requests that can be repeated without changing their effect, and the
+# response statuses after which they are retried.
+RETRY_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+def _retry_after(response):
+    """_retry_after returns the seconds to wait given by a response's Retry-After header, if any."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def lock_backoff(sleep_time, expected=None):
+    """
+    lock_backoff returns the delays between checks whether a book is still
+    locked, growing up to sleep_time, starting a little before expected
+    seconds if earlier uploads took that long. Delays are never shorter than
+    LOCK_POLL_MIN, so that a sleep time of 0 does not flood the server.
+    """
+
+    initial = min(constants.LOCK_POLL_INITIAL, sleep_time)
+    if expected is not None:
+        initial = max(initial, 0.8 * expected)
+    return Backoff(max(constants.LOCK_POLL_MIN, initial), max(constants.LOCK_POLL_MIN, sleep_time))
+
+
+def _not_sent(error):
+    """_not_sent reports whether a failed request cannot have reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
 class DiderotClient:
     """
     DiderotClient is a wrapper around a requests.Session that maintains login
@@ -33,6 +94,51 @@ class DiderotClient:
         self.url = base_url
         self.token_header = {}
         self.client = requests.session()
+        # Courses, books, etc. resolved during this session.
+        self.identities = IdentityMap()
+        # On-disk snapshot of catalog metadata, if enabled.
+        self.catalog = None
+        # (connect, read) timeouts of every request, in seconds.
+        self.timeout = (constants.DEFAULT_CONNECT_TIMEOUT, constants.DEFAULT_READ_TIMEOUT)
+        # Seconds for which failed requests are retried.
+        self.retry_time = constants.DEFAULT_RETRY_TIME
+        # Number of retries in this session, by failure.
+        self.retries = collections.Counter()
+        # Rate and concurrency limits shared by all requests of the session.
+        self.throttle = Throttle(load_limits(base_url))
+        # Sends large files in resumable chunks, where the server supports it.
+        self.chunked = ChunkedUploader(self)
+        # Writes a trace record per request when set, see trace.py.
+        self.tracer = None
+        self.token_cache = None
+        self.username = None
+        self.password_callback = None
+        # Whether the current token came from the token cache, and whether the
+        # server has accepted it yet.
+        self.token_from_cache = False
+        self.token_verified = False
+
+    def authenticate(self, username, password_callback, token_cache=None):
+        """
+        authenticate reuses a cached token for username when one exists and
+        logs in otherwise. password_callback is only called when a login is
+        actually needed, including when the server rejects a cached token.
+        """
+
+        self.username = username
+        self.password_callback = password_callback
+        self.token_cache = token_cache
+
+        token = None
+        if token_cache is not None:
+            token = token_cache.get(self.url, username)
+        if token is None:
+            self.login(username, password_callback())
+        else:
+            debug(f"Using cached token for {username}")
+            self.token_header = {"Authorization": f"Token {token}"}
+            self.token_from_cache = True
+            self.token_verified = False
 
     def login(self, username, password):
         """Log in to Diderot to get the authentication token"""
@@ -43,16 +149,144 @@ class DiderotClient:
         }
         login_url = urllib.parse.urljoin(self.url, constants.LOGIN_URL)
         debug(f"Logging in: URL({login_url}) with credentials ({login_data})")
-        r = self.client.post(login_url, data=login_data)
+        r = self._send("POST", login_url, data=login_data)
         if len(r.history) > 0:
             code = r.history[0].status_code
         else:
             code = r.status_code
 
         if not code == 200:
+            if self.token_cache is not None:
+                self.token_cache.remove(self.url, username)
             exit_with_error(err_for_code(code, r))
         token = r.json()["key"]
         self.token_header = {"Authorization": f"Token {token}"}
+        self.token_from_cache = False
+        if self.token_cache is not None:
+            self.token_cache.put(self.url, username, token)
+
+    def _token_rejected(self, response):
+        if self.password_callback is None:
+            return False
+        if response.status_code == 401:
+            return True
+        # Depending on the authentication classes in use, an invalid token can
+        # also come back as a 403. Only trust that reading for a cached token
+        # the server has not accepted yet.
+        return response.status_code == 403 and self.token_from_cache and not self.token_verified
+
+    def _request(self, method, api, **kwargs):
+        """
+        _request sends a request to the Diderot API, logging in again and
+        retrying once if the server rejects the current token, and raises an
+        exception when the request does not succeed.
+        """
+
+        url = urllib.parse.urljoin(self.url, api)
+        uploads = []
+        if kwargs.get("files"):
+            data, files, uploads = self.chunked.prepare(kwargs.get("data"), kwargs["files"])
+            kwargs = dict(kwargs, data=data, files=files)
+        extra_headers = kwargs.pop("headers", None) or {}
+        response = self._send(method, url, headers=dict(self.token_header, **extra_headers), **kwargs)
+        if self._token_rejected(response):
+            debug(f"Token rejected with status {response.status_code}, logging in again.")
+            self.login(self.username, self.password_callback())
+            rewind_files(kwargs.get("files"))
+            response = self._send(method, url, headers=dict(self.token_header, **extra_headers), **kwargs)
+        if response.status_code < 200 or response.status_code >= 300:
+            raise err_for_code(response.status_code, response=response)
+        self.token_verified = True
+        self.chunked.forget(uploads)
+        return response
+
+    def _send(self, method, url, data=None, files=None, headers=None, **kwargs):
+        """
+        _send sends a single request with the client's timeouts, retrying it
+        with backoff after transient failures for as long as the retry policy
+        allows: requests that are safe to repeat are retried after connection
+        errors, timeouts and 429, 502, 503 and 504 responses, others only when
+        they cannot have reached the server.
+        """
+
+        idempotent = method.upper() in RETRY_METHODS
+        budget = "upload" if files is not None or isinstance(data, bytes) else "metadata"
+        delays = Backoff(constants.RETRY_INITIAL, constants.RETRY_CAP).delays()
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            request_headers = dict(headers or {})
+            body = data
+            if files is not None:
+                # Stream file uploads instead of letting requests build the
+                # whole body in memory.
+                body = MultipartEncoder(data, files)
+                request_headers["Content-Type"] = body.content_type
+            timings = start_timings()
+            with self.throttle.request(budget):
+                sent = time.perf_counter()
+                try:
+                    response = self.client.request(
+                        method, url, headers=request_headers, data=body, timeout=self.timeout, **kwargs
+                    )
+                    error = None
+                except requests.RequestException as e:
+                    response, error = None, e
+                timings["total"] = time.perf_counter() - sent
+            if self.tracer is not None:
+                self._trace(method, url, body, response, error, timings, attempt)
+
+            if response is not None:
+                retry_after = _retry_after(response)
+                retry = response.status_code in RETRY_STATUSES and (idempotent or response.status_code in (429, 503))
+                reason = str(response.status_code)
+            else:
+                retry_after = None
+                retry = isinstance(error, (requests.ConnectionError, requests.Timeout)) and (idempotent or _not_sent(error))
+                reason = type(error).__name__
+
+            delay = retry_after if retry_after is not None else next(delays)
+            if not retry or time.monotonic() - started + delay > self.retry_time:
+                if error is not None:
+                    raise APIError(f"Could not connect to Diderot: {error}")
+                return response
+
+            self.retries[reason] += 1
+            attempt += 1
+            debug(f"{method} {url} failed ({reason}), retrying in {delay:.1f} seconds.")
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            rewind_files(files)
+
+    def _trace(self, method, url, body, response, error, timings, attempt):
+        """_trace writes the trace record of one attempt at a request."""
+
+        request_bytes = len(body) if isinstance(body, (bytes, MultipartEncoder)) else None
+        if response is not None:
+            length = response.request.headers.get("Content-Length") if response.request is not None else None
+            if length is not None:
+                request_bytes = int(length)
+            response_bytes = len(response.content)
+            # Time to the response headers, without setting up the connection.
+            ttfb = max(0.0, response.elapsed.total_seconds() - timings["dns"] - timings["connect"])
+        else:
+            response_bytes = ttfb = None
+        path = urllib.parse.urlparse(url).path
+        self.tracer.record(
+            method=method.upper(),
+            route=route_of(path),
+            path=path,
+            status=response.status_code if response is not None else None,
+            error=type(error).__name__ if error is not None else None,
+            request_bytes=request_bytes,
+            response_bytes=response_bytes,
+            dns=round(timings["dns"], 6),
+            connect=round(timings["connect"], 6),
+            ttfb=None if ttfb is None else round(ttfb, 6),
+            total=round(timings.get("total", 0.0), 6),
+            retry=attempt,
+        )
 
     def get(self, api, params=None):
         """
@@ -60,36 +294,58 @@ class DiderotClient:
         when a request does not succeed.
         """
 
-        url = urllib.parse.urljoin(self.url, api)
-        debug(f"Request: {url}")
-        response = self.client.get(url, headers=self.token_header, params=params)
-        debug(f"Response [{response.status_code}]: {response.json()}")
-        if response.status_code < 200 or response.status_code >= 300:
-            raise err_for_code(response.status_code, response=response)
+        debug(f"Request: {urllib.parse.urljoin(self.url, api)}")
+        response = self._request("GET", api, params=params)
+        # Logging the body would decode it, so only do so when debugging.
+        if debugging():
+            debug(f"Response [{response.status_code}]: {response.text}")
         return response
 
+    def get_catalog(self, api, record, params=None):
+        """
+        get_catalog returns the rows of a GET for rarely changing metadata
+        (courses, labs, books, parts and chapters) as records of the given
+        type, answering from the catalog snapshot when it holds a fresh copy.
+        Empty results are not cached, so that newly created objects are found
+        right away.
+        """
+
+        if self.catalog is not None:
+            data = self.catalog.get(api, params)
+            if data is not None:
+                debug(f"Catalog hit: {api} {params}")
+                return decode(data, record)
+        rows = decode(self.get(api, params=params), record)
+        if self.catalog is not None and len(rows) > 0:
+            self.catalog.put(api, params, [row.asdict() for row in rows])
+        return rows
+
+    def invalidate_catalog(self, api):
+        """invalidate_catalog drops the cached responses for routes starting with api."""
+        if self.catalog is not None:
+            self.catalog.invalidate(api)
+
     def post(self, api, data=None, files=None, params=None):
         """
         post is a wrapper around requests.Session.post that raises an exception
         when a request does not succeed.
         """
-        url = urllib.parse.urljoin(self.url, api)
-        response = self.client.post(url, headers=self.token_header, data=data, files=files, params=params)
-        if response.status_code < 200 or response.status_code >= 300:
-            raise err_for_code(response.status_code, response=response)
+        return self._request("POST", api, data=data, files=files, params=params)
 
     def patch(self, api, data=None, files=None, params=None):
         """
         patch is a wrapper around requests.Session.patch that raises an exception
         when a request does not succeed.
         """
-        url = urllib.parse.urljoin(self.url, api)
-        response = self.client.patch(url, headers=self.token_header, data=data, files=files, params=params)
-        if response.status_code < 200 or response.status_code >= 300:
-            raise err_for_code(response.status_code, response=response)
+        return self._request("PATCH", api, data=data, files=files, params=params)
 
     def close(self):
         """Closes the connection to Diderot."""
+        if self.retries:
+            debug(f"Retried requests: {dict(self.retries)}")
+        waited = {k: round(v, 1) for k, v in self.throttle.waited.items() if v > 0}
+        if waited:
+            debug(f"Seconds requests waited for the rate limits: {waited}")
         self.client.close()
 
 
@@ -103,13 +359,17 @@ class DiderotAPIInterface:
         "Logs in to Diderot."
         self.client.login(username, password)
 
+    def authenticate(self, username, password_callback, token_cache=None):
+        "Authenticates with Diderot, reusing a cached token when possible."
+        self.client.authenticate(username, password_callback, token_cache)
+
     def close(self):
         """Closes the client connection."""
         self.client.close()
 
     def submit_assignment(self, course_label, homework_name, filepath):
-        course = Course(self.client, course_label)
-        lab = Lab(course, homework_name)
+        course = Course.resolve(self.client, course_label)
+        lab = Lab.resolve(course, homework_name)
         # TODO (rohany): Return more information in the response, such as:
         #  homework due date, whether its the latest homework or not, etc.
         #  All this extra stuff that the student would need to confirm
@@ -122,9 +382,9 @@ class DiderotAPIInterface:
         # TODO (rohany): Add back in the URL to view the submission at once
         #  I understand how the react server is deployed.
 
-    def download_assignment(self, course_label: str, homework_name: str):
-        course = Course(self.client, course_label)
-        lab = Lab(course, homework_name)
+    def download_assignment(self, course_label: str, homework_name: str, keep_old: bool = False):
+        course = Course.resolve(self.client, course_label)
+        lab = Lab.resolve(course, homework_name)
 
         attached_file_urls_endpoint = constants.FILE_URLS_API.format(course.pk, lab.pk)
 
@@ -132,22 +392,36 @@ class DiderotAPIInterface:
 
         downloaded = False
 
-        for key, url in r.json().items():
-            kind = re.sub(r"_url$", "", key)
-            try:
-                download_file_helper(url)
-                downloaded = True
-            except APIError as e:
-                debug(e)
-                click.echo(f"Could not find a {kind} for assignment {lab.name}")
-            except FileExistsError as e:
-                click.echo(e)
+        # Download the files concurrently, over the session's pooled connections.
+        urls = r.json()
+        progress = Progress("Downloading")
+        records = DownloadRecords()
+        with ThreadPoolExecutor(max_workers=constants.DOWNLOAD_JOBS) as pool:
+            downloads = {
+                key: pool.submit(
+                    in_current_context(download_file_helper), url,
+                    session=self.client.client, progress=progress, records=records, keep_old=keep_old,
+                    timeout=self.client.timeout,
+                )
+                for key, url in urls.items()
+            }
+            for key, download in downloads.items():
+                kind = re.sub(r"_url$", "", key)
+                try:
+                    download.result()
+                    downloaded = True
+                except APIError as e:
+                    debug(e)
+                    click.echo(f"Could not find a {kind} for assignment {lab.name}")
+                except FileExistsError as e:
+                    click.echo(e)
+        progress.finish()
 
         return downloaded
 
     def update_assignment(self, course_label: str, homework_name: str, **options):
-        course = Course(self.client, course_label)
-        lab = Lab(course, homework_name)
+        course = Course.resolve(self.client, course_label)
+        lab = Lab.resolve(course, homework_name)
         # Send a request to the UploadCodeLabFiles view with the target
         # files in the request.
         files = {}
@@ -171,7 +445,7 @@ class DiderotAPIInterface:
         if not all:
             if course_label == "":
                 raise APIError("A course label is required if not listing all books.")
-            course = Course(self.client, course_label)
+            course = Course.resolve(self.client, course_label)
         books = Book.list(self.client, course=course)
         if not all:
             return books
@@ -182,8 +456,10 @@ class DiderotAPIInterface:
             return [book for book in books if book["course"] in course_dict]
 
     def create_part(self, course_label, book_label, title, **options):
-        course = Course(self.client, course_label)
-        book = Book(course, book_label)
+        course = Course.resolve(self.client, course_label)
+        book = Book.resolve(course, book_label)
+        if options.get(constants.PART_NUMBER_GET) is None:
+            raise APIError(f"--{constants.PART_NUMBER} must be set.")
         if Part.exists(course, book, options.get(constants.PART_NUMBER_GET)):
             raise APIError(
                 "Existing part for Course: {}, Book: {}, and Number: {} found.".format(course.label, book.label, options.get(constants.PART_NUMBER_GET))
@@ -191,7 +467,7 @@ class DiderotAPIInterface:
         Part.create(course, book, title, options.get(constants.PART_NUMBER_GET), options.get(constants.PART_LABEL_GET))
 
     def create_book(self, course_label, title, label):
-        course = Course(self.client, course_label)
+        course = Course.resolve(self.client, course_label)
 
         if Book.exists(course, label):
             raise APIError(
@@ -200,11 +476,13 @@ class DiderotAPIInterface:
         Book.create(course, title, label)
 
     def create_chapter(self, course_label, book_label, **options):
-        course = Course(self.client, course_label)
-        book = Book(course, book_label)
+        course = Course.resolve(self.client, course_label)
+        book = Book.resolve(course, book_label)
         if options.get(constants.PART_NUMBER_GET) is None:
             raise APIError(f"--{constants.PART_NUMBER} must be set.")
-        part = Part(course, book, options.get(constants.PART_NUMBER_GET))
+        if options.get(constants.CHAPTER_NUMBER_GET) is None:
+            raise APIError(f"--{constants.CHAPTER_NUMBER} must be set.")
+        part = Part.resolve(course, book, options.get(constants.PART_NUMBER_GET))
         # See if a chapter like this exists already.
         if Chapter.exists(course, book, options.get(constants.CHAPTER_NUMBER_GET)):
             raise APIError(
@@ -216,9 +494,9 @@ class DiderotAPIInterface:
         Chapter.create(course, book, part, options.get(constants.CHAPTER_NUMBER_GET), **options)
 
     def release_unrelease_chapter(self, course_label, book_label, release, **options):
-        course = Course(self.client, course_label)
-        book = Book(course, book_label)
-        chapter = Chapter(course, book, options.get(constants.CHAPTER_NUMBER_GET), options.get(constants.CHAPTER_LABEL_GET))
+        course = Course.resolve(self.client, course_label)
+        book = Book.resolve(course, book_label)
+        chapter = Chapter.resolve(course, book, options.get(constants.CHAPTER_NUMBER_GET), options.get(constants.CHAPTER_LABEL_GET))
         route_params = {
             "course_id": course.pk,
             "book_id": book.pk,
@@ -228,11 +506,12 @@ class DiderotAPIInterface:
         self.client.post(
             constants.MANAGE_CHAPTER_WITH_ACTION_API.format(**route_params)
         )
+        Chapter.invalidate(course, book, chapter)
 
     def set_publish_date(self, course_label, book_label, **options):
-        course = Course(self.client, course_label)
-        book = Book(course, book_label)
-        chapter = Chapter(course, book, options.get(constants.CHAPTER_NUMBER_GET), options.get(constants.CHAPTER_LABEL_GET))
+        course = Course.resolve(self.client, course_label)
+        book = Book.resolve(course, book_label)
+        chapter = Chapter.resolve(course, book, options.get(constants.CHAPTER_NUMBER_GET), options.get(constants.CHAPTER_LABEL_GET))
         route_params = {
             "course_id": course.pk,
             "book_id": book.pk,
@@ -246,59 +525,33 @@ class DiderotAPIInterface:
         self.client.patch(
             constants.MANAGE_CHAPTER_API.format(**route_params), data=data
         )
+        self.client.invalidate_catalog(constants.CHAPTERS_API)
 
     def upload_chapter(self, course_label: str, book_label: str, number: str, label: str, **options):
-        course = Course(self.client, course_label)
-        book = Book(course, book_label)
-        chapter = Chapter(course, book, number, label)
-
-        pdf_filename = options.get(constants.PDF_GET)
-        xml_filename = options.get(constants.XML_GET)
-        xml_pdf_filename = options.get(constants.XML_PDF_GET)
-        video_url = options.get(constants.VIDEO_URL_GET)
+        course = Course.resolve(self.client, course_label)
+        book = Book.resolve(course, book_label)
+        chapter = Chapter.resolve(course, book, number, label)
+
         sleep_time = options.get(constants.SLEEP_TIME_GET, 5)
-        attach = options.get(constants.ATTACH_GET, [])
+        staged = options.get("staged")
+        if staged is None:
+            staged = stage_upload(
+                pdf=options.get(constants.PDF_GET),
+                xml=options.get(constants.XML_GET),
+                xml_pdf=options.get(constants.XML_PDF_GET),
+                attach=options.get(constants.ATTACH_GET),
+                video_url=options.get(constants.VIDEO_URL_GET),
+            )
 
-        data = {}
-        # Populate the input set of files.
-        files = []
-        if pdf_filename is not None:
-            if not pdf_filename.lower().endswith(".pdf"):
-                raise APIError("PDF argument must be a PDF file.")
-            files.append(("input_file_pdf", Path(pdf_filename)))
-        elif xml_filename is not None:
-            if not (xml_filename.lower().endswith(".xml") or xml_filename.lower().endswith(".mlx")):
-                raise APIError("XML argument must be an XML or MLX file.")
-            files.append(("input_file_xml", Path(xml_filename)))
-
-            if attach:
-                for fg in attach:
-                    base_path = Path(fg)
-                    file_glob = glob.glob(expand_file_path(fg))
-                    if not base_path.exists() and len(file_glob) == 0:
-                        click.echo(f"Warning: cannot find file {fg}. Skipping.")
-                        continue
-                    for g in file_glob:
-                        f = Path(g).expanduser()
-                        if f.is_dir():
-                            # If it is a directory, include all children.
-                            files.extend([("attachments", m) for m in f.glob("**/*")])
-                        else:
-                            # If it is a file, add it directly.
-                            files.append(("attachments", f))
-            if xml_pdf_filename is not None:
-                files.append(("input_file_pdf", Path(xml_pdf_filename)))
-
-        if video_url is not None:
-            data["video_url"] = video_url
-
-        for _, p in files:
-            click.echo(f"Uploading file: {p.name}")
-
-        if pdf_filename is not None or xml_filename is not None:
+        for message in staged.warnings:
+            info(message)
+        for _, p, _ in staged.files:
+            info(f"Uploading file: {p.name}")
+
+        if staged:
             with ExitStack() as stack:
                 opened_files = [
-                    (typ, (path.name, stack.enter_context(path.expanduser().open("rb")))) for typ, path in files
+                    (typ, (path.name, stack.enter_context(path.open("rb")))) for typ, path, _ in staged.files
                 ]
 
                 route_params = {
@@ -309,78 +562,339 @@ class DiderotAPIInterface:
                 }
                 self.client.post(
                     constants.MANAGE_CHAPTER_WITH_ACTION_API.format(**route_params),
-                    data=data,
+                    data=staged.data,
                     files=opened_files
                 )
-
-            # Wait until the book becomes unlocked.
-            while True:
-                click.echo("Waiting for book upload to complete...")
-                time.sleep(sleep_time)
-                if not Book.check_is_locked(self.client, book.pk):
-                    break
+                self.client.invalidate_catalog(constants.CHAPTERS_API)
+
+            if options.get(constants.NO_WAIT_GET, False):
+                job_id = f"{course.label}/{book.label}/{chapter.number}"
+                recorded = UploadJobs(self.client.url).add(job_id, {
+                    "course": course.label,
+                    "book": book.pk,
+                    "chapter": chapter.pk,
+                    "submitted": time.time(),
+                })
+                if not recorded:
+                    warn(f"Could not save upload job {job_id}, wait-uploads will not find it.")
+                return job_id
+
+            # Wait until the book becomes unlocked, first checking a little
+            # before earlier uploads to this book took, then backing off.
+            info("Waiting for book upload to complete...")
+            lock_times = LockTimes(self.client.url)
+            backoff = lock_backoff(sleep_time, lock_times.get(book.pk))
+            timeout = options.get(constants.LOCK_TIMEOUT_GET, constants.DEFAULT_LOCK_TIMEOUT)
+            try:
+                elapsed = poll(lambda: not Book.check_is_locked(self.client, book.pk), backoff, timeout)
+            except TimeoutError:
+                raise APIError(f"Book {book.label} is still locked {timeout} seconds after the upload, giving up.")
+            lock_times.record(book.pk, elapsed)
+            debug(f"Book {book.label} was locked for {elapsed:.1f} seconds.")
 
             # Get back error and warning information from uploading.
             warnings, errors = Chapter.get_warnings_and_errors(self.client, chapter.pk)
-
-#            if len(warnings) != 0:
-#                [warn(w) for w in warnings]
             if warnings:
                 warn(warnings)
             if len(errors) != 0:
                 raise APIError(str(errors))
 
 
-@contextmanager
-def setup_client(dc: DiderotContext):
-    dc.client = DiderotAPIInterface(dc.url)
+    def wait_uploads(self, job_ids=None, **options):
+        """
+        wait_uploads waits for Diderot to finish processing chapter uploads
+        submitted without waiting, all of them unless job_ids are given, and
+        reports their warnings and errors as they finish. Each check takes one
+        request per course with pending uploads. It returns the ids of the jobs
+        whose uploads failed.
+        """
 
-    try:
-        if dc.username is None:
-            creds = constants.DEFAULT_CRED_LOCATIONS
-            if dc.credentials is not None:
-                creds = [dc.credentials] + creds
-            for c in creds:
-                p = Path(c).expanduser()
+        jobs = UploadJobs(self.client.url)
+        pending = jobs.list()
+        if job_ids:
+            unknown = set(job_ids) - set(pending)
+            if unknown:
+                raise APIError(f"Unknown upload jobs: {', '.join(sorted(unknown))}")
+            pending = {k: v for k, v in pending.items() if k in job_ids}
+        failed = []
+
+        def check():
+            for course_label in set(job["course"] for job in pending.values()):
+                locked = Book.locked_in(self.client, course_label)
+                done = [
+                    k for k, job in pending.items()
+                    if job["course"] == course_label and str(job["book"]) not in locked
+                ]
+                if not done:
+                    continue
+                results = Chapter.upload_results(self.client, course_label)
+                for k in sorted(done):
+                    warnings, errors = results.get(str(pending[k]["chapter"]), ("", ""))
+                    if warnings:
+                        warn(f"{k}: {warnings}")
+                    if errors:
+                        click.secho(f"[ERROR]: {k}: {errors}", fg="red", err=True)
+                        failed.append(k)
+                    else:
+                        info(f"{k}: upload complete.")
+                    jobs.remove(k)
+                    del pending[k]
+            return not pending
+
+        if pending:
+            info(f"Waiting for {len(pending)} uploads to complete...")
+            sleep_time = options.get(constants.SLEEP_TIME_GET, 5)
+            timeout = options.get(constants.LOCK_TIMEOUT_GET, constants.DEFAULT_LOCK_TIMEOUT)
+            try:
+                poll(check, lock_backoff(sleep_time), timeout)
+            except TimeoutError:
+                raise APIError(f"Uploads still processing after {timeout} seconds: {', '.join(sorted(pending))}")
+        else:
+            info("No uploads to wait for.")
+        return failed
 
-                if not p.is_file() and c == dc.credentials:
-                    exit_with_error(f"Credentials path `{c}` is invalid.")
+    def upload_book(self, course_label: str, book_data: dict, file_prefix: str, **options):
+        """
+        upload_book creates and uploads the parts and chapters described by
+        book_data, the contents of an upload-book JSON file. Relative paths
+        in it are relative to file_prefix.
+        """
 
-                if not p.exists():
+        def get_or_none(obj, field):
+            if field in obj:
+                return obj[field]
+            return None
+
+        def adjust_search_path(path):
+            if path is None:
+                return None
+            return os.path.join(file_prefix, path)
+
+        # Collect the necessary Diderot objects.
+        info(f"Fetching course {course_label}")
+        course = Course.resolve(self.client, course_label)
+        book_label = get_or_none(book_data, "book")
+        info(f"Uploading  book {book_label}")
+
+        # Try out "label", more consistent with Diderot terminology
+        if book_label is None:
+            book_label = get_or_none(book_data, "label")
+        # If book label is still None, then error out.
+        if book_label is None:
+            raise APIError("Please specify a valid book to upload into")
+
+        book_title = book_data.get("title", book_label)
+        info(f"Book title {book_title}")
+        try:
+            book = Book.resolve(course, book_label)
+        except BookNotFoundAPIError:
+            Book.create(course, book_title, book_label)
+            book = Book.resolve(course, book_label)
+        info("Created  book")
+
+        book_data_chapters = book_data.get("chapters", [])
+
+        # Resolve the existing parts and chapters of the book with one listing
+        # each; every later lookup for this book is answered from them.
+        book_data_parts = book_data.get("parts", [])
+        book_data_part_numbers = set([c.get("number") for c in book_data_parts])
+        chapters_data_part_numbers = set([c.get("part") for c in book_data_chapters])
+        actual_part_numbers = set([int(rank_key(p.number)) for p in Part.resolve_many(course, book)])
+        union_part_numbers = actual_part_numbers.union(book_data_part_numbers)
+        info("Setup complete.")
+
+        if union_part_numbers != set(range(1, len(union_part_numbers) + 1)):
+            raise APIError(f"invalid JSON: resulting parts numbers are inconsistent, "
+                           f"should be a sequence of integers starting with 1 including existing parts. "
+                           f"Current numbers set is: {actual_part_numbers} and resulting using json "
+                           f"is {union_part_numbers}")
+        elif not chapters_data_part_numbers.issubset(union_part_numbers):
+            raise APIError(f"invalid JSON: some parts numbers for chapters are invalid. "
+                           f"Resulting part number set (existing and new) is {union_part_numbers} and specified in"
+                           f" chapter number set is {chapters_data_part_numbers}")
+
+        book_data_chapter_numbers = set([c.get("number") for c in book_data_chapters])
+        actual_chapter_numbers = set([int(rank_key(c.number)) for c in Chapter.resolve_many(course, book)])
+        union_chapter_numbers = actual_chapter_numbers.union(book_data_chapter_numbers)
+        if union_chapter_numbers != set(range(1, len(union_chapter_numbers) + 1)):
+            raise APIError(f"invalid JSON: resulting chapters numbers are inconsistent, "
+                           f"should be a sequence of integers starting with 1 including existing chapters. "
+                           f"Current numbers set is: {actual_chapter_numbers} and resulting using json "
+                           f"is {union_chapter_numbers}")
+
+        # Upload and maybe create the chapters in the input.
+        chapters = get_or_none(book_data, "chapters")
+        if chapters is None:
+            raise APIError("invalid JSON: could not find field 'chapters'")
+        for chapter in chapters:
+            if get_or_none(chapter, "number") is None:
+                raise APIError(f"invalid JSON: must provide field 'number' for chapter {chapter}")
+            if get_or_none(chapter, "number") not in actual_chapter_numbers and get_or_none(chapter, "part") is None:
+                raise APIError("Chapter creation in a book requires 'part' field for chapters")
+
+        info("Creating parts")
+        # If the upload contains parts, create them.
+        parts = get_or_none(book_data, "parts")
+        if parts is not None:
+            new_parts = [part for part in parts if get_or_none(part, "number") not in actual_part_numbers]
+            for part in new_parts:
+                Part.create(course, book, get_or_none(part, "title"), get_or_none(part, "number"), get_or_none(part, "label"))
+            if len(new_parts) > 0:
+                Part.resolve_many(course, book)
+
+        info("Creating chapters")
+        created = set()
+        for chapter in chapters:
+            number = get_or_none(chapter, "number")
+            label = get_or_none(chapter, "label")
+            title = get_or_none(chapter, "title")
+
+            if number not in actual_chapter_numbers:
+                Chapter.create(
+                    course,
+                    book,
+                    Part.resolve(course, book, get_or_none(chapter, "part")),
+                    number,
+                    title=title,
+                    label=label,
+                    publish_date=get_or_none(chapter, "publish-on-date"),
+                    publish_on_week=get_or_none(chapter, "publish-on-week"),
+                )
+                created.add(number)
+                info(f"Successfully created chapter number ({number}), label ({label}, title ({title}).")
+        if created:
+            Chapter.resolve_many(course, book)
+
+        def stage_chapter(chapter):
+            attachments = get_or_none(chapter, "attachments")
+            staged = stage_upload(
+                pdf=adjust_search_path(get_or_none(chapter, "pdf")),
+                xml=adjust_search_path(get_or_none(chapter, "xml")),
+                xml_pdf=adjust_search_path(get_or_none(chapter, "xml-pdf")),
+                attach=None if attachments is None else [adjust_search_path(path) for path in attachments],
+            )
+            return staged, staged.fingerprint(metadata={k: v for k, v in chapter.items() if k not in file_fields})
+
+        file_fields = ("pdf", "xml", "xml-pdf", "attachments")
+        force = options.get(constants.FORCE_GET, False)
+        manifest = UploadManifest(self.client.url)
+
+        # Stage the chapters' files in the background, so that globbing,
+        # stat'ing and hashing them overlaps with the server processing
+        # earlier chapters.
+        with ThreadPoolExecutor(max_workers=1) as stager:
+            staged = [stager.submit(in_current_context(stage_chapter), chapter) for chapter in chapters]
+            for chapter, upload in zip(chapters, staged):
+                number = get_or_none(chapter, "number")
+                upload, fingerprint = upload.result()
+                # The manifest knows chapters by id, so that a chapter deleted and
+                # created again is uploaded, and chapters created above always are.
+                pk = Chapter.resolve(course, book, number, None).pk
+                if not force and number not in created and manifest.get(course.label, book.pk, pk) == fingerprint:
+                    info(f"Chapter number {number} is unchanged, skipping upload.")
                     continue
-
-                if (p.stat().st_mode & 0o177 != 0):
-                    exit_with_error(
-                        f"Credentials file `{c}` must have 0600 permissions."
-                        " Run `chmod 600 <credentials>` first."
+                # The fingerprint covers the publish options, so they are only
+                # set again along with changes.
+                if number not in created:
+                    self.set_publish_date(
+                        course.label, book.label, chapter_number=number,
+                        publish_date=get_or_none(chapter, "publish-on-date"),
+                        publish_on_week=get_or_none(chapter, "publish-on-week"),
                     )
-                with p.open("r") as f:
-                    data = f.read().strip().split("\n")
-                    if len(data) < 2:
-                        exit_with_error(f"Credentials file `{c}` does not contain proper credentials.")
-                    dc.username = data[0]
-                    dc.password = data[1]
-                break
-
-        if dc.username is None:
-            dc.username = click.prompt("Username")
-        if dc.password is None:
-            dc.password = click.prompt(text="Password", hide_input=True)
-
-        dc.client.login(dc.username, dc.password)
-        yield dc.client
-    finally:
-        dc.client.close()
+                info(f"Uploading chapter number: {number}...")
+                with tagged(book=book.label, chapter=number):
+                    self.upload_chapter(
+                        course.label, book.label, number, None,
+                        staged=upload,
+                        sleep_time=options.get(constants.SLEEP_TIME_GET, 5),
+                        lock_timeout=options.get(constants.LOCK_TIMEOUT_GET, constants.DEFAULT_LOCK_TIMEOUT),
+                    )
+                manifest.put(course.label, book.pk, pk, fingerprint)
+                info("Successfully uploaded chapter.")
 
-def uses_api(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        ctx = click.get_current_context()
 
-        with setup_client(ctx.obj):
-            try:
-                f(*args, **kwargs)
-            except APIError as e:
-                exit_with_error(str(e))
+def read_credentials(dc: DiderotContext):
+    """read_credentials fills in dc's username and password from a credentials file, if any."""
+
+    creds = constants.DEFAULT_CRED_LOCATIONS
+    if dc.credentials is not None:
+        creds = [dc.credentials] + creds
+    for c in creds:
+        p = Path(c).expanduser()
+
+        if not p.is_file() and c == dc.credentials:
+            exit_with_error(f"Credentials path `{c}` is invalid.")
 
-    return wrapper
+        if not p.exists():
+            continue
+
+        if (p.stat().st_mode & 0o177 != 0):
+            exit_with_error(
+                f"Credentials file `{c}` must have 0600 permissions."
+                " Run `chmod 600 <credentials>` first."
+            )
+        with p.open("r") as f:
+            data = f.read().strip().split("\n")
+            if len(data) < 2:
+                exit_with_error(f"Credentials file `{c}` does not contain proper credentials.")
+            dc.username = data[0]
+            dc.password = data[1]
+        break
+
+def configure_client(dc: DiderotContext):
+    """configure_client applies the timeout, retry, trace and cache options of a command to its client."""
+    client = dc.client.client
+    if dc.cache_ttl is not None and dc.cache_ttl > 0:
+        client.catalog = Catalog(dc.url, dc.username, dc.cache_ttl)
+    else:
+        client.catalog = None
+    if dc.timeout is not None:
+        client.timeout = (constants.DEFAULT_CONNECT_TIMEOUT, dc.timeout)
+    if dc.retry_time is not None:
+        client.retry_time = dc.retry_time
+    if dc.trace is not None:
+        client.tracer = Tracer(dc.trace)
+        if not isinstance(client.client.get_adapter(client.url), TracingAdapter):
+            for prefix in ("https://", "http://"):
+                client.client.mount(prefix, TracingAdapter())
+    else:
+        # A pooled session may have been traced by an earlier command.
+        client.tracer = None
+
+@contextmanager
+def setup_client(dc: DiderotContext):
+    if dc.username is None:
+        read_credentials(dc)
+    if dc.username is None:
+        dc.username = click.prompt("Username")
+
+    # When running inside the agent, reuse the session of an earlier command
+    # with the same credentials; it stays open for the next one.
+    session_key = (dc.url, dc.username, dc.password)
+    if dc.sessions is not None and session_key in dc.sessions:
+        dc.client = dc.sessions[session_key]
+        # Only the login and connections are reused: objects resolved by
+        # earlier commands may have been changed or deleted since.
+        dc.client.client.identities = IdentityMap()
+        configure_client(dc)
+        yield dc.client
+        return
+
+    dc.client = DiderotAPIInterface(dc.url)
+    configure_client(dc)
+    pooled = False
+    try:
+        def password():
+            if dc.password is None:
+                dc.password = click.prompt(text="Password", hide_input=True)
+            return dc.password
+
+        token_cache = TokenCache() if dc.token_cache else None
+        dc.client.authenticate(dc.username, password, token_cache)
+        if dc.sessions is not None:
+            dc.sessions[session_key] = dc.client
+            pooled = True
+        yield dc.client
+    finally:
+        if not pooled:
+            dc.client.close()
@@ -0,0 +1,35 @@
+"""
+Entry points for the `diderot`, `diderot_admin` and `diderot_student` scripts.
+
+When the background agent is running, command lines are forwarded to it.
+Otherwise the CLI is loaded and the command runs in this process.
+"""
+
+import sys
+
+from diderot_cli import agent
+
+
+def _main(prefix):
+    argv = prefix + sys.argv[1:]
+    if agent.should_forward(argv):
+        code = agent.forward(argv)
+        if code is not None:
+            sys.exit(code)
+
+    from diderot_cli.commands import diderot as diderot_group
+    from diderot_cli.context import DiderotContext
+
+    diderot_group(args=argv, prog_name="diderot", obj=DiderotContext())
+
+
+def diderot():
+    _main([])
+
+
+def admin():
+    _main(["admin"])
+
+
+def student():
+    _main(["student"])
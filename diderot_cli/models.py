@@ -1,3 +1,5 @@
+import threading
+
 from diderot_cli.constants import (
     COURSE_API,
     LAB_API,
@@ -7,9 +9,55 @@ from diderot_cli.constants import (
     MANAGE_BOOK_API,
     MANAGE_BOOK_LIST_API,
 )
+from diderot_cli.records import BookRecord, ChapterRecord, CourseRecord, LabRecord, PartRecord, decode
 from diderot_cli.utils import APIError, BookNotFoundAPIError, singleton_or_none
 
 
+class IdentityMap:
+    """
+    IdentityMap holds the objects resolved during a session, keyed by type
+    and natural key, so that each of them is only fetched from Diderot once.
+    Mutations invalidate the entries they might affect. The map is shared by
+    the threads of a client, such as the lanes of upload-books.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.objects.get(key)
+
+    def put(self, key, obj):
+        with self.lock:
+            self.objects[key] = obj
+
+    def resolve(self, key, make):
+        """resolve returns the object for key, calling make to resolve it if it is not known yet."""
+        with self.lock:
+            obj = self.objects.get(key)
+        if obj is None:
+            # Resolve without holding the lock, so that other threads are not
+            # held up by the request; the first object put for key wins.
+            obj = make()
+            with self.lock:
+                obj = self.objects.setdefault(key, obj)
+        return obj
+
+    def invalidate(self, kind, *prefix):
+        """invalidate drops the objects of the given kind whose key starts with prefix."""
+        n = len(prefix)
+        with self.lock:
+            for key in [k for k in self.objects if k[0] == kind and k[1 : n + 1] == prefix]:
+                del self.objects[key]
+
+
+def rank_key(number):
+    """rank_key normalizes part and chapter ranks, which the API returns as strings."""
+    return float(number)
+
+
 class Course:
     def __init__(self, client, label):
         self.client = client
@@ -20,7 +68,7 @@ class Course:
         self._verify()
 
     def _verify(self):
-        response = self.client.get(COURSE_API, params={"label": self.label})
+        response = self.client.get_catalog(COURSE_API, CourseRecord, params={"label": self.label})
         result = singleton_or_none(response)
         if result is None:
             raise APIError(
@@ -28,13 +76,17 @@ class Course:
                 "You might not be a member of the requested "
                 "course if it exists."
             )
-        self.pk = result["id"]
-        self.autograder_bucket = result["s3_autograder_bucket"]
-        self.number = result["number"]
+        self.pk = result.id
+        self.autograder_bucket = result.s3_autograder_bucket
+        self.number = result.number
+
+    @classmethod
+    def resolve(cls, client, label):
+        return client.identities.resolve(("Course", label), lambda: cls(client, label))
 
     @staticmethod
     def list(client):
-        return client.get(COURSE_API).json()
+        return client.get_catalog(COURSE_API, CourseRecord)
 
 
 class Lab:
@@ -50,16 +102,20 @@ class Lab:
         params = {
             "name": self.name,
         }
-        response = self.client.get(LAB_API.format(self.course.pk), params=params)
+        response = self.client.get_catalog(LAB_API.format(self.course.pk), LabRecord, params=params)
         result = singleton_or_none(response)
         if result is None:
             raise APIError("Invalid homework name.")
-        self.pk = result["id"]
-        self.uuid = result["uuid"]
+        self.pk = result.id
+        self.uuid = result.uuid
+
+    @classmethod
+    def resolve(cls, course, name):
+        return course.client.identities.resolve(("Lab", course.pk, name), lambda: cls(course, name))
 
     @staticmethod
     def list(course):
-        return course.client.get(LAB_API.format(course.pk)).json()
+        return course.client.get_catalog(LAB_API.format(course.pk), LabRecord)
 
 
 class Book:
@@ -75,20 +131,24 @@ class Book:
             "course__label": self.course.label,
             "label": self.label,
         }
-        response = self.client.get(BOOK_API, params=params)
+        response = self.client.get_catalog(BOOK_API, BookRecord, params=params)
         result = singleton_or_none(response)
         if result is None:
-            if len(response.json()) == 0:
+            if len(response) == 0:
                 raise BookNotFoundAPIError("Input book not found.")
             raise APIError("Input book not found.")
-        self.pk = result["id"]
+        self.pk = result.id
+
+    @classmethod
+    def resolve(cls, course, label):
+        return course.client.identities.resolve(("Book", course.pk, label), lambda: cls(course, label))
 
     @staticmethod
     def list(client, course=None):
         params = {}
         if course is not None:
             params["course__label"] = course.label
-        return client.get(BOOK_API, params=params).json()
+        return client.get_catalog(BOOK_API, BookRecord, params=params)
 
     @staticmethod
     def check_is_locked(client, id):
@@ -97,8 +157,14 @@ class Book:
         except:
             raise APIError("Something went wrong when connecting to server: could not connect.  Please try again!")
 
-        result = singleton_or_none(response)
-        return bool(result["is_locked"])
+        result = singleton_or_none(decode(response, BookRecord))
+        return bool(result.is_locked)
+
+    @staticmethod
+    def locked_in(client, course_label):
+        """locked_in returns the ids of the books of a course that are locked, with a single request."""
+        response = client.get(BOOK_API, params={"course__label": course_label})
+        return set(str(b.id) for b in decode(response, BookRecord) if b.is_locked)
 
     @staticmethod
     def create(course, title, label):
@@ -106,33 +172,74 @@ class Book:
 
         route_params = {"course_id": course.pk}
         course.client.post(MANAGE_BOOK_LIST_API.format(**route_params), data=data)
+        course.client.identities.invalidate("Book", course.pk)
+        course.client.invalidate_catalog(BOOK_API)
 
     @staticmethod
     def exists(course, label):
+        if course.client.identities.get(("Book", course.pk, label)) is not None:
+            return True
         params = {
             "course__label": course.label,
             "label": label,
         }
-        response = course.client.get(BOOK_API, params=params)
-        return len(response.json()) != 0
+        return len(course.client.get_catalog(BOOK_API, BookRecord, params=params)) != 0
 
 
 class Part:
-    def __init__(self, course, book, number):
+    def __init__(self, course, book, number, result=None):
         self.course = course
         self.book = book
         self.client = course.client
         self.pk = None
-        self._verify(number)
+        self.number = None
+        if result is None:
+            self._verify(number)
+        else:
+            self._load(result)
 
     def _verify(self, number):
         # If we have a booklet, then don't look at number.
         params = {"book__id": self.book.pk, "rank": number}
-        response = self.client.get(PARTS_API, params=params)
+        response = self.client.get_catalog(PARTS_API, PartRecord, params=params)
         result = singleton_or_none(response)
         if result is None:
             raise APIError("Input part not found.")
-        self.pk = result["id"]
+        self._load(result)
+
+    def _load(self, result):
+        self.pk = result.id
+        self.number = result.rank
+
+    @classmethod
+    def resolve(cls, course, book, number):
+        # Without a number there is nothing to key the part on; let Diderot answer.
+        if number is None:
+            return cls(course, book, number)
+        identities = course.client.identities
+        key = ("Part", book.pk, rank_key(number))
+        part = identities.get(key)
+        if part is None:
+            if identities.get(("Part", book.pk, "*")) is not None:
+                raise APIError("Input part not found.")
+            part = cls(course, book, number)
+            identities.put(key, part)
+        return part
+
+    @classmethod
+    def resolve_many(cls, course, book):
+        """
+        resolve_many resolves all the parts of book with a single listing. Until
+        the book's parts are invalidated, resolve() and exists() then answer
+        for any of its parts without further requests.
+        """
+
+        identities = course.client.identities
+        parts = [cls(course, book, None, result=row) for row in cls.list(course, book)]
+        for part in parts:
+            identities.put(("Part", book.pk, rank_key(part.number)), part)
+        identities.put(("Part", book.pk, "*"), parts)
+        return parts
 
     @staticmethod
     def create(course, book, title, number, label):
@@ -142,23 +249,30 @@ class Part:
 
         route_params = {"course_id": course.pk, "book_id": book.pk}
         course.client.post((MANAGE_BOOK_API + "parts/").format(**route_params), data=data)
+        course.client.identities.invalidate("Part", book.pk)
+        course.client.invalidate_catalog(PARTS_API)
 
     @staticmethod
     def exists(course, book, number):
+        identities = course.client.identities
+        if number is not None:
+            if identities.get(("Part", book.pk, rank_key(number))) is not None:
+                return True
+            if identities.get(("Part", book.pk, "*")) is not None:
+                return False
         params = {
             "book__id": book.pk,
             "rank": number,
         }
-        response = course.client.get(PARTS_API, params=params)
-        return len(response.json()) != 0
+        return len(course.client.get_catalog(PARTS_API, PartRecord, params=params)) != 0
 
     @staticmethod
     def list(course, book):
-        return course.client.get(PARTS_API, params={"book__id": book.pk}).json()
+        return course.client.get_catalog(PARTS_API, PartRecord, params={"book__id": book.pk})
 
 
 class Chapter:
-    def __init__(self, course, book, number, label, publish_date=None, due_date=None):
+    def __init__(self, course, book, number, label, publish_date=None, due_date=None, result=None):
         self.course = course
         self.book = book
         self.client = course.client
@@ -168,7 +282,10 @@ class Chapter:
         self.part_id = None
         self.publish_date = publish_date
         self.due_date = due_date
-        self._verify(number, label)
+        if result is None:
+            self._verify(number, label)
+        else:
+            self._load(result)
 
     def _verify(self, number, label):
         params = {
@@ -181,24 +298,88 @@ class Chapter:
             params["label"] = label
         else:
             raise APIError("Chapter label or Chapter number must be provided.")
-        response = self.client.get(CHAPTERS_API, params=params)
+        response = self.client.get_catalog(CHAPTERS_API, ChapterRecord, params=params)
         result = singleton_or_none(response)
         if result is None:
             raise APIError("Input chapter not found.")
-        self.pk = result["id"]
-        self.number = result["rank"]
-        self.label = result["label"]
-        self.part_id = result["part"]
+        self._load(result)
+
+    def _load(self, result):
+        self.pk = result.id
+        self.number = result.rank
+        self.label = result.label
+        self.part_id = result.part
+
+    def _register(self, identities):
+        identities.put(("Chapter", self.book.pk, "rank", rank_key(self.number)), self)
+        identities.put(("Chapter", self.book.pk, "label", self.label), self)
+
+    @classmethod
+    def resolve(cls, course, book, number, label):
+        """
+        resolve returns the chapter with the given number or, if number is
+        None, label. Resolved chapters are known under both keys.
+        """
+
+        if number is None and label is None:
+            raise APIError("Chapter label or Chapter number must be provided.")
+        identities = course.client.identities
+        key = ("Chapter", book.pk, "rank", rank_key(number)) if number is not None else ("Chapter", book.pk, "label", label)
+        chapter = identities.get(key)
+        if chapter is None:
+            if identities.get(("Chapter", book.pk, "*")) is not None:
+                raise APIError("Input chapter not found.")
+            chapter = cls(course, book, number, label)
+            chapter._register(identities)
+        return chapter
+
+    @classmethod
+    def resolve_many(cls, course, book):
+        """
+        resolve_many resolves all the chapters of book with a single listing.
+        Until the book's chapters are invalidated, resolve() and exists() then
+        answer for any of its chapters, by rank or label, without further
+        requests.
+        """
+
+        identities = course.client.identities
+        chapters = [cls(course, book, None, None, result=row) for row in cls.list(course, book)]
+        for chapter in chapters:
+            chapter._register(identities)
+        identities.put(("Chapter", book.pk, "*"), chapters)
+        return chapters
+
+    @staticmethod
+    def invalidate(course, book, chapter=None):
+        """
+        invalidate forgets a resolved chapter after it was modified, or all the
+        resolved chapters of book if chapter is None, along with the cached
+        chapter listings.
+        """
+
+        course.client.invalidate_catalog(CHAPTERS_API)
+        identities = course.client.identities
+        if chapter is None:
+            identities.invalidate("Chapter", book.pk)
+        else:
+            identities.invalidate("Chapter", book.pk, "rank", rank_key(chapter.number))
+            identities.invalidate("Chapter", book.pk, "label", chapter.label)
+            identities.invalidate("Chapter", book.pk, "*")
 
     @staticmethod
     def exists(course, book, number):
+        identities = course.client.identities
+        if number is not None:
+            if identities.get(("Chapter", book.pk, "rank", rank_key(number))) is not None:
+                return True
+            if identities.get(("Chapter", book.pk, "*")) is not None:
+                return False
         params = {
             "course__id": course.pk,
             "book__id": book.pk,
             "rank": number,
         }
-        response = course.client.get(CHAPTERS_API, params=params)
-        return len(response.json()) != 0
+        return len(course.client.get_catalog(CHAPTERS_API, ChapterRecord, params=params)) != 0
 
     @staticmethod
     def create(course: Course, book: Book, part: Part, number: int, **options):
@@ -208,6 +389,7 @@ class Chapter:
 
         route_params = {"course_id": course.pk, "book_id": book.pk}
         course.client.post((MANAGE_BOOK_API + "manage-chapters/").format(**route_params), data=data)
+        Chapter.invalidate(course, book)
 
     @staticmethod
     def list(course, book):
@@ -215,10 +397,19 @@ class Chapter:
             "course__label": course.label,
             "book__id": book.pk,
         }
-        return course.client.get(CHAPTERS_API, params=params).json()
+        return course.client.get_catalog(CHAPTERS_API, ChapterRecord, params=params)
+
+    @staticmethod
+    def upload_results(client, course_label):
+        """
+        upload_results returns the warnings and errors of the last upload to
+        every chapter of a course, by chapter id, with a single request.
+        """
+        response = client.get(CHAPTERS_API, params={"course__label": course_label})
+        return {str(c.id): (c.upload_warnings, c.upload_errors) for c in decode(response, ChapterRecord)}
 
     @staticmethod
     def get_warnings_and_errors(client, id):
         response = client.get(CHAPTERS_API, params={"id": id})
-        result = singleton_or_none(response)
-        return result["upload_warnings"], result["upload_errors"]
+        result = singleton_or_none(decode(response, ChapterRecord))
+        return result.upload_warnings, result.upload_errors
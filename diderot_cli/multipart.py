@@ -0,0 +1,114 @@
+import io
+import os
+import uuid
+
+
+def _quote(value):
+    # Quote form field and file names the way browsers (and urllib3) do.
+    return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+def _length(fileobj):
+    """_length returns the number of bytes left to read from fileobj."""
+    if hasattr(fileobj, "fileno"):
+        try:
+            return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+        except (OSError, io.UnsupportedOperation):
+            pass
+    position = fileobj.tell()
+    end = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(position)
+    return end - position
+
+
+class MultipartEncoder:
+    """
+    MultipartEncoder is a multipart/form-data request body that reads files
+    as it is sent, chunk by chunk, rather than holding the whole body in
+    memory. It takes the same data and files arguments as requests, and is
+    passed to it as data, with content_type as the Content-Type header.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, data=None, files=None, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+
+        # Parts of the body, each either bytes or a file object to read
+        # length bytes from.
+        self._parts = []
+        for name, value in self._items(data):
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for v in values:
+                if not isinstance(v, bytes):
+                    v = str(v).encode()
+                self._add(self._header(name), v, len(v))
+        for name, value in self._items(files):
+            if isinstance(value, (list, tuple)):
+                filename, fileobj = value[0], value[1]
+                content_type = value[2] if len(value) > 2 else None
+            else:
+                filename, fileobj, content_type = os.path.basename(getattr(value, "name", name)), value, None
+            if isinstance(fileobj, (bytes, str)):
+                fileobj = io.BytesIO(fileobj.encode() if isinstance(fileobj, str) else fileobj)
+            self._add(self._header(name, filename, content_type), fileobj, _length(fileobj))
+        closing = f"--{self.boundary}--\r\n".encode()
+        self._parts.append((closing, len(closing)))
+
+        self.len = sum(length for _, length in self._parts)
+        self._index = 0
+        self._offset = 0
+
+    @staticmethod
+    def _items(fields):
+        if not fields:
+            return []
+        return list(fields.items()) if isinstance(fields, dict) else list(fields)
+
+    def _header(self, name, filename=None, content_type=None):
+        disposition = f'form-data; name="{_quote(name)}"'
+        if filename is not None:
+            disposition += f'; filename="{_quote(filename)}"'
+            content_type = content_type or "application/octet-stream"
+        header = f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n"
+        if content_type is not None:
+            header += f"Content-Type: {content_type}\r\n"
+        return (header + "\r\n").encode()
+
+    def _add(self, header, body, length):
+        self._parts.append((header, len(header)))
+        self._parts.append((body, length))
+        self._parts.append((b"\r\n", 2))
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        """read returns up to size bytes of the body, or all that is left if size is negative."""
+        if size is None or size < 0:
+            size = self.len
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            part, length = self._parts[self._index]
+            n = min(size, length - self._offset)
+            if isinstance(part, bytes):
+                chunk = part[self._offset:self._offset + n]
+            else:
+                chunk = part.read(n)
+                if len(chunk) != n:
+                    raise IOError(f"{getattr(part, 'name', 'file')} changed size while being uploaded")
+            chunks.append(chunk)
+            size -= n
+            self._offset += n
+            if self._offset == length:
+                self._index += 1
+                self._offset = 0
+        return b"".join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
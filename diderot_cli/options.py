@@ -13,6 +13,26 @@ url = click.option("--url", "-a", envvar="DIDEROT_URL", default=constants.DEFAUL
 credentials = click.option("--credentials", "-c", type=click.Path(exists=True))
 username = click.option("--username", "-u", envvar="DIDEROT_USER")
 password = click.option("--password", "-p", envvar="DIDEROT_PASSWORD", help="DEPRECATED. This option will be removed in future versions.")
+token_cache = click.option(
+    "--token-cache/--no-token-cache", envvar="DIDEROT_TOKEN_CACHE", default=True,
+    help="Reuse the authentication token from previous invocations instead of logging in each time.",
+)
+cache_ttl = click.option(
+    "--cache-ttl", type=click.INT, envvar="DIDEROT_CACHE_TTL", default=constants.DEFAULT_CACHE_TTL,
+    help="Seconds to reuse locally cached course, book and chapter metadata. 0 disables the cache.",
+)
+timeout = click.option(
+    "--timeout", type=click.INT, envvar="DIDEROT_TIMEOUT", default=constants.DEFAULT_READ_TIMEOUT,
+    help="Seconds to wait for a response from Diderot before giving up.",
+)
+retry_time = click.option(
+    "--retry-time", type=click.INT, envvar="DIDEROT_RETRY_TIME", default=constants.DEFAULT_RETRY_TIME,
+    help="Seconds for which requests failing with connection or temporary server errors are retried. 0 disables retries.",
+)
+trace = click.option(
+    "--trace", type=click.Path(dir_okay=False), envvar="DIDEROT_TRACE",
+    help="Appends a JSON record with the route, status, sizes and timings of every request to this file.",
+)
 debug = click.option("--debug/--no-debug", envvar="DEBUG", default=False, help="Shows debug messages for development.")
 
 # Options must be constents with those defined
@@ -37,6 +57,18 @@ xml           = click.option("--xml", type=click.Path(exists=True))
 xml_pdf       = click.option("--xml-pdf", type=click.Path(exists=True))
 video_url     = click.option("--video-url", type=str) # TODO(Artur): URL type
 attach        = click.option("--attach", type=click.Path(exists=True), multiple=True)
-sleep_time    = click.option("--sleep-time", type=click.INT, default=5)
+sleep_time    = click.option(
+    "--sleep-time", type=click.INT, default=5,
+    help="Maximum seconds between checks whether Diderot has finished processing an upload.",
+)
+lock_timeout  = click.option(
+    "--lock-timeout", type=click.INT, default=constants.DEFAULT_LOCK_TIMEOUT,
+    help="Seconds to wait for Diderot to finish processing an upload before giving up.",
+)
+no_wait       = click.option(
+    "--no-wait", is_flag=True,
+    help="Return as soon as the upload is submitted, use wait-uploads to wait for it.",
+)
+force         = click.option("--force", is_flag=True, help="Upload chapters even if their input is unchanged.")
 
-api = multi_opts(url, credentials, username, password)
+api = multi_opts(url, credentials, username, password, token_cache, cache_ttl, timeout, retry_time, trace)
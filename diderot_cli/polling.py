@@ -0,0 +1,40 @@
+import random
+import time
+
+
+class Backoff:
+    """
+    Backoff produces the delays between polls of a slow server operation:
+    starting at initial seconds and growing by factor after every poll up to
+    cap seconds, each randomly shortened by up to jitter of itself so that
+    concurrent pollers do not stay in lockstep.
+    """
+
+    def __init__(self, initial, cap, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.cap = cap
+        self.factor = factor
+        self.jitter = jitter
+
+    def delays(self):
+        delay = self.initial
+        while True:
+            yield delay * (1 - self.jitter * random.random())
+            delay = min(self.cap, delay * self.factor)
+
+
+def poll(done, backoff, timeout):
+    """
+    poll calls done after each delay of backoff until it returns True, and
+    returns the number of seconds this took. It raises TimeoutError when done
+    is still False after timeout seconds.
+    """
+
+    started = time.monotonic()
+    for delay in backoff.delays():
+        remaining = timeout - (time.monotonic() - started)
+        if remaining <= 0:
+            raise TimeoutError(f"Gave up after {timeout} seconds.")
+        time.sleep(min(delay, remaining))
+        if done():
+            return time.monotonic() - started
@@ -0,0 +1,123 @@
+"""
+The --profile option of the diderot command.
+
+A profiled command runs under cProfile, and when it finishes its statistics
+are saved to the given file, in the pstats format that snakeviz, gprof2dot
+and `python -m pstats` open. A summary is printed on stderr. It shows where
+the client spent its time (JSON decoding, print_list formatting, attachment
+glob expansion and multipart encoding) next to the time spent waiting for the
+network, and lists the hottest functions. It also shows how long importing
+the CLI takes. That is measured in a fresh interpreter with
+`python -X importtime`, and the raw log is saved next to the profile as
+<file>.imports, which tuna opens.
+
+Only the thread running the command is profiled, not the worker threads of
+concurrent downloads and uploads.
+"""
+
+import click
+import cProfile
+import io
+import pstats
+import re
+import subprocess
+import sys
+
+# Number of functions and modules listed in the summary.
+TOP = 15
+
+# Client-side costs reported separately in the summary, as (label, file, function)
+# patterns matched against the profiled functions; their cumulative times are added up.
+CLIENT_COSTS = [
+    ("JSON decoding", r"json[/\\]__init__\.py$", r"^loads$"),
+    ("print_list formatting", r"diderot_cli[/\\]utils\.py$", r"^print_list$"),
+    ("Glob expansion", r"(^|[/\\])(glob\.py|pathlib.*)$", r"^r?glob$"),
+    ("Multipart encoding", r"diderot_cli[/\\]multipart\.py$", r"^(__init__|read)$"),
+]
+
+# The modules a command talking to Diderot loads, from the entry point on.
+CLI_MODULES = ("diderot_cli.main", "diderot_cli.commands.diderot_admin", "diderot_cli.diderot_api")
+
+# Built-in functions in which the client waits for the server or the network.
+NETWORK_FUNCTIONS = re.compile(r"of '(_socket\.socket|_ssl\._SSLSocket)' objects|getaddrinfo")
+
+
+def start(ctx: click.Context, path):
+    """start profiles the rest of ctx's command, and reports on it when it finishes."""
+
+    profiler = cProfile.Profile()
+
+    def finish():
+        profiler.disable()
+        report(profiler, path)
+
+    ctx.call_on_close(finish)
+    profiler.enable()
+
+
+def _breakdown(stats):
+    costs = {label: 0.0 for label, _, _ in CLIENT_COSTS}
+    network = 0.0
+    for (filename, _, function), (_, _, tottime, cumtime, _) in stats.stats.items():
+        if filename == "~" and NETWORK_FUNCTIONS.search(function):
+            network += tottime
+            continue
+        for label, file_pattern, function_pattern in CLIENT_COSTS:
+            if re.search(file_pattern, filename) and re.search(function_pattern, function):
+                costs[label] += cumtime
+    return costs, network
+
+
+def import_times(log_path=None, modules=CLI_MODULES):
+    """
+    import_times imports modules in a fresh interpreter and returns the total
+    seconds it took and the modules that took longest to import, by their own
+    import time, as (seconds, module) pairs. The raw log goes to log_path.
+    """
+
+    # The marker separates the imports of the interpreter's startup from ours.
+    marker = "diderot_cli imports:"
+    code = f"import sys; print({marker!r}, file=sys.stderr); import {', '.join(modules)}"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    log = result.stderr.partition(marker + "\n")[2]
+    if log_path is not None:
+        with open(log_path, "w") as f:
+            f.write(log)
+
+    total, slowest = 0.0, []
+    for line in log.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if m is None:
+            continue
+        self_us, cumulative_us, indent, module = int(m[1]), int(m[2]), m[3], m[4]
+        slowest.append((self_us / 1e6, module))
+        # Top-level imports are the ones right after the separator.
+        if len(indent) == 1:
+            total += cumulative_us / 1e6
+    slowest.sort(reverse=True)
+    return total, slowest[:TOP]
+
+
+def report(profiler, path):
+    """report saves profiler's statistics to path and prints their summary."""
+
+    profiler.dump_stats(path)
+    stats = pstats.Stats(profiler)
+
+    out = io.StringIO()
+    costs, network = _breakdown(stats)
+    out.write(f"Profile of {stats.total_tt:.3f}s saved to {path}\n\n")
+    out.write("Client-side costs (cumulative seconds):\n")
+    for label, seconds in costs.items():
+        out.write(f"  {label:<24}{seconds:9.3f}\n")
+    out.write(f"  {'Waiting for the network':<24}{network:9.3f}\n\n")
+
+    total, modules = import_times(path + ".imports")
+    out.write(f"Import time of diderot_cli: {total:.3f}s (log saved to {path}.imports), slowest modules:\n")
+    for seconds, module in modules:
+        out.write(f"  {seconds:9.3f}  {module}\n")
+    out.write("\n")
+
+    stats.stream = out
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP)
+    click.echo(out.getvalue(), err=True)
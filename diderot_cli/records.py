@@ -0,0 +1,73 @@
+"""
+Compact records of the rows Diderot returns for courses, labs, books, parts
+and chapters.
+
+A response body is decoded once (see decode), and each of its rows becomes a
+record holding only the fields the CLI uses, in slots rather than a dict, so
+that large listings take less memory. Records also support row["field"] and
+row.get("field"), so that code written against the decoded JSON keeps working.
+"""
+
+
+class Record:
+    """Record is the base of the slotted records; subclasses list their fields in __slots__."""
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_dict(cls, row):
+        """from_dict returns the record of a decoded row, leaving out the fields it does not hold."""
+        return cls(*[row.get(field) for field in cls.__slots__])
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default) if field in self.__slots__ else default
+
+    def asdict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.asdict() == other.asdict()
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class CourseRecord(Record):
+    __slots__ = ("id", "label", "number", "s3_autograder_bucket")
+
+
+class LabRecord(Record):
+    __slots__ = ("id", "name", "uuid", "course")
+
+
+class BookRecord(Record):
+    __slots__ = ("id", "label", "title", "course", "is_locked")
+
+
+class PartRecord(Record):
+    __slots__ = ("id", "label", "title", "rank", "book")
+
+
+class ChapterRecord(Record):
+    __slots__ = ("id", "label", "title", "rank", "part", "book", "upload_warnings", "upload_errors")
+
+
+def decode(data, record):
+    """
+    decode returns the records of a response's rows, decoding its JSON body
+    once. data can also be the already decoded rows.
+    """
+
+    if not isinstance(data, list):
+        data = data.json()
+    return [record.from_dict(row) for row in data]
@@ -0,0 +1,92 @@
+import glob
+import hashlib
+import json
+
+from pathlib import Path
+
+from diderot_cli.utils import APIError, expand_file_path
+
+
+class StagedUpload:
+    """
+    StagedUpload holds the validated input of a chapter content upload: the
+    files to send with their form fields and sizes, and the form data.
+    """
+
+    def __init__(self, files, data, warnings):
+        # List of (field, Path, size in bytes).
+        self.files = files
+        self.data = data
+        self.warnings = warnings
+
+    @property
+    def size(self):
+        return sum(size for _, _, size in self.files)
+
+    def __bool__(self):
+        return len(self.files) > 0
+
+    def fingerprint(self, metadata=None):
+        """
+        fingerprint returns a hash of the upload's form data, file contents
+        and the given chapter metadata, which changes whenever any of them does.
+        """
+
+        h = hashlib.sha256()
+        h.update(json.dumps([self.data, metadata], sort_keys=True, default=str).encode())
+        for field, path, size in self.files:
+            h.update(f"\0{field}\0{path.name}\0{size}\0".encode())
+            with path.open("rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+        return h.hexdigest()
+
+
+def stage_upload(pdf=None, xml=None, xml_pdf=None, attach=None, video_url=None):
+    """
+    stage_upload does the local preparation of a chapter content upload:
+    validating file types, expanding attachment globs and directories, and
+    collecting file sizes. It only touches the local filesystem, so it can run
+    ahead of time, while the server is still busy with an earlier upload.
+    """
+
+    data = {}
+    files = []
+    warnings = []
+    if pdf is not None:
+        if not pdf.lower().endswith(".pdf"):
+            raise APIError("PDF argument must be a PDF file.")
+        files.append(("input_file_pdf", Path(pdf)))
+    elif xml is not None:
+        if not (xml.lower().endswith(".xml") or xml.lower().endswith(".mlx")):
+            raise APIError("XML argument must be an XML or MLX file.")
+        files.append(("input_file_xml", Path(xml)))
+
+        for fg in attach or []:
+            base_path = Path(fg)
+            file_glob = glob.glob(expand_file_path(fg))
+            if not base_path.exists() and len(file_glob) == 0:
+                warnings.append(f"Warning: cannot find file {fg}. Skipping.")
+                continue
+            for g in file_glob:
+                f = Path(g).expanduser()
+                if f.is_dir():
+                    # If it is a directory, include all files below it.
+                    files.extend([("attachments", m) for m in f.glob("**/*") if m.is_file()])
+                else:
+                    # If it is a file, add it directly.
+                    files.append(("attachments", f))
+        if xml_pdf is not None:
+            files.append(("input_file_pdf", Path(xml_pdf)))
+
+    if video_url is not None:
+        data["video_url"] = video_url
+
+    staged = []
+    for field, path in files:
+        path = path.expanduser()
+        try:
+            staged.append((field, path, path.stat().st_size))
+        except OSError as e:
+            raise APIError(f"Cannot read {path}: {e}")
+    return StagedUpload(staged, data, warnings)
@@ -0,0 +1,123 @@
+"""
+Client-side limits on the requests a DiderotClient sends, so that bulk
+operations do not flood the server.
+
+Requests are split in two budgets: "metadata" for lookups and other small
+requests, and "upload" for requests carrying files or file chunks. Each
+budget has a token bucket, allowing rate requests per second on average and
+bursts of up to burst requests, and a cap on its requests in flight at once.
+All requests together are also capped by a global in_flight limit.
+
+The defaults can be overridden per Diderot URL in $DIDEROT_HOME/limits.json:
+
+    {
+        "https://api.diderot.one": {
+            "in_flight": 8,
+            "metadata": {"rate": 20, "burst": 40, "in_flight": 8},
+            "upload": {"rate": 2, "burst": 4, "in_flight": 2}
+        }
+    }
+
+A rate or in_flight of 0 lifts that limit.
+"""
+
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+
+from diderot_cli.utils import debug, state_path
+
+DEFAULT_LIMITS = {
+    "in_flight": 8,
+    "metadata": {"rate": 20, "burst": 40, "in_flight": 8},
+    "upload": {"rate": 2, "burst": 4, "in_flight": 2},
+}
+
+
+def load_limits(url, path=None):
+    """load_limits returns the limits for a Diderot URL, with defaults for what is not configured."""
+
+    path = path or state_path("limits.json")
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+    except FileNotFoundError:
+        profiles = {}
+    except (OSError, ValueError) as e:
+        debug(f"Ignoring invalid limits file {path}: {e}")
+        profiles = {}
+    profile = profiles.get(url.rstrip("/"), {}) if isinstance(profiles, dict) else {}
+
+    limits = {"in_flight": profile.get("in_flight", DEFAULT_LIMITS["in_flight"])}
+    for budget in ("metadata", "upload"):
+        limits[budget] = dict(DEFAULT_LIMITS[budget], **profile.get(budget, {}))
+    return limits
+
+
+class TokenBucket:
+    """TokenBucket allows rate events per second on average, in bursts of up to burst events."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """acquire blocks until an event is allowed, and returns the seconds it waited."""
+        if self.rate <= 0:
+            return 0
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def _semaphore(n):
+    return threading.BoundedSemaphore(n) if n > 0 else None
+
+
+class Throttle:
+    """Throttle enforces the limits of a Diderot URL on the requests of all threads of a client."""
+
+    def __init__(self, limits):
+        self.in_flight = _semaphore(limits["in_flight"])
+        self.budgets = {
+            name: (TokenBucket(limits[name]["rate"], limits[name]["burst"]), _semaphore(limits[name]["in_flight"]))
+            for name in ("metadata", "upload")
+        }
+        # Seconds requests spent waiting for their turn, by budget.
+        self.waited = {name: 0.0 for name in self.budgets}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def request(self, budget):
+        """request holds a place for one request of the given budget while it runs."""
+
+        bucket, slots = self.budgets[budget]
+        started = time.monotonic()
+        for semaphore in (slots, self.in_flight):
+            if semaphore is not None:
+                semaphore.acquire()
+        try:
+            bucket.acquire()
+            waited = time.monotonic() - started
+            if waited > 0.001:
+                with self.lock:
+                    self.waited[budget] += waited
+            yield
+        finally:
+            for semaphore in (self.in_flight, slots):
+                if semaphore is not None:
+                    semaphore.release()
@@ -0,0 +1,99 @@
+"""
+Per-request trace records, written as JSON lines by the --trace option.
+
+Every HTTP request a DiderotClient sends, including each retry, produces one
+record with its method, route template (the name of the constant in
+constants.py the URL was built from), status, request and response sizes,
+timings and retry count; connection timings come from the TracingAdapter in
+trace_adapter.py. Records are tagged with the CLI command that sent them and
+with whatever the code was working on at the time, such as the chapter being
+uploaded (see tagged).
+"""
+
+import click
+import json
+import re
+import threading
+
+from contextlib import contextmanager
+
+import diderot_cli.constants as constants
+
+# Tags and connection timings of the request being sent by the current thread.
+_local = threading.local()
+
+
+def _route_templates():
+    routes = []
+    for name, value in vars(constants).items():
+        if name.endswith(("_API", "_URL")) and isinstance(value, str) and value.startswith(("/", "api/")):
+            pattern = re.escape("/" + value.lstrip("/"))
+            pattern = re.sub(r"\\\{[^}]*\\\}", "[^/]+", pattern)
+            routes.append((re.compile(pattern), name, len(value)))
+    # Prefer the most specific template.
+    routes.sort(key=lambda r: -r[2])
+    return routes
+
+
+ROUTES = _route_templates()
+
+
+def route_of(path):
+    """
+    route_of returns the name of the route template a URL path was built
+    from. Paths extending a template, like MANAGE_BOOK_API + "parts/", are
+    named after it followed by the rest of the path, with ids left out.
+    """
+
+    for pattern, name, _ in ROUTES:
+        if pattern.fullmatch(path):
+            return name
+    for pattern, name, _ in ROUTES:
+        m = pattern.match(path)
+        if m:
+            rest = "/".join("{}" if re.fullmatch(r"[0-9a-f-]+", p) else p for p in path[m.end():].split("/"))
+            return f"{name}+{rest}"
+    return None
+
+
+@contextmanager
+def tagged(**tags):
+    """tagged adds tags to the trace records of the requests the current thread sends meanwhile."""
+    saved = getattr(_local, "tags", {})
+    _local.tags = dict(saved, **tags)
+    try:
+        yield
+    finally:
+        _local.tags = saved
+
+
+def current_tags():
+    return dict(getattr(_local, "tags", {}))
+
+
+def start_timings():
+    """start_timings resets the connection timings collected for the current thread's next request."""
+    _local.timings = {"dns": 0.0, "connect": 0.0}
+    return _local.timings
+
+
+def current_timings():
+    """current_timings returns the connection timings of the current thread's request, if they are collected."""
+    return getattr(_local, "timings", None)
+
+
+class Tracer:
+    """Tracer appends trace records to a JSONL file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, **fields):
+        ctx = click.get_current_context(silent=True)
+        record = {"command": ctx.command_path if ctx is not None else None}
+        record.update(current_tags())
+        record.update(fields)
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock, open(self.path, "a") as f:
+            f.write(line)
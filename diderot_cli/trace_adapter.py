@@ -0,0 +1,72 @@
+"""
+TracingAdapter, the HTTPAdapter a traced session sends its requests through,
+whose connections record how long name resolution and connecting take in
+the timings started by trace.start_timings.
+"""
+
+import socket
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from diderot_cli.trace import current_timings
+
+
+class _TimedConnection:
+    """_TimedConnection records how long name resolution and connecting take."""
+
+    def _new_conn(self):
+        timings = current_timings()
+        if timings is None:
+            return super()._new_conn()
+        host = self._dns_host
+        started = time.perf_counter()
+        try:
+            # Resolve here to time it separately; connecting to the address
+            # keeps the original host name for the Host header and TLS.
+            self._dns_host = socket.getaddrinfo(host, self.port, type=socket.SOCK_STREAM)[0][4][0]
+        except OSError:
+            pass
+        timings["dns"] += time.perf_counter() - started
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+    def connect(self):
+        timings = current_timings()
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            if timings is not None:
+                timings["connect"] += time.perf_counter() - started - timings["dns"]
+
+
+class _TimedHTTPConnection(_TimedConnection, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnection, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TracingAdapter(HTTPAdapter):
+    """TracingAdapter is an HTTPAdapter whose connections record their timings."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
@@ -1,13 +1,19 @@
 import click
+import hashlib
 import json
 import os
-import requests
 import shutil
 import sys
+import tempfile
+import threading
+import time
 
+from contextlib import contextmanager
 from functools import wraps
 from urllib.parse import urlparse, unquote_plus as unquote
 
+import diderot_cli.constants as constants
+
 from diderot_cli.context import DiderotContext, pass_diderot_context
 
 class APIError(Exception):
@@ -21,15 +27,73 @@ def expand_file_path(path):
     return os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
 
 
+def state_path(*parts):
+    """state_path returns a path inside the directory holding the CLI's local state."""
+    home = os.environ.get("DIDEROT_HOME", constants.DEFAULT_DIDEROT_HOME)
+    return os.path.join(expand_file_path(home), *parts)
+
+
+def read_private_json(path):
+    """
+    read_private_json loads a JSON object written by write_private_json. A
+    missing or corrupt file, or one that other users can access, reads as an
+    empty object.
+    """
+
+    try:
+        if os.stat(path).st_mode & 0o077 != 0:
+            return {}
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def write_private_json(path, data):
+    """
+    write_private_json atomically replaces path with the JSON encoding of
+    data, readable only by the current user.
+    """
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
 def singleton_or_none(response):
     """
-    singleton_or_none returns a single element from a response json or
-    none if the response is not a singleton.
+    singleton_or_none returns a single element from a response json (or its
+    already decoded list) or none if the response is not a singleton.
     """
 
-    if len(response.json()) != 1:
+    data = response if isinstance(response, list) else response.json()
+    if len(data) != 1:
         return None
-    return response.json()[0]
+    return data[0]
+
+
+def rewind_files(files):
+    """
+    rewind_files seeks the file objects of a requests-style files argument
+    back to their start so that a request can be sent again.
+    """
+
+    if not files:
+        return
+    entries = files.values() if isinstance(files, dict) else [f for _, f in files]
+    for entry in entries:
+        fileobj = entry[1] if isinstance(entry, tuple) else entry
+        if hasattr(fileobj, "seek"):
+            fileobj.seek(0)
 
 
 def err_for_code(code, response=None):
@@ -48,8 +112,9 @@ def err_for_code(code, response=None):
     else:
         if response is not None:
             try:
-                if getattr(response, "json") and response.json():
-                    return APIError(f"Unhandled status code: {code}, {response.json()}")
+                data = response.json()
+                if data:
+                    return APIError(f"Unhandled status code: {code}, {data}")
                 else:
                     return APIError(f"Unhandled status code: {code}, error: {response.content}")
             except json.decoder.JSONDecodeError:
@@ -60,21 +125,176 @@ def err_for_code(code, response=None):
         return APIError(f"Unhandled status code: {code}")
 
 
-def download_file_helper(url):
+def _validators(record):
+    """_validators returns the conditional request headers for a recorded download."""
+    headers = {}
+    if record is not None and record.get("etag"):
+        headers["If-None-Match"] = record["etag"]
+    if record is not None and record.get("last_modified"):
+        headers["If-Modified-Since"] = record["last_modified"]
+    return headers
+
+
+def download_file_helper(url, session=None, progress=None, records=None, keep_old=False, timeout=None):
     """
     download_file_helper abstracts logic for downloading a file and potentially
-    aborting if the same file already exists locally.
+    aborting if the same file already exists locally. Pass a requests.Session
+    as session to reuse its connections, and a Progress to report to.
+
+    The file is downloaded to a ".part" file first, and only renamed to its
+    final name once complete. An interrupted download resumes from where it
+    stopped, in this or a later run, when the server supports Range requests.
+
+    With records, a DownloadRecords, a file that exists locally and has not
+    changed since it was downloaded is only downloaded again if it changed on
+    the server. Otherwise, existing files are left alone, unless keep_old is
+    set, in which case the previous copy is kept as "<name>.old".
     """
 
-    r = requests.get(url, stream=True)
-    if r.status_code != 200:
-        raise APIError("Non 200 status code when downloading {}".format(url))
+    # Imported here so that commands that do not download start faster.
+    import requests
+    import urllib3
+
+    session = session or requests
     local_filename = unquote(urlparse(url).path.split("/")[-1])
+    part_filename = local_filename + ".part"
+    conditional = {}
     if os.path.isfile(local_filename):
-        raise FileExistsError("File {} already exists, aborting".format(local_filename))
-    click.echo("Downloading {}...".format(local_filename))
-    with open(local_filename, "wb") as f:
-        shutil.copyfileobj(r.raw, f)
+        record = records.get(local_filename) if records is not None else None
+        if record is not None and _unchanged(local_filename, record):
+            conditional = _validators(record)
+        if not conditional and not keep_old:
+            raise FileExistsError("File {} already exists, aborting".format(local_filename))
+
+    for attempt in range(constants.DOWNLOAD_ATTEMPTS):
+        headers = dict(conditional)
+        offset = os.path.getsize(part_filename) if os.path.isfile(part_filename) else 0
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+            # Only resume a partial file of the same version of the file.
+            part_record = records.get(part_filename) if records is not None else None
+            if part_record is not None and (part_record.get("etag") or part_record.get("last_modified")):
+                headers["If-Range"] = part_record.get("etag") or part_record["last_modified"]
+        r = session.get(url, stream=True, headers=headers, timeout=timeout)
+        if r.status_code == 304:
+            r.close()
+            click.echo("{} is up to date.".format(local_filename))
+            return
+        if r.status_code == 416:
+            # The partial file does not fit the file on the server anymore.
+            r.close()
+            os.unlink(part_filename)
+            continue
+        if r.status_code == 206 and r.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            mode = "ab"
+        elif r.status_code == 200:
+            mode, offset = "wb", 0
+        else:
+            r.close()
+            raise APIError("Non 200 status code when downloading {}".format(url))
+
+        record = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        if records is not None and mode == "wb":
+            records.put(part_filename, record)
+        if attempt == 0:
+            click.echo("Downloading {}...".format(local_filename))
+        expected = None
+        if "Content-Length" in r.headers:
+            expected = offset + int(r.headers["Content-Length"])
+        if progress is not None:
+            progress.expect(local_filename, expected or 0, offset)
+        try:
+            with r, open(part_filename, mode) as f:
+                for chunk in iter(lambda: r.raw.read(64 * 1024), b""):
+                    f.write(chunk)
+                    if progress is not None:
+                        progress.advance(local_filename, len(chunk))
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            debug(f"Download of {local_filename} interrupted: {e}")
+            continue
+
+        size = os.path.getsize(part_filename)
+        if expected is not None and size != expected:
+            debug(f"Download of {local_filename} stopped at {size} of {expected} bytes.")
+            continue
+        if keep_old and os.path.isfile(local_filename):
+            os.replace(local_filename, local_filename + ".old")
+        os.replace(part_filename, local_filename)
+        if records is not None:
+            records.remove(part_filename)
+            records.put(local_filename, dict(record, **_file_state(local_filename), sha256=_sha256(local_filename)))
+        return
+    raise APIError(f"Could not complete download of {url}, run the command again to resume it.")
+
+
+def _file_state(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _unchanged(path, record):
+    """
+    _unchanged returns whether a downloaded file was left as it was
+    downloaded, comparing its size and modification time, then its content,
+    with its download record.
+    """
+
+    state = _file_state(path)
+    if any(record.get(k) != v for k, v in state.items()):
+        return False
+    return record.get("sha256") == _sha256(path)
+
+
+class Progress:
+    """
+    Progress shows the combined progress of concurrent transfers on a single
+    line of stderr, when stderr is a terminal. Transfers are told apart by a
+    key, so that one that is retried or resumed is not counted twice.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.total = 0
+        self.done = 0
+        # Bytes expected and transferred so far, by transfer.
+        self.sizes = {}
+        self.positions = {}
+        self.lock = threading.Lock()
+        self.shown = 0
+        self.enabled = sys.stderr.isatty()
+
+    def expect(self, key, size, position=0):
+        """expect sets the size of a transfer, which restarts at position bytes."""
+        with self.lock:
+            self.total += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            self.done += position - self.positions.get(key, 0)
+            self.positions[key] = position
+
+    def advance(self, key, size):
+        with self.lock:
+            self.done += size
+            self.positions[key] = self.positions.get(key, 0) + size
+            if self.enabled and time.monotonic() - self.shown > 0.1:
+                self.shown = time.monotonic()
+                self._show()
+
+    def _show(self):
+        mib = 1024 * 1024
+        click.echo(f"\r{self.label}: {self.done / mib:.1f} of {self.total / mib:.1f} MiB", nl=False, err=True)
+
+    def finish(self):
+        if self.enabled and self.shown:
+            self._show()
+            click.echo(err=True)
 
 
 def print_list(items):
@@ -100,13 +320,55 @@ def exit_with_error(error_msg):
     sys.exit(1)
 
 
-def debug(message):
-    ctx: DiderotContext = click.get_current_context().obj
+def debugging():
+    """debugging returns whether debug messages are shown, so that costly ones can be skipped."""
+    click_ctx = click.get_current_context(silent=True)
+    return click_ctx is not None and click_ctx.obj.debug
+
 
-    if ctx.debug:
+def debug(message):
+    if debugging():
         click.secho(f"[DEBUG]: {message}", fg="yellow", err=True)
 
+
+def in_current_context(f):
+    """
+    in_current_context wraps f to run in the current click context, so that
+    it can use it from another thread.
+    """
+
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return f
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with ctx.scope(cleanup=False):
+            return f(*args, **kwargs)
+
+    return wrapper
+
+# Per-thread prefix for progress messages, so that the output of work running
+# concurrently can be told apart.
+_output = threading.local()
+
+
+@contextmanager
+def output_prefix(prefix):
+    """output_prefix prefixes the progress messages of the current thread with prefix."""
+    _output.prefix = prefix
+    try:
+        yield
+    finally:
+        _output.prefix = ""
+
+
+def info(message):
+    """info prints a progress message."""
+    click.echo(f"{getattr(_output, 'prefix', '')}{message}")
+
+
 def warn(message):
-    click.secho(f"Warning: {message}", fg="yellow")
+    click.secho(f"{getattr(_output, 'prefix', '')}Warning: {message}", fg="yellow")
 
 
@@ -10,9 +10,9 @@ setup(
     ],
     entry_points={
         "console_scripts": [
-            "diderot = diderot_cli.commands:diderot",
-            "diderot_admin = diderot_cli.commands.diderot_admin:admin",
-            "diderot_student = diderot_cli.commands.diderot_user:student",
+            "diderot = diderot_cli.main:diderot",
+            "diderot_admin = diderot_cli.main:admin",
+            "diderot_student = diderot_cli.main:student",
         ],
     },
 )
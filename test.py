@@ -1,16 +1,46 @@
+import argparse
+import bench
+import cgi
+import click
+import hashlib
+import io
+import json
 import logging
+import os
+import pstats
 import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+import test_server
+import threading
 import time
 import traceback
+import requests
 import unittest
+import unittest.mock
 
+from contextlib import redirect_stdout
 from io import StringIO
 from click.testing import CliRunner, Result
 
+import diderot_cli.constants as constants
+
+from diderot_cli import agent, chunked
+from diderot_cli.cache import Catalog, LockTimes, TokenCache
 from diderot_cli.commands import diderot
-from diderot_cli.constants import SERVURL
+from diderot_cli.constants import CHAPTERS_API, CHUNKED_UPLOAD_API, COURSE_API, SERVURL
+from diderot_cli.context import DiderotContext
+from diderot_cli.diderot_api import RETRY_STATUSES, DiderotAPIInterface, DiderotClient, lock_backoff, setup_client
+from diderot_cli.models import Book, Chapter, Course, IdentityMap, Part
+from diderot_cli.multipart import MultipartEncoder
+from diderot_cli.polling import Backoff, poll
+from diderot_cli.records import BookRecord, ChapterRecord, decode
+from diderot_cli.staging import stage_upload
+from diderot_cli.throttle import Throttle, TokenBucket, load_limits
+from diderot_cli.trace import Tracer, route_of
+from diderot_cli.utils import APIError, Progress, singleton_or_none
 from test_server import books, chapters, codelabs, courses, parts
 
 log = logging.getLogger("TESTLOG")
@@ -92,8 +122,63 @@ class TestDiderotUserCLI(Base):
         with self.runner.isolated_filesystem():
             self.run_user_cmd("download-assignment TestCourse0 TestHW1")
 
-        self.assert_successful_execution()
-        self.assert_in_output("Successfully downloaded assignment.")
+            self.assert_successful_execution()
+            self.assert_in_output("Successfully downloaded assignment.")
+            for name in ["handout_url.tgz", "writeup_url.pdf"]:
+                with open(name, "rb") as f:
+                    self.assertEqual(f.read(), name.split(".")[0].encode())
+
+            # Unchanged files are not downloaded again.
+            self.run_user_cmd("download-assignment TestCourse0 TestHW1")
+
+            self.assert_successful_execution()
+            self.assert_in_output("handout_url.tgz is up to date.")
+            self.assert_in_output("writeup_url.pdf is up to date.")
+
+            # Local changes are kept, or moved aside with --keep-old.
+            with open("handout_url.tgz", "wb") as f:
+                f.write(b"changed")
+
+            self.run_user_cmd("download-assignment TestCourse0 TestHW1")
+
+            self.assert_in_output("File handout_url.tgz already exists, aborting")
+            self.assert_in_output("writeup_url.pdf is up to date.")
+
+            self.run_user_cmd("download-assignment TestCourse0 TestHW1 --keep-old")
+
+            self.assert_successful_execution()
+            self.assert_in_output("Downloading handout_url.tgz...")
+            with open("handout_url.tgz", "rb") as f:
+                self.assertEqual(f.read(), b"handout_url")
+            with open("handout_url.tgz.old", "rb") as f:
+                self.assertEqual(f.read(), b"changed")
+
+        # Local changes keeping the size and modification time are found too.
+        with self.runner.isolated_filesystem():
+            self.run_user_cmd("download-assignment TestCourse0 TestHW1")
+            self.assert_successful_execution()
+            mtime_ns = os.stat("handout_url.tgz").st_mtime_ns
+            with open("handout_url.tgz", "wb") as f:
+                f.write(b"HANDOUT_URL")
+            os.utime("handout_url.tgz", ns=(mtime_ns, mtime_ns))
+
+            self.run_user_cmd("download-assignment TestCourse0 TestHW1")
+
+            self.assert_in_output("File handout_url.tgz already exists, aborting")
+            with open("handout_url.tgz", "rb") as f:
+                self.assertEqual(f.read(), b"HANDOUT_URL")
+
+        # Interrupted downloads resume where they stopped.
+        with self.runner.isolated_filesystem():
+            with open("handout_url.tgz.part", "wb") as f:
+                f.write(b"HAND")
+
+            self.run_user_cmd("download-assignment TestCourse0 TestHW1")
+
+            self.assert_successful_execution()
+            with open("handout_url.tgz", "rb") as f:
+                self.assertEqual(f.read(), b"HANDout_url")
+            self.assertFalse(os.path.exists("handout_url.tgz.part"))
 
     def test_submit_assignment(self):
         # Test invalid course label.
@@ -142,6 +227,12 @@ class TestDiderotAdminCLI(Base):
         self.assert_unsuccessful_execution()
         self.assert_in_output("--part-number must be set.")
 
+        # Test error is raised when the chapter number is not provided.
+        self.run_admin_cmd("create-chapter TestCourse0 TestBook1 --part-number 1")
+
+        self.assert_unsuccessful_execution()
+        self.assert_in_output("--chapter-number must be set.")
+
         # Test error when input part is invalid.
         self.run_admin_cmd("create-chapter TestCourse0 TestBook1 --part-number 3 --chapter-number 1")
 
@@ -181,6 +272,12 @@ class TestDiderotAdminCLI(Base):
         self.assert_unsuccessful_execution()
         self.assert_in_output("Input book not found.")
 
+        # Test error when the part number is not provided.
+        self.run_admin_cmd("create-part TestCourse0 TestBook1 NewTestPart")
+
+        self.assert_unsuccessful_execution()
+        self.assert_in_output("--part-number must be set.")
+
         # Test error when part exists.
         self.run_admin_cmd("create-part TestCourse0 TestBook1 NewTestPart --part-number 1")
 
@@ -456,6 +553,135 @@ class TestDiderotAdminCLI(Base):
         self.assert_in_output("Uploading file: test2.png")
         self.assert_in_output("Chapter uploaded successfully.")
 
+    def test_upload_chapter_no_wait(self):
+        self.run_admin_cmd("upload-chapter TestCourse0 TestBook1 --chapter-number 1 --pdf testdata/chapter.pdf --no-wait")
+        self.assert_successful_execution()
+        self.assert_in_output("Chapter upload submitted as job TestCourse0/TestBook1/1.")
+        self.assertNotIn("Waiting for book upload", self.result.output)
+
+        # A job that cannot be saved is still reported.
+        with tempfile.NamedTemporaryFile() as f, unittest.mock.patch.dict(os.environ, {"DIDEROT_HOME": f.name}):
+            self.run_admin_cmd("upload-chapter TestCourse0 TestBook1 --chapter-number 1 --pdf testdata/chapter.pdf --no-wait")
+        self.assert_successful_execution()
+        self.assert_in_output("Chapter upload submitted as job TestCourse0/TestBook1/1.")
+        self.assert_in_output("Could not save upload job TestCourse0/TestBook1/1, wait-uploads will not find it.")
+
+        self.run_admin_cmd("upload-chapter TestCourse0 TestBook1 --chapter-number 2 --pdf testdata/chapter.pdf --no-wait")
+        self.assert_successful_execution()
+
+        self.run_admin_cmd("wait-uploads TestCourse0/TestBook1/3")
+        self.assert_unsuccessful_execution()
+        self.assert_in_output("Unknown upload jobs: TestCourse0/TestBook1/3")
+
+        self.run_admin_cmd("wait-uploads --sleep-time 0")
+        self.assert_successful_execution()
+        self.assert_in_output("Waiting for 2 uploads to complete...")
+        self.assert_in_output("TestCourse0/TestBook1/1: upload complete.")
+        self.assert_in_output("TestCourse0/TestBook1/2: upload complete.")
+
+        self.run_admin_cmd("wait-uploads")
+        self.assert_successful_execution()
+        self.assert_in_output("No uploads to wait for.")
+
+    def test_upload_book(self):
+        testdata = os.path.abspath("testdata")
+        book = {
+            "book": "TestBook1",
+            "parts": [{"number": 2, "title": "TestPart2"}],
+            "chapters": [
+                {"number": 1, "part": 1, "pdf": os.path.join(testdata, "chapter.pdf")},
+                {
+                    "number": 2,
+                    "part": 2,
+                    "xml": os.path.join(testdata, "book.xml"),
+                    "xml-pdf": os.path.join(testdata, "book.pdf"),
+                    "attachments": [os.path.join(testdata, "images", "*.png")],
+                },
+            ],
+        }
+        with self.runner.isolated_filesystem():
+            with open("book.json", "w") as f:
+                json.dump(book, f)
+
+            self.run_admin_cmd("upload-book TestCourse0 book.json")
+
+            self.assert_successful_execution()
+            self.assert_in_output("Uploading file: chapter.pdf")
+            self.assert_in_output("Uploading file: test1.png")
+            self.assert_in_output("Uploading file: test2.png")
+            self.assertEqual(self.result.output.count("Successfully uploaded chapter."), 2)
+
+            # Chapters whose input did not change are only uploaded again with --force.
+            book["chapters"][1]["title"] = "Renamed"
+            with open("book.json", "w") as f:
+                json.dump(book, f)
+
+            self.run_admin_cmd("upload-book TestCourse0 book.json --sleep-time 0")
+
+            self.assert_successful_execution()
+            self.assert_in_output("Chapter number 1 is unchanged, skipping upload.")
+            self.assertNotIn("Uploading file: chapter.pdf", self.result.output)
+            self.assert_in_output("Uploading file: test1.png")
+
+            self.run_admin_cmd("upload-book TestCourse0 book.json --sleep-time 0 --force")
+
+            self.assert_successful_execution()
+            self.assertEqual(self.result.output.count("Successfully uploaded chapter."), 2)
+
+        # The input is checked before anything is uploaded.
+        book["chapters"].append({"part": 1})
+        with self.runner.isolated_filesystem():
+            with open("book.json", "w") as f:
+                json.dump(book, f)
+
+            self.run_admin_cmd("upload-book TestCourse0 book.json")
+
+        self.assert_unsuccessful_execution()
+        self.assert_in_output("invalid JSON")
+        self.assertNotIn("Uploading chapter number", self.result.output)
+
+    def test_upload_books(self):
+        testdata = os.path.abspath("testdata")
+        books = {
+            "book1.json": {
+                "book": "TestBook1",
+                "chapters": [{"number": 1, "part": 1, "pdf": os.path.join(testdata, "chapter.pdf")}],
+            },
+            "book2.json": {"course": "TestCourse0", "book": "TestBook2", "chapters": []},
+            "book3.json": {"course": "fakecourse", "book": "TestBook3", "chapters": []},
+        }
+        with self.runner.isolated_filesystem():
+            for name, book in books.items():
+                with open(name, "w") as f:
+                    json.dump(book, f)
+
+            self.run_admin_cmd("upload-books --course TestCourse0 --jobs 2 --sleep-time 0 --force book1.json book2.json")
+            self.assert_successful_execution()
+            self.assert_in_output("[TestCourse0/TestBook1] Uploading file: chapter.pdf")
+            self.assert_in_output("[TestCourse0/TestBook2] Creating chapters")
+            self.assert_in_output("Uploaded 2 books.")
+
+            # A failing book does not stop the others.
+            self.run_admin_cmd("upload-books --course TestCourse0 --sleep-time 0 --force book3.json book1.json")
+            self.assert_unsuccessful_execution()
+            self.assert_in_output("[TestCourse0/TestBook1] Successfully uploaded chapter.")
+            self.assert_in_output("1 of 2 books failed to upload.")
+
+            # Unexpected errors only fail their own book too.
+            upload_book = DiderotAPIInterface.upload_book
+
+            def flaky_upload_book(api, course_label, book_data, *args, **kwargs):
+                if book_data["book"] == "TestBook2":
+                    raise requests.ConnectionError("connection dropped")
+                return upload_book(api, course_label, book_data, *args, **kwargs)
+
+            with unittest.mock.patch.object(DiderotAPIInterface, "upload_book", flaky_upload_book):
+                self.run_admin_cmd("upload-books --course TestCourse0 --jobs 2 --sleep-time 0 --force book1.json book2.json")
+            self.assert_unsuccessful_execution()
+            self.assert_in_output("[ERROR]: book2.json: connection dropped")
+            self.assert_in_output("[TestCourse0/TestBook1] Successfully uploaded chapter.")
+            self.assert_in_output("1 of 2 books failed to upload.")
+
     def test_set_publish_date_for_chapter(self):
         # Test invalid course label.
         self.run_admin_cmd(
@@ -496,14 +722,1031 @@ class TestDiderotAdminCLI(Base):
         )
         self.assert_in_output("Successfully set publish date for the chapter.")
 
+class TestBatch(Base):
+    def test_batch(self):
+        script = "\n".join([
+            json.dumps({"command": "list-courses"}),
+            "# Comments and blank lines are skipped.",
+            "",
+            json.dumps({"command": "list-books", "args": ["TestCourse0"]}),
+            json.dumps({"command": "publish-chapter", "args": ["TestCourse0", "TestBook1"], "options": {"chapter-number": 10}}),
+            json.dumps({"command": "publish-chapter", "args": ["TestCourse0", "TestBook1"], "options": {"chapter-number": 1}}),
+            "not json",
+        ])
+        self.result = self.runner.invoke(
+            diderot, f"admin --url {SERVURL} --username test --password test batch -", input=script
+        )
+
+        self.assert_unsuccessful_execution()
+        records = [json.loads(line) for line in self.result.stdout.splitlines()]
+        self.assertEqual([r["line"] for r in records], [1, 4, 5, 6, 7])
+        self.assertEqual([r["status"] for r in records], ["ok", "ok", "error", "ok", "error"])
+        for c in courses:
+            self.assertIn(c["label"], records[0]["stdout"])
+        self.assertIn("Input chapter not found.", records[2]["stderr"])
+        self.assertIn("Success publishing chapter.", records[3]["stdout"])
+
+        # Stop at the first failure if asked to.
+        self.result = self.runner.invoke(
+            diderot, f"admin --url {SERVURL} --username test --password test batch --stop-on-error -", input=script
+        )
+
+        self.assert_unsuccessful_execution()
+        self.assertEqual(len(self.result.stdout.splitlines()), 3)
+
+    def test_batch_survives_crashing_commands(self):
+        script = "\n".join([
+            json.dumps({"command": "list-courses"}),
+            json.dumps({"command": "list-books", "args": ["TestCourse0"]}),
+            json.dumps({"command": "list-parts", "args": ["TestCourse0", "TestBook1"]}),
+            json.dumps({"command": "no-such-command"}),
+        ])
+        with unittest.mock.patch.object(Course, "list", side_effect=OSError("disk on fire")), \
+                unittest.mock.patch.object(DiderotAPIInterface, "list_books", side_effect=ValueError("bad value")):
+            self.result = self.runner.invoke(
+                diderot, f"admin --url {SERVURL} --username test --password test batch -", input=script
+            )
+
+        self.assert_unsuccessful_execution()
+        records = [json.loads(line) for line in self.result.stdout.splitlines()]
+        self.assertEqual([r["status"] for r in records], ["error", "error", "ok", "error"])
+        self.assertEqual([r["exit_code"] for r in records], [1, 1, 0, 2])
+        self.assertEqual(records[0]["error"], "disk on fire")
+        # Errors raised by a command are not mistaken for invalid entries.
+        self.assertEqual(records[1]["error"], "bad value")
+        self.assertIn("[ERROR]: bad value", records[1]["stderr"])
+        self.assertEqual(records[3]["error"], "invalid batch entry: unknown command 'no-such-command'")
+
+
+class CountingClient(DiderotClient):
+    """CountingClient records the API routes of the GET requests it makes."""
+
+    def __init__(self, base_url):
+        super().__init__(base_url)
+        self.gets = []
+
+    def get(self, api, params=None):
+        self.gets.append(api)
+        return super().get(api, params=params)
+
+
+class TestIdentityMap(unittest.TestCase):
+    def setUp(self):
+        self.ctx = click.Context(diderot, obj=DiderotContext())
+        self.ctx.__enter__()
+        self.api = DiderotAPIInterface(SERVURL, client_class=CountingClient)
+        self.api.login("test", "test")
+
+    def tearDown(self):
+        self.api.close()
+        self.ctx.__exit__(None, None, None)
+
+    def assert_gets(self, n, f, *args, **kwargs):
+        before = len(self.api.client.gets)
+        f(*args, **kwargs)
+        self.assertEqual(len(self.api.client.gets) - before, n, self.api.client.gets[before:])
+
+    def test_objects_are_resolved_once(self):
+        # Course, book and chapter are resolved on first use...
+        self.assert_gets(3, self.api.set_publish_date, "TestCourse0", "TestBook1", chapter_number=1, publish_date="2021-06-10T10:15")
+        # ...and reused afterwards, under the chapter's number and label alike.
+        self.assert_gets(0, self.api.set_publish_date, "TestCourse0", "TestBook1", chapter_number=1, publish_on_week="3/5, 14:30")
+        self.assert_gets(0, self.api.set_publish_date, "TestCourse0", "TestBook1", chapter_label="TestChapter1", publish_date="2021-06-10T10:15")
+
+        # Publishing invalidates the chapter, but not its course and book.
+        self.assert_gets(0, self.api.release_unrelease_chapter, "TestCourse0", "TestBook1", True, chapter_number=1)
+        self.assert_gets(1, self.api.release_unrelease_chapter, "TestCourse0", "TestBook1", False, chapter_number=1)
+
+        # Creating a chapter resolves the part and checks the new chapter does
+        # not exist, then invalidates the chapters of the book.
+        self.assert_gets(2, self.api.create_chapter, "TestCourse0", "TestBook1", part_number=1, chapter_number=3, title="TestChapter3")
+        self.assert_gets(1, self.api.set_publish_date, "TestCourse0", "TestBook1", chapter_number=1, publish_date="2021-06-10T10:15")
+
+
+    def test_resolve_many(self):
+        course = Course.resolve(self.api.client, "TestCourse0")
+        book = Book.resolve(course, "TestBook1")
+
+        self.assert_gets(1, Chapter.resolve_many, course, book)
+        self.assert_gets(1, Part.resolve_many, course, book)
+
+        # Every chapter and part of the book is now known, present or not.
+        def lookups():
+            self.assertEqual(Chapter.resolve(course, book, 2, None).label, "TestChapter2")
+            self.assertEqual(Chapter.resolve(course, book, None, "TestChapter1").pk, "0")
+            self.assertTrue(Chapter.exists(course, book, 1))
+            self.assertFalse(Chapter.exists(course, book, 7))
+            self.assertRaises(APIError, Chapter.resolve, course, book, 7, None)
+            self.assertTrue(Part.exists(course, book, 2))
+            self.assertFalse(Part.exists(course, book, 3))
+            self.assertEqual(Part.resolve(course, book, 1).pk, "0")
+        self.assert_gets(0, lookups)
+
+        # A chapter without a label is not found by an empty label.
+        unlabeled = Chapter(course, book, None, None, result=ChapterRecord.from_dict({"id": "9", "rank": "9", "part": "0"}))
+        unlabeled._register(self.api.client.identities)
+        self.assertRaisesRegex(APIError, "must be provided", Chapter.resolve, course, book, None, None)
+
+        # Lookups without a number are left to Diderot.
+        self.assert_gets(1, Chapter.exists, course, book, None)
+        self.assert_gets(1, Part.exists, course, book, None)
+
+        # Publishing a chapter makes the listing incomplete again.
+        self.api.release_unrelease_chapter("TestCourse0", "TestBook1", True, chapter_number=1)
+        self.assert_gets(1, Chapter.exists, course, book, 7)
+
+
+    def test_concurrent_updates(self):
+        identities = IdentityMap()
+        # Many objects make invalidating slow, and threads switch often, so
+        # that updates land while the keys are gone through.
+        for i in range(20000):
+            identities.put(("Book", i), i)
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        errors = []
+
+        def put(lane):
+            try:
+                for i in range(2000):
+                    identities.put(("Chapter", lane, "rank", i), i)
+                    identities.resolve(("Part", lane, i), lambda: i)
+            except Exception as e:
+                errors.append(e)
+
+        def invalidate():
+            try:
+                for _ in range(100):
+                    identities.invalidate("Chapter", 0)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=put, args=(lane,)) for lane in range(2)]
+        threads.append(threading.Thread(target=invalidate))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+
+class TestCatalog(Base):
+    def catalog(self):
+        return Catalog(SERVURL, "test", 300)
+
+    def tearDown(self):
+        self.catalog().clear()
+
+    def test_list_from_catalog(self):
+        self.catalog().put(COURSE_API, None, [{"id": "9", "label": "CachedCourse"}])
+
+        self.run_user_cmd("list-courses")
+
+        self.assert_successful_execution()
+        self.assertEqual(shlex.split(self.result.output), ["CachedCourse"])
+
+        # A TTL of 0 bypasses the catalog.
+        self.run_user_cmd("--cache-ttl 0 list-courses")
+
+        self.assert_successful_execution()
+        self.assertEqual(len(shlex.split(self.result.output)), len(courses))
+
+        # Refreshing drops the stale snapshot.
+        self.run_user_cmd("refresh-cache")
+
+        self.assert_successful_execution()
+        self.assert_in_output("Successfully refreshed the cache.")
+
+        self.run_user_cmd("list-courses")
+
+        self.assert_successful_execution()
+        self.assertEqual(len(shlex.split(self.result.output)), len(courses))
+        self.assertNotIn("CachedCourse", self.result.output)
+
+    def test_mutations_invalidate_catalog(self):
+        self.run_admin_cmd("list-chapters TestCourse0 TestBook1")
+
+        self.assert_successful_execution()
+        self.assertTrue(any(k.startswith(CHAPTERS_API) for k in self.catalog().entries))
+
+        self.run_admin_cmd("publish-chapter TestCourse0 TestBook1 --chapter-number 1")
+
+        self.assert_successful_execution()
+        self.assertFalse(any(k.startswith(CHAPTERS_API) for k in self.catalog().entries))
+        self.assertTrue(any(k.startswith(COURSE_API) for k in self.catalog().entries))
+
+    def test_catalogs_share_changes(self):
+        first, second = self.catalog(), self.catalog()
+        first.put(COURSE_API, None, [{"id": "9"}])
+        second.put(CHAPTERS_API, None, [{"id": "8"}])
+
+        # Writes merge with what other processes wrote...
+        self.assertEqual(self.catalog().get(COURSE_API), [{"id": "9"}])
+        self.assertEqual(first.get(CHAPTERS_API), [{"id": "8"}])
+
+        # ...and invalidations are seen, and not written back.
+        second.invalidate(COURSE_API)
+        self.assertIsNone(first.get(COURSE_API))
+        first.put(CHAPTERS_API, {"rank": 1}, [{"id": "8"}])
+        self.assertIsNone(self.catalog().get(COURSE_API))
+
+    def test_catalog_holds_record_fields(self):
+        self.run_admin_cmd("list-chapters TestCourse0 TestBook1")
+
+        self.assert_successful_execution()
+        rows = next(e["data"] for k, e in self.catalog().entries.items() if k.startswith(CHAPTERS_API))
+        self.assertEqual(rows[0], ChapterRecord.from_dict(chapters[0]).asdict())
+        self.assertNotIn("course__label", rows[0])
+
+
+class CountingResponse:
+    """CountingResponse counts how many times its JSON body is decoded."""
+
+    def __init__(self, data):
+        self.data = data
+        self.decoded = 0
+
+    def json(self):
+        self.decoded += 1
+        return json.loads(json.dumps(self.data))
+
+
+class TestRecords(unittest.TestCase):
+    def test_decode_once(self):
+        response = CountingResponse(chapters)
+        rows = decode(response, ChapterRecord)
+
+        self.assertEqual(response.decoded, 1)
+        self.assertEqual([row.label for row in rows], ["TestChapter1", "TestChapter2"])
+        self.assertIsNone(singleton_or_none(rows))
+        self.assertEqual(singleton_or_none(rows[:1]).id, "0")
+
+    def test_record_access(self):
+        book = BookRecord.from_dict(dict(books[0], unknown="ignored"))
+
+        self.assertEqual(book["label"], book.label)
+        self.assertEqual(book.get("title"), "TestBook1")
+        self.assertIsNone(book.get("unknown"))
+        self.assertRaises(KeyError, book.__getitem__, "unknown")
+        self.assertFalse(hasattr(book, "__dict__"))
+        self.assertEqual(BookRecord.from_dict(book.asdict()), book)
+        # Fields missing from a row are None.
+        self.assertIsNone(BookRecord.from_dict({"id": "7"}).is_locked)
+
+    def test_get_does_not_decode(self):
+        client = DiderotClient(SERVURL)
+        client.login("test", "test")
+        with click.Context(diderot, obj=DiderotContext()), unittest.mock.patch.object(requests.Response, "json") as json_:
+            client.get(COURSE_API)
+        client.close()
+        # Without --debug, the body is left for the caller to decode.
+        json_.assert_not_called()
+
+
+class TestStaging(unittest.TestCase):
+    def test_stage_upload(self):
+        staged = stage_upload(
+            xml="testdata/book.xml",
+            xml_pdf="testdata/book.pdf",
+            attach=["testdata/images", "testdata/missing.png"],
+            video_url="http://video",
+        )
+
+        fields = [field for field, _, _ in staged.files]
+        self.assertEqual(fields[0], "input_file_xml")
+        self.assertEqual(fields[-1], "input_file_pdf")
+        self.assertEqual(
+            sorted(p.name for field, p, _ in staged.files if field == "attachments"),
+            sorted(os.listdir("testdata/images")),
+        )
+        self.assertEqual(staged.size, sum(os.path.getsize(p) for _, p, _ in staged.files))
+        self.assertEqual(staged.data, {"video_url": "http://video"})
+        self.assertEqual(staged.warnings, ["Warning: cannot find file testdata/missing.png. Skipping."])
+
+        with self.assertRaises(APIError):
+            stage_upload(pdf="testdata/book.xml")
+
+class TestMultipart(unittest.TestCase):
+    def test_encoder(self):
+        with open("testdata/book.pdf", "rb") as pdf, open("testdata/book.xml", "rb") as xml:
+            encoder = MultipartEncoder(
+                {"kind": "upload content", "video_url": "http://video"},
+                [("input_file_xml", ("book.xml", xml)), ("input_file_pdf", pdf)],
+            )
+            length = len(encoder)
+            chunks = list(iter(lambda: encoder.read(1000), b""))
+
+        body = b"".join(chunks)
+        self.assertEqual(len(body), length)
+        self.assertTrue(all(len(c) == 1000 for c in chunks[:-1]))
+
+        _, pdict = cgi.parse_header(encoder.content_type)
+        pdict["boundary"] = pdict["boundary"].encode()
+        pdict["CONTENT-LENGTH"] = str(length)
+        fields = cgi.parse_multipart(io.BytesIO(body), pdict)
+        self.assertEqual(fields["kind"], ["upload content"])
+        self.assertEqual(fields["video_url"], ["http://video"])
+        with open("testdata/book.xml", "rb") as f:
+            self.assertEqual(fields["input_file_xml"], [f.read()])
+        with open("testdata/book.pdf", "rb") as f:
+            self.assertEqual(fields["input_file_pdf"], [f.read()])
+
+class TestChunkedUpload(unittest.TestCase):
+    def setUp(self):
+        self.ctx = click.Context(diderot, obj=DiderotContext())
+        self.ctx.__enter__()
+        self.api = DiderotAPIInterface(SERVURL)
+        self.api.login("test", "test")
+        self.api.client.chunked.threshold = 1
+        self.puts = 0
+        self.failing_puts = False
+        send = self.api.client._send
+
+        def counting_send(method, url, **kwargs):
+            if method == "PUT":
+                if self.failing_puts:
+                    raise requests.ConnectionError("connection reset")
+                self.puts += 1
+            return send(method, url, **kwargs)
+        self.api.client._send = counting_send
+
+    def tearDown(self):
+        self.api.close()
+        self.ctx.__exit__(None, None, None)
+        if os.path.exists(self.api.client.chunked.path):
+            os.unlink(self.api.client.chunked.path)
+
+    def update_assignment(self):
+        self.api.update_assignment(
+            "TestCourse0", "TestHW1",
+            autograde_tar="testdata/autograde.tar",
+            autograde_makefile="testdata/autograde-Makefile",
+            handout="testdata/handout.tar",
+        )
+
+    def test_chunked_upload(self):
+        self.update_assignment()
+
+        # The server accepts 4 byte chunks.
+        sizes = [os.path.getsize(f"testdata/{f}") for f in ["autograde.tar", "autograde-Makefile", "handout.tar"]]
+        self.assertEqual(self.puts, sum((size + 3) // 4 for size in sizes))
+        self.assertTrue(self.api.client.chunked.supported)
+        # Uploads that were used are forgotten.
+        self.assertEqual(self.api.client.chunked._state(), {})
+
+    def test_resume(self):
+        uploader = self.api.client.chunked
+        with open("testdata/autograde-Makefile", "rb") as f:
+            key = chunked._file_key(SERVURL, f)
+            self.failing_puts = True
+            self.assertRaises(APIError, uploader.upload, key, f)
+            upload_id = uploader._state()[key]
+
+            # Send the first two chunks, then lose the connection.
+            self.failing_puts = False
+            f.seek(0)
+            for start in [0, 4]:
+                chunk = f.read(4)
+                self.api.client._request(
+                    "PUT", CHUNKED_UPLOAD_API + f"{upload_id}/", data=chunk,
+                    headers={"Content-Range": f"bytes {start}-{start + 3}/15", "X-Chunk-SHA256": hashlib.sha256(chunk).hexdigest()},
+                )
+            self.puts = 0
+
+            # A new uploader picks up after the acknowledged chunks.
+            self.assertEqual(chunked.ChunkedUploader(self.api.client).upload(key, f), upload_id)
+            self.assertEqual(self.puts, 2)
+
+    def test_malformed_status(self):
+        request = self.api.client._request
+
+        def malformed_status(method, api, **kwargs):
+            response = request(method, api, **kwargs)
+            if method == "GET":
+                response.json = lambda: {"received": "lots"}
+            return response
+
+        with open("testdata/autograde-Makefile", "rb") as f, \
+                unittest.mock.patch.object(self.api.client, "_request", malformed_status):
+            self.failing_puts = True
+            self.assertRaises(APIError, self.api.client.chunked.upload, chunked._file_key(SERVURL, f), f)
+
+    def test_unsupported(self):
+        with unittest.mock.patch.object(constants, "CHUNKED_UPLOAD_API", "/api/unsupported/"):
+            self.update_assignment()
+
+        self.assertEqual(self.puts, 0)
+        self.assertFalse(self.api.client.chunked.supported)
+
+class FlakySession:
+    """FlakySession answers requests with a scripted series of responses and errors."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code, response.headers = outcome
+        response._content = b"[]"
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        pass
+
+class TestRetries(unittest.TestCase):
+    def setUp(self):
+        self.ctx = click.Context(diderot, obj=DiderotContext())
+        self.ctx.__enter__()
+        self.client = DiderotClient(SERVURL)
+
+    def tearDown(self):
+        self.ctx.__exit__(None, None, None)
+
+    def test_transient_failures_are_retried(self):
+        self.client.client = FlakySession(
+            (503, {"Retry-After": "0"}), requests.ConnectionError("reset"), (502, {"Retry-After": "0"}), (200, {}),
+        )
+        with unittest.mock.patch.object(constants, "RETRY_INITIAL", 0.01):
+            self.assertEqual(self.client.get(COURSE_API).json(), [])
+        self.assertEqual(self.client.retries, {"503": 1, "ConnectionError": 1, "502": 1})
+
+    def test_unsafe_requests_are_not_repeated(self):
+        self.client.client = FlakySession((502, {"Retry-After": "0"}), (200, {}))
+        self.assertRaises(APIError, self.client.post, COURSE_API)
+        self.assertEqual(self.client.client.requests, 1)
+
+        # ...unless the server did not handle them.
+        self.client.client = FlakySession((503, {"Retry-After": "0"}), (200, {}))
+        self.client.post(COURSE_API)
+        self.assertEqual(self.client.client.requests, 2)
+
+    def test_retry_time(self):
+        self.client.client = FlakySession((503, {"Retry-After": "5"}), (200, {}))
+        self.client.retry_time = 1
+        self.assertRaises(APIError, self.client.get, COURSE_API)
+        self.assertEqual(self.client.client.requests, 1)
+
+        self.client.client = FlakySession(requests.ConnectTimeout("timed out"))
+        self.client.retry_time = 0
+        with self.assertRaisesRegex(APIError, "Could not connect to Diderot"):
+            self.client.get(COURSE_API)
+
+class TestThrottle(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=50, burst=2)
+        started = time.monotonic()
+        for _ in range(7):
+            bucket.acquire()
+        # Two requests pass right away, the other five at 50 per second.
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_in_flight(self):
+        limits = load_limits(SERVURL)
+        limits["upload"] = {"rate": 0, "burst": 1, "in_flight": 2}
+        throttle = Throttle(limits)
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def upload():
+            with throttle.request("upload"):
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(0.02)
+                with lock:
+                    running[0] -= 1
+
+        threads = [threading.Thread(target=upload) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(peak[0], 2)
+        self.assertGreater(throttle.waited["upload"], 0)
+
+    def test_limits_per_url(self):
+        path = os.path.join(os.environ["DIDEROT_HOME"], "limits.json")
+        with open(path, "w") as f:
+            json.dump({SERVURL: {"in_flight": 3, "upload": {"rate": 1}}}, f)
+        try:
+            limits = load_limits(SERVURL)
+            self.assertEqual(limits["in_flight"], 3)
+            self.assertEqual(limits["upload"], {"rate": 1, "burst": 4, "in_flight": 2})
+            self.assertEqual(load_limits("https://other")["upload"]["rate"], 2)
+        finally:
+            os.unlink(path)
+
+class TestProgress(unittest.TestCase):
+    def test_retries_are_not_counted_twice(self):
+        progress = Progress("Downloading")
+        progress.expect("a", 100)
+        progress.expect("b", 50)
+        progress.advance("a", 60)
+
+        # "a" starts over, then resumes at byte 40.
+        progress.expect("a", 100)
+        self.assertEqual((progress.done, progress.total), (0, 150))
+        progress.advance("a", 40)
+        progress.expect("a", 100, position=40)
+        progress.advance("a", 60)
+        progress.advance("b", 50)
+        self.assertEqual((progress.done, progress.total), (150, 150))
+
+
+class TestPolling(unittest.TestCase):
+    def test_backoff(self):
+        delays = Backoff(0.5, 4, jitter=0).delays()
+        self.assertEqual([next(delays) for _ in range(6)], [0.5, 1, 2, 4, 4, 4])
+
+        for delay, bound in zip(Backoff(1, 8).delays(), [1, 2, 4, 8, 8]):
+            self.assertTrue(bound / 2 <= delay <= bound)
+
+    def test_lock_backoff(self):
+        # A sleep time of 0 does not poll without pause.
+        delays = lock_backoff(0).delays()
+        self.assertTrue(all(next(delays) >= constants.LOCK_POLL_MIN / 2 for _ in range(5)))
+        self.assertEqual(lock_backoff(0).cap, constants.LOCK_POLL_MIN)
+        # Earlier uploads move the first check later.
+        self.assertEqual(lock_backoff(5, expected=10).initial, 8)
+
+    def test_poll(self):
+        checks = []
+        elapsed = poll(lambda: checks.append(1) or len(checks) == 3, Backoff(0.01, 0.02), 5)
+        self.assertEqual(len(checks), 3)
+        self.assertLess(elapsed, 1)
+
+        with self.assertRaises(TimeoutError):
+            poll(lambda: False, Backoff(0.01, 0.02), 0.1)
+
+    def test_lock_times(self):
+        times = LockTimes(SERVURL)
+        self.assertIsNone(times.get("polling-book"))
+        times.record("polling-book", 10)
+        times.record("polling-book", 20)
+        self.assertAlmostEqual(LockTimes(SERVURL).get("polling-book"), 13)
+
+class TestTrace(Base):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.trace = os.path.join(self.tmp.name, "trace.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def records(self):
+        with open(self.trace) as f:
+            return [json.loads(line) for line in f]
+
+    def test_route_of(self):
+        self.assertEqual(route_of("/api/courses/courses/"), "COURSE_API")
+        self.assertEqual(route_of("/api/courses/0/books/1/manage-chapters/2/content_upload/"), "MANAGE_CHAPTER_WITH_ACTION_API")
+        self.assertEqual(route_of("/api/courses/0/books/1/parts/"), "MANAGE_BOOK_API+parts/")
+        self.assertEqual(route_of("/api/uploads/12/"), "CHUNKED_UPLOAD_API+{}/")
+        self.assertIsNone(route_of("/elsewhere/"))
+
+    def test_trace_upload_chapter(self):
+        self.run_admin_cmd(
+            f"--cache-ttl 0 --trace {self.trace} upload-chapter TestCourse0 TestBook1 --chapter-number 1 --pdf testdata/chapter.pdf"
+        )
+
+        self.assert_successful_execution()
+        records = self.records()
+        self.assertTrue(records)
+        for r in records:
+            self.assertEqual(r["command"], "diderot admin upload-chapter")
+            self.assertEqual(r["status"], 200)
+            self.assertEqual(r["retry"], 0)
+            self.assertGreaterEqual(r["total"], r["ttfb"])
+        routes = [r["route"] for r in records]
+        self.assertIn("CHAPTERS_API", routes)
+        upload = next(r for r in records if r["route"] == "MANAGE_CHAPTER_WITH_ACTION_API")
+        self.assertEqual(upload["method"], "POST")
+        self.assertEqual(upload["chapter"], 1)
+        self.assertEqual(upload["book"], "TestBook1")
+        self.assertGreater(upload["request_bytes"], os.path.getsize("testdata/chapter.pdf"))
+        # The session's connection is opened by the first request only.
+        self.assertGreater(records[0]["connect"], 0)
+
+    def test_trace_records_retries(self):
+        client = DiderotClient(SERVURL)
+        client.tracer = Tracer(self.trace)
+        client.client = FlakySession((503, {"Retry-After": "0"}), requests.ConnectionError("reset"), (200, {}))
+        with unittest.mock.patch.object(constants, "RETRY_INITIAL", 0.01):
+            client.get(COURSE_API)
+
+        records = self.records()
+        self.assertEqual(
+            [(r["status"], r["error"], r["retry"]) for r in records],
+            [(503, None, 0), (None, "ConnectionError", 1), (200, None, 2)],
+        )
+        self.assertIsNone(records[0]["command"])
+
+class TestProfile(Base):
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "list.prof")
+            self.result = self.runner.invoke(
+                diderot, f"--profile {path} student --url {SERVURL} --username test --password test list-courses"
+            )
+
+            self.assert_successful_execution()
+            for c in courses:
+                self.assert_in_output(c["label"])
+            self.assert_in_output("JSON decoding")
+            self.assert_in_output("Waiting for the network")
+            self.assert_in_output("Import time of diderot_cli")
+            # The statistics can be opened by standard tools.
+            stats = pstats.Stats(path)
+            self.assertTrue(any(function == "print_list" for _, _, function in stats.stats))
+            self.assertTrue(os.path.getsize(path + ".imports") > 0)
+
+class TestStartup(unittest.TestCase):
+    # Modules that only commands talking to Diderot need.
+    CLIENT_MODULES = (
+        "requests", "urllib3", "diderot_cli.diderot_api",
+        "diderot_cli.commands.diderot_admin", "diderot_cli.commands.diderot_user", "diderot_cli.commands.diderot_agent",
+    )
+
+    def modules_after(self, code):
+        code = f"import sys\n{code}\nprint(' '.join(sys.modules), file=sys.stderr)"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        return result.stderr.split()
+
+    def loaded_modules(self, *argv):
+        return self.modules_after(f"from diderot_cli.commands import diderot\ndiderot({list(argv)!r}, standalone_mode=False)")
+
+    def test_entry_point_is_light(self):
+        modules = self.modules_after("import diderot_cli.main")
+        for module in self.CLIENT_MODULES:
+            self.assertNotIn(module, modules)
+
+    def test_help_does_not_load_client(self):
+        modules = self.loaded_modules("--help")
+        self.assertNotIn("diderot_cli.commands.diderot_admin", modules)
+        self.assertNotIn("requests", modules)
+
+        modules = self.loaded_modules("admin", "--help")
+        self.assertIn("diderot_cli.commands.diderot_admin", modules)
+        self.assertNotIn("diderot_cli.diderot_api", modules)
+        self.assertNotIn("requests", modules)
+
+    def test_lazy_short_help(self):
+        # The short help shown before loading a command is the command's own.
+        for name, (_, short_help) in diderot.lazy_commands.items():
+            command = diderot.get_command(None, name)
+            self.assertEqual(command.get_short_help_str(), short_help)
+
+class TestBench(unittest.TestCase):
+    def test_bench(self):
+        options = argparse.Namespace(
+            chapters=2, attachments=1, attachment_size=1000, handin_size=1000, latency=0, port=bench.BENCH_PORT + 1,
+        )
+        with redirect_stdout(StringIO()):
+            results = bench.run(options)
+
+        self.assertEqual([name for name, _ in bench.benchmarks("book.json", "handin.tar")], list(results))
+        for name, result in results.items():
+            self.assertEqual(result["exit_code"], 0, name)
+            self.assertGreater(result["requests"], 0, name)
+            self.assertGreater(result["peak_rss"], 0, name)
+        # Both chapters are uploaded, with their PDF and attachment.
+        self.assertGreater(results["upload-book"]["bytes_sent"], 2 * 2 * 1000)
+        self.assertEqual(results["upload-book-unchanged"]["bytes_sent"], 0)
+
+class TestMockServer(unittest.TestCase):
+    PORT = constants.PORT + 2
+    URL = f"http://{constants.ADDR}:{PORT}"
+    AUTH = {"Authorization": f"Token {test_server.TOKEN}"}
+
+    def start(self, **options):
+        self.server = test_server.make_server(self.PORT, **options)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def get(self, path):
+        return requests.get(self.URL + path, headers=self.AUTH, timeout=10)
+
+    def test_concurrent_requests(self):
+        self.start(latency=0.3)
+        started = time.monotonic()
+        threads = [threading.Thread(target=self.get, args=(COURSE_API,)) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Requests overlap rather than waiting for one another.
+        self.assertLess(time.monotonic() - started, 0.9)
+
+    def test_route_latency(self):
+        self.start(latency="uniform:0:0.01", route_latency={"CHAPTERS_API": 0.3})
+        started = time.monotonic()
+        self.get(COURSE_API)
+        self.assertLess(time.monotonic() - started, 0.2)
+        started = time.monotonic()
+        self.get(CHAPTERS_API)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    def test_distributions(self):
+        self.assertEqual(test_server.distribution(0.5)(), 0.5)
+        self.assertEqual(test_server.distribution("0.5")(), 0.5)
+        self.assertTrue(0.1 <= test_server.distribution("uniform:0.1:0.2")() <= 0.2)
+        self.assertGreaterEqual(test_server.distribution("normal:0:1")(), 0)
+        self.assertGreaterEqual(test_server.distribution("exp:0.1")(), 0)
+        self.assertRaises(ValueError, test_server.distribution, "pareto:1")
+
+    def test_bandwidth(self):
+        self.start(bandwidth=20000)
+        started = time.monotonic()
+        self.assertEqual(self.get("/writeup_url.pdf").content, b"writeup_url")
+        path = constants.MANAGE_CHAPTER_WITH_ACTION_API.format(course_id=0, book_id=0, chapter_id=0, action="content_upload")
+        requests.post(self.URL + path, headers=self.AUTH, data=b"x" * 10000, timeout=10)
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+
+    def test_errors(self):
+        self.start(error_rate=1, errors=["5xx"], error_statuses=[502, 503, 504])
+        self.assertIn(self.get(COURSE_API).status_code, (502, 503, 504))
+
+        # The CLI's client retries them, until it runs out of time.
+        self.assertTrue({502, 503, 504} <= RETRY_STATUSES)
+        client = DiderotClient(self.URL)
+        client.retry_time = 0.5
+        with unittest.mock.patch.object(constants, "RETRY_INITIAL", 0.05):
+            self.assertRaises(APIError, client.get, COURSE_API)
+        self.assertGreater(sum(client.retries.values()), 0)
+
+    def test_reset(self):
+        self.start(error_rate=1, errors=["reset"])
+        self.assertRaises(requests.ConnectionError, self.get, COURSE_API)
+
+    def test_slow_body(self):
+        self.start(error_rate=1, errors=["slow"], slow_delay=0.3)
+        started = time.monotonic()
+        self.assertEqual(len(self.get(COURSE_API).json()), len(courses))
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    def test_book_lock(self):
+        self.start(lock_rate=1000, lock_min=0.1)
+        path = constants.MANAGE_CHAPTER_WITH_ACTION_API.format(course_id=0, book_id=0, chapter_id=0, action="content_upload")
+        requests.post(self.URL + path, headers=self.AUTH, data=b"x" * 300, timeout=10)
+
+        # The book stays locked for 0.1 + 300 / 1000 seconds.
+        self.assertTrue(self.get(constants.BOOK_API + "?id=0").json()[0]["is_locked"])
+        self.assertFalse(self.get(constants.BOOK_API + "?id=1").json()[0]["is_locked"])
+        time.sleep(0.5)
+        self.assertFalse(self.get(constants.BOOK_API + "?id=0").json()[0]["is_locked"])
+
+class RequestBudget(Base):
+    """
+    RequestBudget runs CLI commands from a cold start, without cached tokens
+    or metadata, and checks the number of requests they send to Diderot
+    against a budget, so that extra round trips are caught in review.
+    """
+
+    url = SERVURL
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.runs = 0
+
+    def requests_of(self, user, cmd, home=None):
+        """
+        requests_of runs a command and returns the trace records of the
+        requests it sent. Without home, it starts from a new DIDEROT_HOME.
+        """
+
+        self.runs += 1
+        home = home or os.path.join(self.tmp, f"home{self.runs}")
+        trace = os.path.join(self.tmp, f"trace{self.runs}.jsonl")
+        with unittest.mock.patch.dict(os.environ, {"DIDEROT_HOME": home}):
+            self.result = self.runner.invoke(
+                diderot,
+                f"{user} --url {self.url} --username test --password test --no-debug --trace {trace} {cmd}",
+            )
+        self.assert_successful_execution()
+        if not os.path.exists(trace):
+            return []
+        with open(trace) as f:
+            return [json.loads(line) for line in f]
+
+    def assert_budget(self, records, budget, command):
+        if len(records) > budget:
+            calls = "\n".join(
+                f"  {i}. {r['method']} {r['route']} {r['path']} -> {r['status'] or r['error']}"
+                for i, r in enumerate(records, start=1)
+            )
+            self.fail(f"{command} sent {len(records)} requests, over its budget of {budget}:\n{calls}")
+
+    def check_budget(self, user, cmd, budget):
+        self.assert_budget(self.requests_of(user, cmd), budget, f"{user} {cmd}")
+
+class TestRequestBudgets(RequestBudget):
+    def test_student_commands(self):
+        self.check_budget("student", "list-courses", 2)
+        self.check_budget("student", "list-assignments TestCourse0", 3)
+        self.check_budget("student", "submit-assignment TestCourse0 TestHW1 testdata/test_handin.tar", 4)
+        with self.runner.isolated_filesystem():
+            self.check_budget("student", "download-assignment TestCourse0 TestHW1", 4)
+
+    def test_admin_commands(self):
+        self.check_budget("admin", "list-books TestCourse0", 3)
+        self.check_budget("admin", "list-parts TestCourse0 TestBook1", 4)
+        self.check_budget("admin", "list-chapters TestCourse0 TestBook1", 4)
+        self.check_budget("admin", "publish-chapter TestCourse0 TestBook1 --chapter-number 1", 5)
+        self.check_budget(
+            "admin", "upload-chapter TestCourse0 TestBook1 --chapter-number 1 --pdf testdata/chapter.pdf --sleep-time 0", 7,
+        )
+
+    def test_budget_failure_lists_requests(self):
+        records = self.requests_of("student", "list-courses")
+        with self.assertRaises(AssertionError) as failure:
+            self.assert_budget(records, 0, "student list-courses")
+        self.assertIn("over its budget of 0", str(failure.exception))
+        self.assertIn("1. POST LOGIN_URL /api/users/login/ -> 200", str(failure.exception))
+
+class StatefulUploads(RequestBudget):
+    """StatefulUploads uploads books to a stateful mock server running in this process."""
+
+    url = f"http://{constants.ADDR}:{constants.PORT + 3}"
+
+    def setUp(self):
+        super().setUp()
+        server = test_server.make_server(constants.PORT + 3, stateful=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        # The stateful server keeps what the tests create, in this process.
+        self.saved = [(data, list(data)) for data in (test_server.books, test_server.parts, test_server.chapters)]
+        self.addCleanup(self.reset_server)
+
+    def reset_server(self):
+        """reset_server drops the books, parts and chapters created since the test started."""
+        for data, saved in self.saved:
+            data[:] = saved
+
+    def upload_book(self, label, chapters, home=None, **fields):
+        book = {
+            "book": label,
+            "parts": [{"number": 1, "title": "Part", "label": f"{label}:part"}],
+            "chapters": [
+                dict(number=n, part=1, label=f"{label}:{n}", pdf=os.path.abspath("testdata/chapter.pdf"), **fields)
+                for n in range(1, chapters + 1)
+            ],
+        }
+        path = os.path.join(self.tmp, f"{label}.json")
+        with open(path, "w") as f:
+            json.dump(book, f)
+        return self.requests_of("admin", f"upload-book TestCourse0 {path} --sleep-time 0", home=home)
+
+class TestUploadBookBudget(StatefulUploads):
+    """upload-book must send a constant number of requests per chapter, plus a constant overhead."""
+
+    # Requests per chapter: creating it, uploading its content, checking that
+    # its book is unlocked and fetching the upload's warnings and errors.
+    PER_CHAPTER = 4
+    OVERHEAD = 10
+
+    def test_upload_book_scales_per_chapter(self):
+        counts = {}
+        for k in (1, 2, 4):
+            records = self.upload_book(f"BudgetBook{k}", k)
+            self.assert_budget(records, self.OVERHEAD + self.PER_CHAPTER * k, f"upload-book with {k} chapters")
+            counts[k] = len(records)
+        # Every chapter costs the same number of requests.
+        self.assertEqual(counts[2] - counts[1], (counts[4] - counts[2]) / 2, counts)
+
+class TestUploadManifest(StatefulUploads):
+    def test_recreated_chapters_are_uploaded(self):
+        home = os.path.join(self.tmp, "home")
+        self.upload_book("RecreatedBook", 2, home=home)
+        self.assertEqual(self.result.output.count("Successfully uploaded chapter."), 2)
+
+        # Unchanged chapters are skipped, without setting their publish dates again...
+        records = self.upload_book("RecreatedBook", 2, home=home)
+        self.assertEqual(self.result.output.count("is unchanged, skipping upload."), 2)
+        self.assertEqual([r["method"] for r in records], ["GET"])
+
+        # ...unless they changed.
+        records = self.upload_book("RecreatedBook", 2, home=home, **{"publish-on-week": "3/5, 14:30"})
+        self.assertEqual([r["method"] for r in records].count("PATCH"), 2)
+        self.assertEqual(self.result.output.count("Successfully uploaded chapter."), 2)
+        self.upload_book("RecreatedBook", 2, home=home, **{"publish-on-week": "3/5, 14:30"})
+        self.assertEqual(self.result.output.count("is unchanged, skipping upload."), 2)
+
+        # ...but not once the book was deleted and the chapters created again.
+        self.reset_server()
+        # Drop the metadata snapshot, as refresh-cache would.
+        shutil.rmtree(os.path.join(home, "catalog"))
+        self.upload_book("RecreatedBook", 2, home=home)
+        self.assert_in_output("Successfully created chapter number (1)")
+        self.assertNotIn("is unchanged", self.result.output)
+        self.assertEqual(self.result.output.count("Successfully uploaded chapter."), 2)
+
+class TestTokenCache(Base):
+    def test_rejected_token_is_refreshed(self):
+        TokenCache().put(SERVURL, "test", "stale")
+
+        # Bypass the catalog so that the command has to talk to the server.
+        self.run_user_cmd("--cache-ttl 0 list-courses")
+
+        self.assert_successful_execution()
+        self.assertEqual(TokenCache().get(SERVURL, "test"), "test")
+
+    def test_cached_token_skips_login(self):
+        TokenCache().put(SERVURL, "test", "test")
+        base_cmd = f"student --url {SERVURL} --username test --no-debug"
+
+        # Without a password, the command can only succeed if it does not log in.
+        self.result = self.runner.invoke(diderot, f"{base_cmd} list-courses")
+
+        self.assert_successful_execution()
+        for c in courses:
+            self.assert_in_output(c["label"])
+
+        # With the cache disabled, the CLI has to ask for the password and log in.
+        with unittest.mock.patch.object(DiderotClient, "login", side_effect=APIError("Login failed.")) as login:
+            self.result = self.runner.invoke(diderot, f"{base_cmd} --no-token-cache list-courses", input="secret\n")
+
+        self.assert_unsuccessful_execution()
+        self.assert_in_output("Password")
+        login.assert_called_once_with("test", "secret")
+
+    def test_token_cache_is_private(self):
+        self.run_user_cmd("list-courses")
+
+        self.assert_successful_execution()
+        self.assertEqual(os.stat(TokenCache().path).st_mode & 0o777, 0o600)
+
+class TestAgent(Base):
+    def tearDown(self):
+        self.runner.invoke(diderot, "agent stop")
+
+    def forward(self, cmd):
+        out = StringIO()
+        with redirect_stdout(out):
+            code = agent.forward(shlex.split(f"student --url {SERVURL} --username test --password test {cmd}"))
+        return code, out.getvalue()
+
+    def test_forwarding(self):
+        # Without an agent, commands are not forwarded.
+        self.assertIsNone(agent.forward(["student", "list-courses"]))
+
+        self.result = self.runner.invoke(diderot, "agent start --idle-timeout 60")
+        self.assert_successful_execution()
+        self.assert_in_output("Agent started.")
+
+        for _ in range(2):
+            code, output = self.forward("list-courses")
+            self.assertEqual(code, 0)
+            for c in courses:
+                self.assertIn(c["label"], output)
+
+        code, _ = self.forward("list-assignments fakelabel")
+        self.assertEqual(code, 1)
+
+        # All commands shared a single logged in session.
+        self.result = self.runner.invoke(diderot, "agent status")
+        self.assert_in_output("3 commands served, 1 sessions.")
+
+        self.result = self.runner.invoke(diderot, "agent stop")
+        self.assert_in_output("Agent stopped.")
+
+    def test_pooled_sessions_forget_resolved_objects(self):
+        dc = DiderotContext()
+        dc.url, dc.username, dc.password, dc.sessions = SERVURL, "test", "test", {}
+        with click.Context(diderot, obj=dc):
+            with setup_client(dc) as api:
+                Course.resolve(api.client, "TestCourse0")
+                self.assertTrue(api.client.identities.objects)
+            with setup_client(dc) as pooled:
+                self.assertIs(pooled, api)
+                self.assertEqual(pooled.client.identities.objects, {})
+        api.close()
+
 
 server_process = None
+state_dir = None
 def setUpModule():
     # Start the server in a subprocess.
     logging.basicConfig(stream=sys.stderr)
     logger = logging.getLogger("TESTLOG")
     logger.setLevel(logging.DEBUG)
 
+    # Keep the CLI's local state (token cache, etc.) away from the user's.
+    global state_dir
+    state_dir = tempfile.mkdtemp()
+    os.environ["DIDEROT_HOME"] = state_dir
+
     global server_process
     server_process = subprocess.Popen(["python3", "test_server.py"])
 
@@ -511,6 +1754,7 @@ def setUpModule():
 
 def tearDownModule():
     server_process.kill()
+    shutil.rmtree(state_dir)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,54 @@
+"""
+A mock Diderot server for the tests and benchmarks.
+
+By default it answers instantly and never fails. Run as a script, or through
+make_server, it can instead simulate a real deployment:
+
+* --latency and --route-latency delay responses by a fixed time or a random
+  distribution, overall or per route. Routes are named after their constants
+  in constants.py, as in --trace records.
+* --bandwidth caps the bytes per second that all connections together send and
+  receive.
+* --error-rate fails that fraction of requests with one of the --errors:
+  5xx responses (with the --error-statuses), connection resets, or slow
+  bodies sent with --slow-delay pauses.
+* --lock-rate keeps a book locked after a chapter upload for --lock-min
+  seconds plus one second for every --lock-rate bytes uploaded, the way
+  Diderot does while it processes the upload.
+* --stateful keeps the books, parts and chapters created through it.
+
+Requests are served on their own threads, so concurrent clients overlap.
+"""
+
+import argparse
 import cgi
+import hashlib
 import json
+import random
+import re
+import socket
+import struct
+import threading
+import time
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs, urlparse
 
-from diderot_cli.constants import ADDR, PORT, COURSE_API, BOOK_API, PARTS_API, CHAPTERS_API, LOGIN_URL
+from diderot_cli.constants import (
+    ADDR, PORT, COURSE_API, BOOK_API, PARTS_API, CHAPTERS_API, LOGIN_URL, CHUNKED_UPLOAD_API,
+)
+from diderot_cli.trace import route_of
+
+ERRORS = ("5xx", "reset", "slow")
+ERROR_STATUSES = (500, 502, 503, 504)
+
+# Routes that create objects, which a --stateful server adds to its data.
+CREATE_BOOK = re.compile(r"/api/courses/(\w+)/manage-books/$")
+CREATE_PART = re.compile(r"/api/courses/(\w+)/books/(\w+)/parts/$")
+CREATE_CHAPTER = re.compile(r"/api/courses/(\w+)/books/(\w+)/manage-chapters/$")
+CONTENT_UPLOAD = re.compile(r"/api/courses/(\w+)/books/(\w+)/manage-chapters/(\w+)/content_upload/$")
+
+TOKEN = "test"
 
 courses = [
     {"id": "0", "label": "TestCourse0", "number": "0", "s3_autograder_bucket": "test_bucket"},
@@ -99,12 +143,146 @@ chapters = [
     },
 ]
 
+# Chunked uploads by id. The chunk size is tiny so that tests send several.
+CHUNK_SIZE = 4
+uploads = {}
+
+# Guards the data above, which requests on several threads change.
+lock = threading.Lock()
+# Time until which each book, by id, is locked processing an upload.
+locked_until = {}
+
+
+def distribution(spec):
+    """
+    distribution returns a function drawing delays in seconds as described by
+    spec: a number for a fixed delay, or "uniform:MIN:MAX", "normal:MEAN:SD"
+    or "exp:MEAN".
+    """
+
+    if isinstance(spec, (int, float)):
+        return lambda: spec
+    kind, *args = spec.split(":")
+    if not args:
+        delay = float(kind)
+        return lambda: delay
+    args = [float(a) for a in args]
+    if kind == "uniform":
+        return lambda: random.uniform(*args)
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(*args))
+    if kind == "exp":
+        return lambda: random.expovariate(1 / args[0]) if args[0] > 0 else 0.0
+    raise ValueError(f"unknown distribution {spec}")
+
+
+class Link:
+    """Link is a shared connection of limited bandwidth, which transfers take turns on."""
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.free_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def transfer(self, n):
+        """transfer blocks for as long as sending n bytes takes, after the transfers ahead of it."""
+        with self.lock:
+            start = max(time.monotonic(), self.free_at)
+            self.free_at = start + n / self.bandwidth
+            done = self.free_at
+        time.sleep(max(0.0, done - time.monotonic()))
+
+
+class ThrottledFile:
+    """ThrottledFile reads and writes a socket file through a Link, pausing before the second half of slow bodies."""
+
+    chunk_size = 16 * 1024
+
+    def __init__(self, f, link, handler):
+        self.f = f
+        self.link = link
+        self.handler = handler
+
+    def read(self, n=-1):
+        if self.link is None or n is None or n < 0:
+            return self.f.read(n)
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.f.read(min(self.chunk_size, n - len(data)))
+            if not chunk:
+                break
+            self.link.transfer(len(chunk))
+            data += chunk
+        return bytes(data)
+
+    def readline(self, *args):
+        line = self.f.readline(*args)
+        if self.link is not None:
+            self.link.transfer(len(line))
+        return line
+
+    def write(self, data):
+        if self.handler.slow and self.handler.body_started and len(data) > 1:
+            # Stall in the middle of the body, then send the rest.
+            self.handler.slow = False
+            half = len(data) // 2
+            self.write(data[:half])
+            self.flush()
+            time.sleep(self.handler.server.slow_delay)
+            return half + self.write(data[half:])
+        if self.link is None:
+            return self.f.write(data)
+        for i in range(0, len(data), self.chunk_size):
+            chunk = data[i:i + self.chunk_size]
+            self.link.transfer(len(chunk))
+            self.f.write(chunk)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
 
 # TODO (rohany): This seems unlikely, but maybe theres a way to run an actual
 # mini-server of diderot here?
 # Create an HTTP server handler to pretend to be Diderot to do some verification.
 class DiderotHTTPHandler(BaseHTTPRequestHandler):
 
+    def setup(self):
+        super().setup()
+        self.slow = False
+        self.body_started = False
+        self.rfile = ThrottledFile(self.rfile, self.server.uplink, self)
+        self.wfile = ThrottledFile(self.wfile, self.server.downlink, self)
+
+    def end_headers(self):
+        super().end_headers()
+        self.body_started = True
+
+    # Delay the request, and fail it if the server injects an error.
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        server = self.server
+        route = route_of(urlparse(self.path).path) or "other"
+        time.sleep(server.route_latency.get(route, server.latency)())
+
+        if server.error_rate <= 0 or random.random() >= server.error_rate:
+            return True
+        error = random.choice(server.errors)
+        if error == "5xx":
+            self.send_response(random.choice(server.error_statuses))
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-length", "0")
+            self.end_headers()
+            return False
+        if error == "reset":
+            # Close the connection with a RST instead of answering.
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return False
+        self.slow = True
+        return True
+
     # useful json wrapper
     def dump(self, obj):
         js = json.dumps(obj)
@@ -133,7 +311,16 @@ class DiderotHTTPHandler(BaseHTTPRequestHandler):
         return self.filter(courses)
 
     def list_books(self):
-        return self.filter(books)
+        now = time.monotonic()
+        return self.filter([dict(b, is_locked=b["is_locked"] or locked_until.get(b["id"], 0) > now) for b in books])
+
+    # Lock the book of a chapter upload for as long as processing it takes.
+    def lock_book(self, book_id, size):
+        if self.server.lock_rate or self.server.lock_min:
+            processing = size / self.server.lock_rate if self.server.lock_rate else 0
+            with lock:
+                until = time.monotonic() + self.server.lock_min + processing
+                locked_until[book_id] = max(locked_until.get(book_id, 0), until)
 
     def list_parts(self):
         return self.filter(parts)
@@ -141,6 +328,63 @@ class DiderotHTTPHandler(BaseHTTPRequestHandler):
     def list_chapters(self):
         return self.filter(chapters)
 
+    # Reject API requests that do not carry the token handed out on login.
+    def authorized(self):
+        if not self.path.startswith("/api/") or self.path.startswith(LOGIN_URL):
+            return True
+        if self.headers.get("Authorization") == f"Token {TOKEN}":
+            return True
+        self.send_response(401)
+        self.send_header("Content-length", "0")
+        self.end_headers()
+        return False
+
+    def upload_status(self, upload_id):
+        upload = uploads[upload_id]
+        return {"id": upload_id, "size": upload["size"], "received": len(upload["data"]), "chunk_size": CHUNK_SIZE}
+
+    # Whether a file was sent in a form, directly or as a completed chunked upload.
+    def has_file(self, fields, name):
+        if name in fields:
+            return True
+        upload_id = fields.get(f"{name}_upload_id", [None])[0]
+        if upload_id not in uploads:
+            return False
+        upload = uploads[upload_id]
+        return len(upload["data"]) == upload["size"]
+
+    def course_label(self, course_id):
+        return next(c["label"] for c in courses if c["id"] == course_id)
+
+    # Add the objects created by POSTs to the data, for --stateful servers.
+    def create(self, params):
+        path = urlparse(self.path).path
+        m = CREATE_BOOK.match(path)
+        if m:
+            course_id = m[1]
+            books.append({
+                "id": str(len(books)), "label": params["label"], "title": params.get("title", params["label"]),
+                "course": course_id, "course__label": self.course_label(course_id), "version": "1", "is_locked": False,
+            })
+            return
+        m = CREATE_PART.match(path)
+        if m:
+            book_id = m[2]
+            parts.append({
+                "id": str(len(parts)), "label": params.get("label", ""), "title": params.get("title", ""),
+                "book": book_id, "book__id": book_id, "rank": params["rank"],
+            })
+            return
+        m = CREATE_CHAPTER.match(path)
+        if m:
+            course_id, book_id = m[1], m[2]
+            chapters.append({
+                "id": str(len(chapters)), "label": params.get("label", ""), "title": params.get("title", ""),
+                "book": book_id, "book__id": book_id, "part": params["part"], "rank": params["rank"],
+                "upload_errors": "", "upload_warnings": "",
+                "course__label": self.course_label(course_id), "course__id": course_id,
+            })
+
     def json_response(self, data: str):
         self.send_response(200)
         self.send_header("Content-type", "application/json")
@@ -149,13 +393,35 @@ class DiderotHTTPHandler(BaseHTTPRequestHandler):
         self.wfile.write(data)
 
     def file_response(self, data: bytes):
-        self.send_response(200)
+        etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        # Serve the rest of the file from the start of a "bytes=N-" range,
+        # unless If-Range names another version of it.
+        start = 0
+        if self.headers.get("Range", "").startswith("bytes=") and self.headers.get("If-Range", etag) == etag:
+            start = int(self.headers["Range"][len("bytes="):].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
         self.send_header("Content-type", "binary/octet-stream")
-        self.send_header("Content-length", str(len(data)))
+        self.send_header("Content-length", str(len(data) - start))
         self.end_headers()
-        self.wfile.write(data)
+        self.wfile.write(data[start:])
 
     def do_GET(self):
+        if not self.authorized():
+            return
         # base path
         if self.path == "/":
             self.json_response("")
@@ -164,9 +430,12 @@ class DiderotHTTPHandler(BaseHTTPRequestHandler):
             self.json_response(data)
         elif self.path.startswith("/handout_url.tgz"):
             self.file_response(b"handout_url")
+        elif self.path.startswith("/writeup_url.pdf"):
+            self.file_response(b"writeup_url")
         elif self.path.startswith("/api/courses/0/codelabs/0/attached_file_urls/"):
             data = self.dump({
-                "handout_url": f"http://{ADDR}:{PORT}/handout_url.tgz",
+                "handout_url": f"http://{ADDR}:{self.server.server_port}/handout_url.tgz",
+                "writeup_url": f"http://{ADDR}:{self.server.server_port}/writeup_url.pdf",
             })
             self.json_response(data)
         elif self.path.startswith("/api/courses/0/codelabs/"):
@@ -184,12 +453,22 @@ class DiderotHTTPHandler(BaseHTTPRequestHandler):
         elif self.path.startswith(CHAPTERS_API):
             data = self.dump(self.list_chapters())
             self.json_response(data)
+        elif self.path.startswith(CHUNKED_UPLOAD_API):
+            upload_id = self.path[len(CHUNKED_UPLOAD_API):].strip("/")
+            if upload_id in uploads:
+                self.json_response(self.dump(self.upload_status(upload_id)))
+            else:
+                self.send_response(404)
+                self.send_header("Content-length", "0")
+                self.end_headers()
         else:
             print("GOT THIS URL AND IM ANGRY", self.path)
             self.send_response(200)
             self.end_headers()
 
     def do_PATCH(self):
+        if not self.authorized():
+            return
         if self.path.startswith("/api/courses/0/codelabs/0"):
             success = True
             # HEADERS are now in dict/json style container
@@ -204,9 +483,9 @@ class DiderotHTTPHandler(BaseHTTPRequestHandler):
             success = all(
                 [
                     success,
-                    "autograder-makefile" in fields,
-                    "autograder-tar" in fields,
-                    "handout" in fields,
+                    self.has_file(fields, "autograder-makefile"),
+                    self.has_file(fields, "autograder-tar"),
+                    self.has_file(fields, "handout"),
                 ]
             )
             if success:
@@ -220,16 +499,30 @@ class DiderotHTTPHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_POST(self):
+        if not self.authorized():
+            return
         # Handle the login behavior
         if self.path.startswith(LOGIN_URL):
-            data = self.dump({"key": "test"})
+            data = self.dump({"key": TOKEN})
+            self.json_response(data)
+        # Start a chunked upload
+        elif self.path == CHUNKED_UPLOAD_API:
+            params = self.post_params()
+            with lock:
+                upload_id = str(len(uploads))
+                uploads[upload_id] = {"size": int(params["size"]), "data": bytearray()}
+            data = self.dump(self.upload_status(upload_id))
             self.json_response(data)
         # handle submitting an assignment to course 0
         elif self.path.startswith("/api/courses/0/codelabs/0/submissions/create_and_submit/"):
             success = True
             # assert that submission tar is indeed in the request files
-            self.rfile.readline()
-            line = str(self.rfile.readline())
+            length = int(self.headers["Content-Length"])
+            first = self.rfile.readline()
+            line = self.rfile.readline()
+            # Read the rest of the submission before answering.
+            self.rfile.read(length - len(first) - len(line))
+            line = str(line)
 
             # depending on the upload type of the homework, check that
             # the appropriate tag is in the header
@@ -285,18 +578,121 @@ class DiderotHTTPHandler(BaseHTTPRequestHandler):
             else:
                 self.send_response(400)
             self.send_header("Content-length", "0")
+        # Chapter content uploads lock their book while they are processed.
+        elif CONTENT_UPLOAD.match(self.path):
+            size = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(size)
+            self.lock_book(CONTENT_UPLOAD.match(self.path)[2], size)
+            self.send_response(200)
+            self.send_header("Content-length", "0")
+        elif self.server.stateful and (
+            CREATE_BOOK.match(self.path) or CREATE_PART.match(self.path) or CREATE_CHAPTER.match(self.path)
+        ):
+            params = self.post_params()
+            with lock:
+                self.create(params)
+            self.send_response(200)
+            self.send_header("Content-length", "0")
         else:
             self.send_response(200)
             self.send_header("Content-length", "0")
         self.end_headers()
 
+    # Receive a chunk of a chunked upload, which must start where the
+    # previous one ended and match its checksum.
+    def do_PUT(self):
+        if not self.authorized():
+            return
+        upload_id = self.path[len(CHUNKED_UPLOAD_API):].strip("/")
+        chunk = self.rfile.read(int(self.headers["Content-Length"]))
+        if not self.path.startswith(CHUNKED_UPLOAD_API) or upload_id not in uploads:
+            self.send_response(404)
+            self.send_header("Content-length", "0")
+            self.end_headers()
+            return
+        upload = uploads[upload_id]
+        start = int(self.headers["Content-Range"].split()[1].split("-")[0])
+        with lock:
+            accepted = start == len(upload["data"]) and hashlib.sha256(chunk).hexdigest() == self.headers["X-Chunk-SHA256"]
+            if accepted:
+                upload["data"] += chunk
+        if not accepted:
+            self.send_response(409)
+            self.send_header("Content-length", "0")
+            self.end_headers()
+            return
+        self.json_response(self.dump(self.upload_status(upload_id)))
+
     # silence log messages.
     def log_message(self, format, *args):
         return
 
 
+def make_server(
+    port=PORT, latency=0.0, stateful=False, route_latency=None, bandwidth=None,
+    error_rate=0.0, errors=ERRORS, error_statuses=ERROR_STATUSES, slow_delay=1.0, lock_rate=None, lock_min=0.0,
+    seed=None,
+):
+    """
+    make_server returns a mock Diderot server on port, simulating a real one
+    as described in the module's documentation. Latencies are distribution
+    specs, route_latency maps route names to them, and seed makes the random
+    delays and errors repeatable.
+    """
+
+    if seed is not None:
+        random.seed(seed)
+    httpd = ThreadingHTTPServer((ADDR, port), DiderotHTTPHandler)
+    httpd.daemon_threads = True
+    httpd.latency = distribution(latency)
+    httpd.route_latency = {route: distribution(spec) for route, spec in (route_latency or {}).items()}
+    httpd.uplink = Link(bandwidth) if bandwidth else None
+    httpd.downlink = Link(bandwidth) if bandwidth else None
+    httpd.error_rate = error_rate
+    httpd.errors = list(errors)
+    httpd.error_statuses = list(error_statuses)
+    httpd.slow_delay = slow_delay
+    httpd.lock_rate = lock_rate
+    httpd.lock_min = lock_min
+    httpd.stateful = stateful
+    return httpd
+
+
 # run the unit tests
 if __name__ == "__main__":
-    server_address = (ADDR, PORT)
-    httpd = HTTPServer(server_address, DiderotHTTPHandler)
-    httpd.serve_forever()
+    parser = argparse.ArgumentParser(description="Mock Diderot server for tests and benchmarks.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--latency", default="0", help="Seconds before each response: N, uniform:MIN:MAX, normal:MEAN:SD or exp:MEAN.",
+    )
+    parser.add_argument(
+        "--route-latency", action="append", default=[], metavar="ROUTE=SPEC",
+        help="Latency of one route, named after its constant, such as CHAPTERS_API=exp:0.2.",
+    )
+    parser.add_argument("--bandwidth", type=float, help="Bytes per second sent and received by all connections.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail.")
+    parser.add_argument(
+        "--errors", default=",".join(ERRORS), help=f"Comma-separated failures to inject, among {', '.join(ERRORS)}.",
+    )
+    parser.add_argument(
+        "--error-statuses", default=",".join(map(str, ERROR_STATUSES)),
+        help="Comma-separated statuses of the 5xx responses injected.",
+    )
+    parser.add_argument("--slow-delay", type=float, default=1.0, help="Seconds slow bodies pause for.")
+    parser.add_argument("--lock-rate", type=float, help="Bytes of chapter upload processed per second while locked.")
+    parser.add_argument("--lock-min", type=float, default=0.0, help="Seconds every chapter upload keeps its book locked.")
+    parser.add_argument("--seed", type=int, help="Seed of the random latencies and errors.")
+    parser.add_argument("--stateful", action="store_true", help="Keep the books, parts and chapters created.")
+    options = parser.parse_args()
+    make_server(
+        options.port, options.latency, options.stateful,
+        route_latency=dict(spec.split("=", 1) for spec in options.route_latency),
+        bandwidth=options.bandwidth,
+        error_rate=options.error_rate,
+        errors=options.errors.split(","),
+        error_statuses=[int(status) for status in options.error_statuses.split(",")],
+        slow_delay=options.slow_delay,
+        lock_rate=options.lock_rate,
+        lock_min=options.lock_min,
+        seed=options.seed,
+    ).serve_forever()